@@ -27,68 +27,621 @@
 # $Id$
 
 __revision__ = "r"+"$Revision$"[11:-2]
-__all__ = ['AptRepoClient', 'AptRepoException']
+__all__ = ['AptRepoClient', 'AptRepoException', 'AptRepoParagraph', 'LazyAptRepoParagraph',
+           'CompactAptRepoParagraph']
 
-from minideblib.DpkgControl import DpkgParagraph
+from minideblib.DpkgControl import DpkgParagraph, split_paragraphs, decode_value, _field_re
 from minideblib.DpkgDatalist import DpkgOrderedDatalist
-from minideblib.DpkgVersion import DpkgVersion, VersionError
+from minideblib.OrderedDict import OrderedDict
+from minideblib.DpkgVersion import DpkgVersion, VersionError, cached_version
 from minideblib.LoggableObject import LoggableObject
+from minideblib.SafeWriteFile import SafeWriteFile
+from minideblib.SignedFile import SignedFile
+import os
 import re
+import errno
 import urllib2
 import types
 import time
 import posixpath
 import cStringIO
-import gzip
-
-
-def _universal_urlopen(url):
-    """More robust urlopen. It understands gzip transfer encoding"""
+import zlib
+import hashlib
+import bisect
+import struct
+import array
+import sys
+import tempfile
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+import threading
+import Queue
+
+# Decompressor factories for index compressions we can handle
+_DECOMPRESSORS = {".gz": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)}
+if bz2 is not None:
+    _DECOMPRESSORS[".bz2"] = bz2.BZ2Decompressor
+if lzma is not None:
+    _DECOMPRESSORS[".xz"] = lzma.LZMADecompressor
+# Index compressions in order of preference
+_COMPRESSIONS = [ext for ext in (".xz", ".bz2", ".gz") if ext in _DECOMPRESSORS] + [""]
+
+
+class _MetadataCache:
+    """On-disk storage of fetched index files together with their HTTP validators.
+       Entry of url is .meta file with validators, which names .data file with body.
+       Each body is written to new .data file, so body and validators are replaced
+       together, when new .meta file is renamed over the old one"""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __path(self, url):
+        """Returns path to cache entry (without extension) for url"""
+        return os.path.join(self.cache_dir, hashlib.md5(url).hexdigest())
+
+    def __read_meta(self, path):
+        """Returns contents of .meta file at path or None if there is no such file"""
+        try:
+            fhdl = open(path, "r")
+        except IOError:
+            return None
+        try:
+            meta = DpkgParagraph()
+            meta.load(fhdl)
+        finally:
+            fhdl.close()
+        return meta
+
+    def __load_meta(self, url):
+        """Returns stored headers for url or None if url is not cached"""
+        meta = self.__read_meta(self.__path(url) + ".meta")
+        if meta is None or meta.get('url') != url or not meta.get('data') or \
+                not os.path.isfile(os.path.join(self.cache_dir, meta['data'])):
+            return None
+        return meta
+
+    def validators(self, url):
+        """Returns dictionary of conditional request headers for url"""
+        headers = {}
+        meta = self.__load_meta(url)
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last-modified'):
+                headers['If-Modified-Since'] = meta['last-modified']
+        return headers
+
+    def content_encoding(self, url):
+        """Returns Content-Encoding which cached data for url was received with"""
+        meta = self.__load_meta(url)
+        return meta and meta.get('content-encoding') or None
+
+    def open(self, url):
+        """Returns file object with cached body for url"""
+        meta = self.__load_meta(url)
+        if meta is None:
+            raise IOError(errno.ENOENT, "Not cached", url)
+        return open(os.path.join(self.cache_dir, meta['data']), "rb")
+
+    def writer(self, url):
+        """Returns file object new body for url is written to.
+           Body is only stored after successful commit()"""
+        (fdesc, newname) = tempfile.mkstemp(prefix=os.path.basename(self.__path(url)) + ".",
+                                            suffix=".data.new", dir=self.cache_dir)
+        os.close(fdesc)
+        return SafeWriteFile(newname, newname[:-len(".new")], "wb")
+
+    def commit(self, url, fhdl, headers):
+        """Stores body written to fhdl and validators from response headers"""
+        path = self.__path(url)
+        old = self.__read_meta(path + ".meta")
+        fhdl.close()
+        meta = DpkgParagraph()
+        meta['URL'] = url
+        data = os.path.basename(fhdl.realname)
+        meta['Data'] = data
+        for field in ('ETag', 'Last-Modified', 'Content-Encoding'):
+            if headers.get(field):
+                meta[field] = headers.get(field)
+        meta.store(path + ".meta")
+        if old is not None and old.get('data') and old['data'] != data:
+            self.__remove(old['data'])
+
+    def index_copy(self, url):
+        """Returns uncompressed copy of index at url stored with store_index_copy() or None"""
+        try:
+            fhdl = open(self.__path(url) + ".index", "rb")
+        except IOError:
+            return None
+        try:
+            if fhdl.readline() != url + "\n":
+                return None
+            return fhdl.read()
+        finally:
+            fhdl.close()
+
+    def store_index_copy(self, url, data):
+        """Stores uncompressed copy of index at url, which diffs are applied to later"""
+        fhdl = SafeWriteFile(self.__path(url) + ".index.new", self.__path(url) + ".index", "wb")
+        try:
+            fhdl.write(url + "\n")
+            fhdl.write(data)
+        except:
+            self.abort(fhdl)
+            raise
+        fhdl.close()
+
+    def abort(self, fhdl):
+        """Discards body written to fhdl"""
+        fhdl.abort()
+        fhdl.fobj.close()
+        if os.path.exists(fhdl.newname):
+            os.unlink(fhdl.newname)
+
+    def prune(self, prefix, keep):
+        """Removes entries of urls under prefix (without trailing slash), which are not
+           in keep, and bodies no entry refers to"""
+        names = os.listdir(self.cache_dir)
+        referenced = set()
+        for name in names:
+            url = None
+            if name.endswith(".meta"):
+                meta = self.__read_meta(os.path.join(self.cache_dir, name))
+                if meta is None:
+                    continue
+                if not meta.get('data'):
+                    # Written by older version, which kept body in file of fixed name
+                    self.__remove(name)
+                    continue
+                url = meta.get('url', '')
+                referenced.add(meta['data'])
+            elif name.endswith(".index"):
+                try:
+                    fhdl = open(os.path.join(self.cache_dir, name), "rb")
+                except IOError:
+                    continue
+                try:
+                    url = fhdl.readline().rstrip("\n")
+                finally:
+                    fhdl.close()
+            if url is not None and url.startswith(prefix + "/") and url not in keep:
+                self.__remove(name)
+                if name.endswith(".meta"):
+                    referenced.discard(meta['data'])
+        for name in names:
+            if name.endswith(".data") and name not in referenced:
+                self.__remove(name)
+
+    def __remove(self, name):
+        """Removes file name from cache directory, if it's still there"""
+        try:
+            os.unlink(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+
+class _Decompressor:
+    """Incremental decompressor, which also handles concatenated streams"""
+    def __init__(self, factory):
+        self.__factory = factory
+        self.__obj = factory()
+
+    def decompress(self, data):
+        """Decompresses next chunk of data"""
+        result = []
+        while data:
+            result.append(self.__obj.decompress(data))
+            data = getattr(self.__obj, 'unused_data', '')
+            if data:
+                # Next stream starts
+                self.__obj = self.__factory()
+        return "".join(result)
+
+    def flush(self):
+        """Returns rest of decompressed data"""
+        if hasattr(self.__obj, 'flush'):
+            return self.__obj.flush()
+        return ""
+
+
+class _StreamReader:
+    """File-like object which reads stream chunk by chunk, decompresses it on the fly
+       and verifies checksum of (compressed) data when end of stream is reached.
+       Raw data can be copied to cache on the way."""
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, stream, url, transfer_gzip=False, compression="", checksum=None,
+                 cache=None, cache_fhdl=None, headers=None, not_modified=False):
+        self.__stream = stream
+        # True if data comes from cache, because server replied it was not modified
+        self.not_modified = not_modified
+        self.__url = url
+        self.__transfer = None
+        if transfer_gzip:
+            self.__transfer = _Decompressor(_DECOMPRESSORS[".gz"])
+        self.__decompressor = None
+        if compression:
+            self.__decompressor = _Decompressor(_DECOMPRESSORS[compression])
+        self.__checksum = checksum
+        self.__hasher = None
+        if checksum is not None:
+            # Checksums from Release file name their algorithm, diff indexes use SHA256
+            self.__hasher = hashlib.new(len(checksum) > 2 and checksum[2] or "sha256")
+        self.__size = 0
+        self.__cache = cache
+        self.__cache_fhdl = cache_fhdl
+        self.__headers = headers
+        # Complete lines decoded so far and beginning of the next line
+        self.__lines = cStringIO.StringIO()
+        self.__tail = ""
+        self.__eof = False
+
+    def __fill(self):
+        """Reads and decodes next chunk of stream into buffer"""
+        raw = self.__stream.read(self.CHUNK_SIZE)
+        if self.__cache_fhdl is not None and raw:
+            self.__cache_fhdl.write(raw)
+        try:
+            data = self.__decode(raw)
+            if not raw:
+                self.__verify()
+        except:
+            if self.__cache_fhdl is not None:
+                # Broken data must not be stored together with its validators
+                self.__cache.abort(self.__cache_fhdl)
+                self.__cache_fhdl = None
+            raise
+        data = self.__tail + data
+        if not raw:
+            if self.__cache_fhdl is not None:
+                self.__cache.commit(self.__url, self.__cache_fhdl, self.__headers)
+                self.__cache_fhdl = None
+            self.__eof = True
+            self.__tail = ""
+        else:
+            idx = data.rfind("\n") + 1
+            self.__tail = data[idx:]
+            data = data[:idx]
+        self.__lines = cStringIO.StringIO(data)
+
+    def __decode(self, raw):
+        """Decodes next chunk of raw stream, empty chunk means end of stream"""
+        if self.__transfer is not None:
+            data = self.__transfer.decompress(raw)
+            if not raw:
+                data += self.__transfer.flush()
+        else:
+            data = raw
+        self.__size += len(data)
+        if self.__hasher is not None:
+            self.__hasher.update(data)
+        if self.__decompressor is not None:
+            data = self.__decompressor.decompress(data)
+            if not raw:
+                data += self.__decompressor.flush()
+        return data
+
+    def __verify(self):
+        """Checks size and checksum of received data"""
+        if self.__checksum is None:
+            return
+        if self.__size != self.__checksum[1] or self.__hasher.hexdigest() != self.__checksum[0]:
+            raise AptRepoException("Checksum mismatch: %s" % self.__url)
+
+    def readline(self):
+        """Returns next line from stream"""
+        line = self.__lines.readline()
+        while not line and not self.__eof:
+            self.__fill()
+            line = self.__lines.readline()
+        return line
+
+    def read(self, size=-1):
+        """Reads up to size bytes, or everything if size is negative"""
+        chunks = []
+        got = 0
+        while True:
+            if size < 0:
+                chunk = self.__lines.read()
+            else:
+                chunk = self.__lines.read(size - got)
+            chunks.append(chunk)
+            got += len(chunk)
+            if (size >= 0 and got >= size) or self.__eof:
+                return "".join(chunks)
+            self.__fill()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self.__cache_fhdl is not None:
+            # Not read till the end, don't store incomplete data
+            self.__cache.abort(self.__cache_fhdl)
+            self.__cache_fhdl = None
+        self.__stream.close()
+
+
+def _universal_urlopen(url, cache=None, compression=None, checksum=None):
+    """More robust urlopen. It understands gzip transfer encoding.
+       Returned object decompresses data incrementally while it's read.
+       If cache is specified, request is made conditional and cached copy is used when
+       server replies that it was not modified.
+       compression -- extension of compressed file, by default guessed from url
+       checksum -- tuple (hexdigest, size[, hashlib algorithm]) data is verified against,
+                   SHA256 is used if algorithm is not given"""
     headers = {'User-Agent': 'Mozilla/4.0 (compatible; Python/AptRepoClient)',
                'Pragma': 'no-cache',
                'Cache-Control': 'no-cache',
                'Accept-encoding': 'gzip'}
+    if compression is None:
+        compression = posixpath.splitext(url)[1]
+        if compression not in _DECOMPRESSORS:
+            compression = ""
+    if cache is not None and not url.startswith("http"):
+        # Only HTTP knows about validators
+        cache = None
+    if cache is not None:
+        headers.update(cache.validators(url))
     request = urllib2.Request(url, None, headers)
-    usock = urllib2.urlopen(request, None, 180)
-    if usock.headers.get('content-encoding', None) == 'gzip' or url.endswith(".gz"):
-        data = usock.read()
-        data = gzip.GzipFile(fileobj=cStringIO.StringIO(data)).read()
-        return cStringIO.StringIO(data)
+    try:
+        usock = urllib2.urlopen(request, None, 180)
+    except urllib2.HTTPError, hte:
+        if hte.code != 304 or cache is None:
+            raise
+        stream = cache.open(url)
+        encoding = cache.content_encoding(url)
+        cache_fhdl = None
+        response_headers = None
+        not_modified = True
     else:
-        return usock
-
-
-def _filter_base_urls(base_url, pkgcache):
-    """Return list of keys to be used in pkgcache lookup according to requested base_keys"""
-    if base_url:
-        if isinstance(base_url, types.ListType):
-            cache_keys = base_url
-        elif isinstance(base_url, types.StringType):
-            cache_keys = [(base_url, "/", '')]
-        elif isinstance(base_url, types.TupleType):
-            cache_keys = [base_url]
+        stream = usock
+        encoding = usock.headers.get('content-encoding', None)
+        if cache is None and checksum is None and not compression and encoding != 'gzip':
+            return usock
+        cache_fhdl = None
+        if cache is not None:
+            cache_fhdl = cache.writer(url)
+        response_headers = usock.headers
+        not_modified = False
+    # If server compressed .gz file once more, it's decompressed only once
+    return _StreamReader(stream, url, encoding == 'gzip' and compression != ".gz",
+                         compression, checksum, cache, cache_fhdl, response_headers, not_modified)
+
+
+# Release file fields with checksums, strongest first: (field, by-hash directory, algorithm)
+_RELEASE_CHECKSUMS = [('sha256', 'SHA256', 'sha256'),
+                      ('sha1', 'SHA1', 'sha1'),
+                      ('md5sum', 'MD5Sum', 'md5')]
+
+
+def _parse_release(fls):
+    """Parses Release or InRelease file. Each index gets the strongest checksum listed for it.
+       Returns tuple ({index path: (hexdigest, size, algorithm)}, by-hash supported)"""
+    release = DpkgParagraph()
+    release.load(SignedFile(fls))
+    entries = {}
+    for (field, by_hash_dir, algorithm) in _RELEASE_CHECKSUMS:
+        sums = release.get(field, [])
+        if not isinstance(sums, types.ListType):
+            sums = [sums]
+        for line in sums:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] not in entries:
+                entries[fields[2]] = (fields[0], int(fields[1]), algorithm)
+    return (entries, release.get('acquire-by-hash', 'no').lower() == 'yes')
+
+
+def _pick_index(release, path):
+    """Chooses best available compressed variant of index listed in release.
+       Returns tuple (relative path to fetch, compression, (hexdigest, size, algorithm))
+       or None if index is not listed"""
+    (entries, by_hash) = release
+    for compression in _COMPRESSIONS:
+        if path + compression in entries:
+            checksum = entries[path + compression]
+            if by_hash:
+                return (_by_hash_path(path + compression, checksum), compression, checksum)
+            return (path + compression, compression, checksum)
+    return None
+
+
+def _by_hash_path(path, checksum):
+    """Returns relative by-hash path of file at path with checksum from Release file"""
+    by_hash_dir = [name for (field, name, algorithm) in _RELEASE_CHECKSUMS
+                   if algorithm == checksum[2]][0]
+    return posixpath.join(posixpath.dirname(path), "by-hash", by_hash_dir, checksum[0])
+
+
+def _release_urls(release_dir, release):
+    """Returns set of urls under release_dir, which release refers to"""
+    (entries, by_hash) = release
+    urls = set([posixpath.join(release_dir, name) for name in ("InRelease", "Release")])
+    for (path, checksum) in entries.items():
+        urls.add(posixpath.join(release_dir, path))
+        if by_hash:
+            urls.add(posixpath.join(release_dir, _by_hash_path(path, checksum)))
+    return urls
+
+
+def _pick_pdiff(release, path):
+    """Returns tuple (relative path of diff index, its checksum, checksum of uncompressed
+       index or None) if release lists diffs for index at path, otherwise None"""
+    entries = release[0]
+    if path + ".diff/Index" not in entries:
+        return None
+    checksum = entries.get(path)
+    if checksum is not None:
+        # Diffs are checked by SHA256 only
+        checksum = (checksum[2] == "sha256" and checksum[:2] or None)
+    return (path + ".diff/Index", entries[path + ".diff/Index"], checksum)
+
+
+def _parse_diff_index(fls):
+    """Parses Packages.diff/Index file. Returns tuple (current checksum,
+       [(sha256 before patch, size, patch name), ...], {patch name: checksum},
+       {compressed patch name: checksum}, patches are merged)"""
+    index = DpkgParagraph()
+    index.load(fls)
+    current = index['sha256-current'].split()
+    tables = []
+    for field in ('sha256-history', 'sha256-patches', 'sha256-download'):
+        lines = index.get(field, [])
+        if not isinstance(lines, types.ListType):
+            lines = [lines]
+        tables.append([line.split() for line in lines if len(line.split()) == 3])
+    history = [(sha, int(size), name) for (sha, size, name) in tables[0]]
+    patches = dict([(name, (sha, int(size))) for (sha, size, name) in tables[1]])
+    downloads = dict([(name, (sha, int(size))) for (sha, size, name) in tables[2]])
+    merged = index.get('x-patch-precedence', '').strip() == 'merged'
+    return ((current[0], int(current[1])), history, patches, downloads, merged)
+
+
+_ed_command_re = re.compile(r"^(\d+)(?:,(\d+))?([acd])$")
+
+
+def _apply_ed_patch(lines, patch):
+    """Applies ed script made by "diff --ed" to list of lines (with line ends)"""
+    commands = patch.splitlines(True)
+    idx = 0
+    while idx < len(commands):
+        match = _ed_command_re.match(commands[idx].rstrip("\n"))
+        if not match:
+            raise ValueError("Unsupported ed command: %r" % commands[idx])
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        idx += 1
+        text = []
+        if match.group(3) in "ac":
+            while commands[idx].rstrip("\n") != ".":
+                text.append(commands[idx])
+                idx += 1
+            idx += 1
+        if match.group(3) == "a":
+            lines[first:first] = text
+        elif match.group(3) == "c":
+            lines[first - 1:last] = text
         else:
-            # WTF!?
-            raise TypeError("Parameter base_url should be array of strings or string or tuple")
-        # Ok, we have list of keys, let's compare them
-        rkeys = set()
-        pckeys = pkgcache.keys()
-        for ckey in cache_keys:
-            if not isinstance(ckey, types.TupleType) and len(ckey) != 3:
-                raise TypeError("base_url key should be a tuple -> "
-                                "(url, distribution, section): %s" % str(ckey))
-            rkeys.update([akey for akey in pckeys if (ckey[0] is None or
-                                                      ckey[0] == akey[0]) and
-                          (ckey[1] is None or ckey[1] == akey[1]) and
-                          (ckey[2] is None or ckey[2] == akey[2])])
-        return list(rkeys) 
+            del lines[first - 1:last]
+
+
+def _is_not_found(err):
+    """Returns True if err raised by _universal_urlopen() means there is no such file"""
+    if isinstance(err, urllib2.HTTPError):
+        return err.code in (404, 410)
+    if isinstance(err, urllib2.URLError):
+        return isinstance(err.reason, (IOError, OSError)) and err.reason.errno == errno.ENOENT
+    return False
+
+
+def _index_token(url, target):
+    """Returns string, which changes when index at url changes, or None if that can't be
+       told without fetching it. target is what AptRepoClient.__plan_indexes() picked"""
+    if target is not None:
+        return target[2][0]
+    if url.startswith("file:"):
+        path = urllib2.url2pathname(url[len("file:"):])
+        stamps = []
+        for suffix in (".gz", ""):
+            try:
+                stat = os.stat(path + suffix)
+            except OSError:
+                continue
+            stamps.append("%s:%d:%d" % (suffix, stat.st_mtime, stat.st_size))
+        return "stat " + " ".join(stamps)
+    return None
+
+
+def _base_url_patterns(base_url):
+    """Return tuple of (url, distribution, section) patterns requested by base_url"""
+    if isinstance(base_url, types.ListType):
+        cache_keys = base_url
+    elif isinstance(base_url, types.StringType):
+        cache_keys = [(base_url, "/", '')]
+    elif isinstance(base_url, types.TupleType):
+        cache_keys = [base_url]
     else:
-        return pkgcache.keys()
-
-
-def _get_available_pkgs(base_url, pkgcache):
-    """Returns list of package names, available in pkgcache filtered by base_url"""
-    cache_keys = _filter_base_urls(base_url, pkgcache)
+        # WTF!?
+        raise TypeError("Parameter base_url should be array of strings or string or tuple")
+    for ckey in cache_keys:
+        if not isinstance(ckey, types.TupleType) and len(ckey) != 3:
+            raise TypeError("base_url key should be a tuple -> "
+                            "(url, distribution, section): %s" % str(ckey))
+    return tuple([tuple(ckey) for ckey in cache_keys])
+
+
+class _RepoKeyIndex(object):
+    """Finds pkgcache keys matching base_url patterns. Keys are indexed by
+       url, distribution and section, so None wildcards are resolved by set
+       intersection. Results are remembered until the keys change"""
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.pkgcache = None
+        self.count = 0
+        self.components = ({}, {}, {})
+        self.resolved = {}
+
+    def __build(self, pkgcache):
+        """Indexes keys of pkgcache"""
+        self.invalidate()
+        for key in pkgcache:
+            for (component, value) in zip(self.components, key):
+                component.setdefault(value, set()).add(key)
+        self.pkgcache = pkgcache
+        self.count = len(pkgcache)
+
+    def resolve(self, base_url, pkgcache):
+        """Return set of pkgcache keys requested by base_url or None for all of them"""
+        if not base_url:
+            return None
+        if pkgcache is not self.pkgcache or len(pkgcache) != self.count:
+            self.__build(pkgcache)
+        patterns = _base_url_patterns(base_url)
+        keys = self.resolved.get(patterns)
+        if keys is None:
+            keys = set()
+            for pattern in patterns:
+                matched = None
+                for (component, value) in zip(self.components, pattern):
+                    if value is None:
+                        continue
+                    found = component.get(value, frozenset())
+                    if matched is None:
+                        matched = set(found)
+                    else:
+                        matched &= found
+                if matched is None:
+                    matched = pkgcache.keys()
+                keys.update(matched)
+            keys = self.resolved[patterns] = frozenset(keys)
+        return keys
+
+
+def _get_available_pkgs(cache_keys, pkgcache):
+    """Returns list of package names, available in pkgcache under cache_keys (None for all)"""
+    if cache_keys is None:
+        cache_keys = pkgcache.keys()
     pkg_names = set()
     for cache_key in cache_keys:
         pkgs = pkgcache.get(cache_key, {})
@@ -96,21 +649,174 @@ def _get_available_pkgs(base_url, pkgcache):
     return list(pkg_names)
 
 
-def _get_available_versions(package, base_url, pkgcache):
-    """
-        Should return tuple (base_url,package_version) with the best version found in cache.
-        If base_url is not specified, all repositories will be checked
-    """
-    cache_keys = _filter_base_urls(base_url, pkgcache)
-
-    pkg_vers = [] 
-    for cache_key in cache_keys:
-        cache = pkgcache.get(cache_key, {})
-        if package in cache:
-            for pkg in cache[package]:
-                if (cache_key, pkg['version']) not in pkg_vers:
-                    pkg_vers.append((cache_key, pkg['version']))
-    return pkg_vers
+class _VersionIndex(object):
+    """Versions of packages from all repositories, sorted by version.
+       Entries are (version key, (rank, sequence), cache key, version, package), where
+       rank is position of repository in load order and sequence keeps order of
+       packages within it. Packages with bad versions are kept with empty version
+       key, which sorts first"""
+
+    def __init__(self):
+        self.repo_keys = _RepoKeyIndex()
+        self.clear()
+
+    def clear(self):
+        self.repo_keys.invalidate()
+        self.entries = {}
+        self.indexed = {}
+        self.ranks = {}
+        self.seq = 0
+        self.pending = None
+
+    def defer(self, pkgcache, cache_keys, logger):
+        """Indexes packages added to pkgcache on the next lookup, so loading
+           doesn't pay for it when there are no lookups. cache_keys lists just
+           loaded repositories in load order, repositories are ranked by their
+           first load"""
+        for cache_key in cache_keys:
+            if cache_key not in self.ranks:
+                self.ranks[cache_key] = len(self.ranks)
+        self.pending = (pkgcache, logger)
+
+    def __rank(self, cache_key):
+        return self.ranks.get(cache_key, sys.maxint)
+
+    def order(self, pkgcache):
+        """Returns cache keys of pkgcache in load order"""
+        return sorted(pkgcache, key=self.__rank)
+
+    def __sync(self):
+        """Indexes deferred packages"""
+        if self.pending is not None:
+            (pkgcache, logger) = self.pending
+            for cache_key in self.order(pkgcache):
+                self.update(cache_key, pkgcache[cache_key], logger)
+            self.pending = None
+
+    def drop(self, cache_key):
+        """Forgets packages of cache_key, so replaced metadata is indexed anew"""
+        for name in self.indexed.pop(cache_key, {}):
+            entries = [entry for entry in self.entries.get(name, ()) if entry[2] != cache_key]
+            if entries:
+                self.entries[name] = entries
+            else:
+                self.entries.pop(name, None)
+
+    def update(self, cache_key, metadata, logger):
+        """Indexes packages appended to metadata since the last update"""
+        indexed = self.indexed.setdefault(cache_key, {})
+        rank = self.__rank(cache_key)
+        for name in metadata.keys():
+            pkgs = metadata[name]
+            count = indexed.get(name, 0)
+            if count == len(pkgs):
+                continue
+            entries = self.entries.setdefault(name, [])
+            for pkg in pkgs[count:]:
+                version = pkg.get('version')
+                try:
+                    version = cached_version(version)
+                    key = version.cmp_key
+                except VersionError:
+                    logger.info("BadVersion: %s %s" % (name, version))
+                    key = ()
+                self.seq += 1
+                bisect.insort(entries, (key, (rank, self.seq), cache_key, version, pkg))
+            indexed[name] = len(pkgs)
+
+    def best(self, package, cache_keys=None):
+        """Returns (cache key, version) of the best version, package of repository
+           loaded first wins among equal versions. cache_keys limits repositories"""
+        self.__sync()
+        entries = self.entries.get(package, ())
+        found = None
+        for idx in xrange(len(entries) - 1, -1, -1):
+            entry = entries[idx]
+            if not entry[0] or found is not None and entry[0] != found[0]:
+                break
+            if cache_keys is None or entry[2] in cache_keys:
+                found = entry
+        if found is None:
+            return (None, None)
+        return (found[2], found[3])
+
+    def matching(self, package, version, cache_keys=None):
+        """Returns packages with given version (a DpkgVersion)"""
+        self.__sync()
+        entries = self.entries.get(package, ())
+        key = version.cmp_key
+        start = bisect.bisect_left(entries, (key,))
+        end = bisect.bisect_left(entries, (key, (sys.maxint + 1,)), start)
+        return [entry[4] for entry in entries[start:end]
+                if cache_keys is None or entry[2] in cache_keys]
+
+    def versions(self, package, cache_keys=None):
+        """Returns [(cache key, version string), ...] sorted by version"""
+        self.__sync()
+        result = []
+        seen = set()
+        for entry in self.entries.get(package, ()):
+            if cache_keys is None or entry[2] in cache_keys:
+                item = (entry[2], entry[4].get('version'))
+                if item not in seen:
+                    seen.add(item)
+                    result.append(item)
+        return result
+
+
+class _PackageMap(object):
+    """Packages grouped by key (like source or pkgid), made of per-repository
+       segments, which are replaced or dropped independently. Lists in merged
+       map keep order in which segments were added"""
+
+    def __init__(self, get_key):
+        self.get_key = get_key
+        self.clear()
+
+    def clear(self):
+        self.active = False
+        self.merged = {}
+        self.order = []
+        # repository -> (metadata, { key: [package, ...] })
+        self.segments = {}
+
+    def set(self, repo, metadata, packages):
+        """Replaces segment of repo with packages loaded into metadata"""
+        segment = {}
+        for pkg in packages:
+            key = self.get_key(pkg)
+            if key not in segment:
+                segment[key] = []
+            segment[key].append(pkg)
+        old = self.segments.get(repo)
+        self.segments[repo] = (metadata, segment)
+        if old is None:
+            # The last segment, just append to merged lists
+            self.order.append(repo)
+            for (key, pkgs) in segment.items():
+                if key not in self.merged:
+                    self.merged[key] = []
+                self.merged[key].extend(pkgs)
+        else:
+            self.__merge(set(old[1]) | set(segment))
+
+    def drop(self, repo):
+        """Removes segment of repo"""
+        old = self.segments.pop(repo, None)
+        if old is not None:
+            self.order.remove(repo)
+            self.__merge(old[1])
+
+    def __merge(self, keys):
+        """Rebuilds merged lists of keys from segments"""
+        for key in keys:
+            pkgs = []
+            for repo in self.order:
+                pkgs.extend(self.segments[repo][1].get(key, ()))
+            if pkgs:
+                self.merged[key] = pkgs
+            else:
+                self.merged.pop(key, None)
 
 
 class AptRepoException(Exception):
@@ -127,43 +833,34 @@ class AptRepoException(Exception):
         return self.msg
 
 
-class AptRepoParagraph(DpkgParagraph):
-    """Like DpkgParagraph, but can return urls to packages and can return
-    correct source package name/version for binaries"""
-    def __init__(self, fname="", base_url=None):
-        DpkgParagraph.__init__(self, fname)
-        self.base_url = base_url
-        self.__files = None
-        self.__urls = None
-        self.__pkgid = None
-        self.__source_version = None
-
-    def __hash__(self):
-        """Make this object hashable"""
-        return hash((self.get("package", None), self.get("version", None)))
+class _AptRepoPackageMixin(object):
+    """Methods, which return urls to packages and correct source package
+    name/version for binaries. Expects mapping interface and _files, _urls,
+    _pkgid, _source_version attributes for caching results"""
+    __slots__ = ()
 
     def set_base_url(self, base_url):
         """Sets base url for this package. Used later to calculate relative paths"""
         self.base_url = base_url
         # After change the base URL, cached URLs are not valid anymore
-        self.__urls = None
+        self._urls = None
 
     def get_files(self):
         """Return list of files in this package. Format similar to .changes files section"""
-        if self.__files:
-            return self.__files
+        if self._files:
+            return self._files
         try:
             files = self['files']
         except KeyError:
             # Binary package ?
             if "filename" in self:
-                self.__files = [(self['md5sum'], self['size'], None, None, self['filename'])]
-                return self.__files
+                self._files = [(self['md5sum'], self['size'], None, None, self['filename'])]
+                return self._files
             else:
                 # Something wrong
                 return []
 
-        self.__files = []
+        self._files = []
         lineregexp = re.compile( 
             "^(?P<f_md5>[0-9a-f]{32})[ \t]+(?P<f_size>\d+)" +
             "(?:[ \t]+(?P<f_section>[-/a-zA-Z0-9]+)[ \t]+(?P<f_priority>[-a-zA-Z0-9]+))?" +
@@ -177,23 +874,23 @@ class AptRepoParagraph(DpkgParagraph):
                 raise AptRepoException("Couldn't parse file entry \"%s\" "
                                        "in Files field of .changes" % (line,))
             else:
-                self.__files.append((match.group("f_md5"), match.group("f_size"),
-                                     match.group("f_section"),
-                                     match.group("f_priority"),
-                                     match.group("f_name")))
-        return self.__files
+                self._files.append((match.group("f_md5"), match.group("f_size"),
+                                    match.group("f_section"),
+                                    match.group("f_priority"),
+                                    match.group("f_name")))
+        return self._files
 
     def get_pkgid(self):
         """Return pkg id for this package. For binaries it's MD5 sum of file, for sources MD5 sum of .dsc"""
-        if self.__pkgid:
-            return self.__pkgid
+        if self._pkgid:
+            return self._pkgid
         try:
             files = self['files']
         except KeyError:
             # Binary package ?
             if "md5sum" in self:
-                self.__pkgid = self['md5sum']
-                return self.__pkgid
+                self._pkgid = self['md5sum']
+                return self._pkgid
             else:
                 # Something wrong
                 raise AptRepoException("Binary package, but MD5Sum not defined")
@@ -212,59 +909,494 @@ class AptRepoParagraph(DpkgParagraph):
                                        "in Files field of .changes" % (line,))
             else:
                 if match.group("f_name").endswith(".dsc"):
-                    self.__pkgid = match.group("f_md5")
-                    return self.__pkgid
+                    self._pkgid = match.group("f_md5")
+                    return self._pkgid
         raise AptRepoException("No DSC file found in source package")
 
     def get_urls(self):
         """Return array of URLs to package files"""
 
-        if self.__urls:
-            return self.__urls
+        if self._urls:
+            return self._urls
         if "filename" in self:
-            self.__urls = [posixpath.join(self.base_url, self['filename'])]
-            return self.__urls
+            self._urls = [posixpath.join(self.base_url, self['filename'])]
+            return self._urls
         if "files" in self:
-            self.__urls = []
+            self._urls = []
             for elems in self.get_files():
-                self.__urls.append(posixpath.join(self.base_url,
+                self._urls.append(posixpath.join(self.base_url,
                                                   self['directory'], elems[4]))
-            return self.__urls
+            return self._urls
 
     def get_source(self):
         """ Return tuple (name, version) for sources of this package """
-        if self.__source_version:
-            return self.__source_version
+        if self._source_version:
+            return self._source_version
         if "files" in self:
             # It's source itself, stupid people
-            self.__source_version = (self['package'], self['version'])
+            self._source_version = (self['package'], self['version'])
         # Ok, it's binary. Let's analize some situations
         elif "source" not in self:
             # source name the same as package
-            self.__source_version = (self['package'], self['version'])
+            self._source_version = (self['package'], self['version'])
         else:
             # Source: tag present. Let's deal with it
             match = re.search(r"(?P<name>[0-9a-zA-Z][-+:.,=~0-9a-zA-Z_]+)"
                               r"(\s+\((?P<ver>(?:[0-9]+:)?[a-zA-Z0-9.+-]+)\))?",
                               self['source'])
             if not match.group("ver"):
-                self.__source_version = (match.group("name"), self['version'])
+                self._source_version = (match.group("name"), self['version'])
             else:
                 # mostly braindead packagers
-                self.__source_version = (match.group("name"), match.group("ver"))
-        if self.__source_version:
-            return self.__source_version
+                self._source_version = (match.group("name"), match.group("ver"))
+        if self._source_version:
+            return self._source_version
         else:
             raise AptRepoException("Something strange. We can't identify source version")
 
 
+class AptRepoParagraph(DpkgParagraph, _AptRepoPackageMixin):
+    """Like DpkgParagraph, but can return urls to packages and can return
+    correct source package name/version for binaries"""
+    def __init__(self, fname="", base_url=None):
+        DpkgParagraph.__init__(self, fname)
+        self.base_url = base_url
+        self._files = None
+        self._urls = None
+        self._pkgid = None
+        self._source_version = None
+
+    def __hash__(self):
+        """Make this object hashable"""
+        return hash((self.get("package", None), self.get("version", None)))
+
+
+def _paragraph_text(keys, values):
+    """Returns paragraph text for decoded fields, which load_text() decodes back"""
+    lines = []
+    for (key, value) in zip(keys, values):
+        if isinstance(value, list):
+            value = "\n ".join(value)
+        lines.append("%s: %s" % (key, value))
+    return "\n".join(lines)
+
+
+# Regular expressions to find single field in paragraph text, by (field, case_sensitive)
+_lazy_field_res = {}
+
+
+class LazyAptRepoParagraph(AptRepoParagraph):
+    """Like AptRepoParagraph, but when loaded with load_text() only keeps
+    text of the paragraph. Field is decoded the first time it's accessed,
+    and the whole paragraph is decoded only when all fields are needed"""
+    def __init__(self, fname="", base_url=None):
+        AptRepoParagraph.__init__(self, fname, base_url)
+        self.__text = None
+        self.__decoded = None
+
+    def __getattr__(self, name):
+        # data and trueFieldCasing are removed while paragraph is not decoded
+        # Looked up via __dict__, __getattr__ is also called on unpickled objects before __init__
+        if name in ('data', 'trueFieldCasing') and \
+                self.__dict__.get('_LazyAptRepoParagraph__text') is not None:
+            self.__materialize()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def __materialize(self):
+        """Decodes whole paragraph text"""
+        text = self.__text
+        self.__text = None
+        self.__decoded = None
+        self.data = {}
+        self.trueFieldCasing = {}
+        OrderedDict.clear(self)
+        AptRepoParagraph.load_text(self, text)
+
+    def __field(self, key):
+        """Returns value of field from paragraph text or raises KeyError"""
+        if self.__decoded is None:
+            self.__decoded = {}
+        elif key in self.__decoded:
+            value = self.__decoded[key]
+            if value is _lazy_field_res:
+                raise KeyError(key)
+            return value
+        if not isinstance(key, types.StringTypes) or \
+                (not self.case_sensitive and key != key.lower()):
+            # Could not be loaded as a key
+            raise KeyError(key)
+        regexp = _lazy_field_res.get((key, self.case_sensitive))
+        if regexp is None:
+            flags = re.M
+            if not self.case_sensitive:
+                flags |= re.I
+            regexp = re.compile(r"^%s:(.*(?:\n .*)*)" % re.escape(key), flags)
+            _lazy_field_res[(key, self.case_sensitive)] = regexp
+        values = regexp.findall(self.__text)
+        if not values:
+            # Remember missing field, this module level dictionary is a safe marker
+            self.__decoded[key] = _lazy_field_res
+            raise KeyError(key)
+        # The last one wins, like with load()
+        value = self.__decoded[key] = decode_value(values[-1])
+        return value
+
+    def load_text(self, text, fields=None):
+        """Keeps paragraph text for decoding on demand"""
+        if self.__text is not None or self.data:
+            self.__materialize()
+            AptRepoParagraph.load_text(self, text, fields)
+            return
+        if fields is not None:
+            if self.case_sensitive:
+                text = "\n".join(["%s:%s" % (key, value) for (key, value) in _field_re.findall(text)
+                                  if key in fields])
+            else:
+                text = "\n".join(["%s:%s" % (key, value) for (key, value) in _field_re.findall(text)
+                                  if key.lower() in fields])
+        self.__text = text
+        del self.data
+        del self.trueFieldCasing
+
+    def load_fields(self, keys, values):
+        """Keeps text of already decoded fields for decoding on demand"""
+        self.load_text(_paragraph_text(keys, values))
+
+    def _undecoded_text(self):
+        """Returns paragraph text kept by load_text() or None if it was decoded"""
+        return self.__text
+
+    def __getitem__(self, key):
+        if self.__text is None:
+            return AptRepoParagraph.__getitem__(self, key)
+        return self.__field(key)
+
+    def __contains__(self, key):
+        if self.__text is None:
+            return AptRepoParagraph.__contains__(self, key)
+        try:
+            self.__field(key)
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def get(self, key, failobj=None):
+        try:
+            return self[key]
+        except KeyError:
+            return failobj
+
+    def __setitem__(self, key, value):
+        if self.__text is not None:
+            self.__materialize()
+        AptRepoParagraph.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self.__text is not None:
+            self.__materialize()
+        AptRepoParagraph.__delitem__(self, key)
+
+    def clear(self):
+        if self.__text is not None:
+            self.__materialize()
+        AptRepoParagraph.clear(self)
+
+    def keys(self):
+        if self.__text is not None:
+            self.__materialize()
+        return AptRepoParagraph.keys(self)
+
+    def items(self):
+        if self.__text is not None:
+            self.__materialize()
+        return AptRepoParagraph.items(self)
+
+    def values(self):
+        if self.__text is not None:
+            self.__materialize()
+        return AptRepoParagraph.values(self)
+
+    def __iter__(self):
+        if self.__text is not None:
+            self.__materialize()
+        return AptRepoParagraph.__iter__(self)
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        if self.__text is not None:
+            self.__materialize()
+        return AptRepoParagraph.itervalues(self)
+
+    def iteritems(self):
+        if self.__text is not None:
+            self.__materialize()
+        return AptRepoParagraph.iteritems(self)
+
+    def __cmp__(self, other):
+        if self.__text is not None:
+            self.__materialize()
+        return AptRepoParagraph.__cmp__(self, other)
+
+
+def _stanza_text(para):
+    """Returns paragraph text, which load_text() decodes back. Text of
+    LazyAptRepoParagraph is returned as it was loaded, without decoding it"""
+    if isinstance(para, LazyAptRepoParagraph):
+        text = para._undecoded_text()
+        if text is not None:
+            return text
+    casing = para.trueFieldCasing
+    return _paragraph_text([casing.get(key, key) for key in para.keys()], para.values())
+
+
+# Field layouts shared by CompactAptRepoParagraph objects:
+# (true cased field names, case_sensitive) -> (field names, {name: index}, {name: true cased name})
+_compact_shapes = {}
+# Real indexes use a few dozens of layouts, but changed fields make new ones. When there
+# are more, the table is emptied: paragraphs keep their layouts, new ones share new copies
+_COMPACT_SHAPES_MAX = 1024
+
+
+def _compact_shape(true_keys, case_sensitive):
+    """Returns shared layout for paragraph with fields true_keys"""
+    shape = _compact_shapes.get((true_keys, case_sensitive))
+    if shape is None:
+        if len(_compact_shapes) >= _COMPACT_SHAPES_MAX:
+            _compact_shapes.clear()
+        true_keys = tuple([intern(key) for key in true_keys])
+        if case_sensitive:
+            keys = true_keys
+        else:
+            keys = tuple([intern(key.lower()) for key in true_keys])
+        index = {}
+        for (idx, key) in enumerate(keys):
+            index[key] = idx
+        shape = (keys, index, dict(zip(keys, true_keys)))
+        _compact_shapes[(true_keys, case_sensitive)] = shape
+    return shape
+
+
+class CompactAptRepoParagraph(_AptRepoPackageMixin):
+    """Memory efficient read-mostly variant of AptRepoParagraph. Values are
+    kept in a tuple, while interned field names and their positions are shared
+    by all paragraphs with the same set of fields. Offers the same mapping
+    interface, but changing fields is slow. fname is name of file or file
+    object paragraph is loaded from. Unlike DpkgParagraph, it has no filename
+    attribute, so store() needs file to write to"""
+    __slots__ = ('base_url', 'case_sensitive', '_shape', '_values',
+                 '_files', '_urls', '_pkgid', '_source_version')
+
+    def __init__(self, fname="", base_url=None):
+        self.base_url = base_url
+        self.case_sensitive = False
+        self._shape = _compact_shape((), False)
+        self._values = ()
+        self._files = None
+        self._urls = None
+        self._pkgid = None
+        self._source_version = None
+        if isinstance(fname, types.StringType) and fname:
+            fhdl = open(fname, "r")
+            try:
+                self.load(fhdl)
+            finally:
+                fhdl.close()
+        elif fname:
+            self.load(fname)
+
+    def __hash__(self):
+        """Make this object hashable"""
+        return hash((self.get("package", None), self.get("version", None)))
+
+    def __getstate__(self):
+        return (self.base_url, self.case_sensitive,
+                tuple([self._shape[2][key] for key in self._shape[0]]), self._values)
+
+    def __setstate__(self, state):
+        (self.base_url, self.case_sensitive, true_keys, self._values) = state
+        self._shape = _compact_shape(true_keys, self.case_sensitive)
+        self._files = self._urls = self._pkgid = self._source_version = None
+
+    def setcase_sensitive(self, value):
+        self.case_sensitive = value
+
+    def __set_fields(self, true_keys, values):
+        """Sets paragraph content from list of true cased field names and values"""
+        shape = _compact_shape(tuple(true_keys), self.case_sensitive)
+        if len(shape[1]) != len(true_keys):
+            # Duplicate fields. First position and last value wins, like with DpkgParagraph
+            self._shape = _compact_shape((), self.case_sensitive)
+            self._values = ()
+            for (key, value) in zip(true_keys, values):
+                self.__set(key, value)
+            return
+        self._shape = shape
+        self._values = tuple(values)
+
+    def __set(self, true_key, value):
+        """Sets field, remembering its true cased name"""
+        key = true_key
+        if not self.case_sensitive:
+            key = true_key.lower()
+        (keys, index, casing) = self._shape
+        if key in index:
+            values = list(self._values)
+            values[index[key]] = value
+            self._values = tuple(values)
+        else:
+            self._shape = _compact_shape(tuple([casing[fld] for fld in keys]) + (true_key,),
+                                         self.case_sensitive)
+            self._values = self._values + (value,)
+
+    def load_text(self, text, fields=None):
+        """Fill paragraph from its text, see DpkgParagraph.load_text()"""
+        true_keys = []
+        values = []
+        for (key, value) in _field_re.findall(text):
+            if fields is not None:
+                if self.case_sensitive:
+                    if key not in fields:
+                        continue
+                elif key.lower() not in fields:
+                    continue
+            true_keys.append(key)
+            values.append(decode_value(value))
+        if self._values:
+            for (key, value) in zip(true_keys, values):
+                self.__set(key, value)
+        else:
+            self.__set_fields(true_keys, values)
+
+    def load_fields(self, keys, values):
+        """Fill paragraph from decoded fields, see DpkgParagraph.load_fields()"""
+        if self._values:
+            for (key, value) in zip(keys, values):
+                self.__set(key, value)
+        else:
+            self.__set_fields(list(keys), list(values))
+
+    def load(self, fhdl):
+        """Read paragraph data from a file object, see DpkgParagraph.load()"""
+        para = DpkgParagraph()
+        para.setcase_sensitive(self.case_sensitive)
+        para.load(fhdl)
+        for (key, value) in para.items():
+            self.__set(para.trueFieldCasing.get(key, key), value)
+
+    def store(self, fname):
+        """Write paragraph to file name or file object, see DpkgDatalist.store()"""
+        if not isinstance(fname, types.StringType):
+            self._store(fname)
+            return
+        fhdl = SafeWriteFile(fname + ".new", fname, "w")
+        try:
+            self._store(fhdl)
+        finally:
+            fhdl.close()
+
+    def _store(self, fhdl):
+        """Write our paragraph data to a file object"""
+        casing = self._shape[2]
+        for (key, value) in zip(self._shape[0], self._values):
+            fhdl.write(str(casing[key]) + ":")
+            DpkgParagraph._store_field(fhdl, value)
+
+    def __getitem__(self, key):
+        return self._values[self._shape[1][key]]
+
+    def __setitem__(self, key, value):
+        self.__set(key, value)
+
+    def __delitem__(self, key):
+        (keys, index, casing) = self._shape
+        idx = index[key]
+        self._shape = _compact_shape(tuple([casing[fld] for fld in keys if fld != key]),
+                                     self.case_sensitive)
+        self._values = self._values[:idx] + self._values[idx + 1:]
+
+    def __contains__(self, key):
+        return key in self._shape[1]
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._shape[0])
+
+    def __eq__(self, other):
+        try:
+            return self.items() == list(other.items())
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, failobj=None):
+        idx = self._shape[1].get(key)
+        if idx is None:
+            return failobj
+        return self._values[idx]
+
+    def keys(self):
+        return list(self._shape[0])
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._shape[0], self._values)
+
+    def iterkeys(self):
+        return iter(self._shape[0])
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return iter(zip(self._shape[0], self._values))
+
+    def update(self, dictionary):
+        for (key, value) in dictionary.items():
+            self.__set(key, value)
+
+    def clear(self):
+        self._shape = _compact_shape((), self.case_sensitive)
+        self._values = ()
+
+    def copy(self):
+        para = CompactAptRepoParagraph(base_url=self.base_url)
+        para.__setstate__(self.__getstate__())
+        return para
+
+    def get_true_field_casing(self):
+        """Mapping of field names to their original case, like DpkgParagraph.trueFieldCasing"""
+        return self._shape[2]
+
+    trueFieldCasing = property(get_true_field_casing)
+
+
 class AptRepoMetadataBase(DpkgOrderedDatalist):
-    def __init__(self, base_url=None, case_sensitive=0, allowed_arches=None):
+    def __init__(self, base_url=None, case_sensitive=0, allowed_arches=None,
+                 paragraph_class=AptRepoParagraph):
         DpkgOrderedDatalist.__init__(self)
         self.key = "package"
         self.case_sensitive = case_sensitive
         self.base_url = base_url
         self.allowed_arches = allowed_arches
+        self.paragraph_class = paragraph_class
 
     def setkey(self, key):
         self.key = key
@@ -272,31 +1404,42 @@ class AptRepoMetadataBase(DpkgOrderedDatalist):
     def set_case_sensitive(self, value):
         self.case_sensitive = value
 
-    def __load_one(self, in_file, base_url):
+    def __load_one(self, text, base_url, fields):
         """Load meta-information for one package"""
-        para = AptRepoParagraph(base_url=base_url)
+        para = self.paragraph_class(base_url=base_url)
         para.setcase_sensitive(self.case_sensitive)
-        para.load(in_file)
+        para.load_text(text, fields)
         return para
 
-    def load(self, inf, base_url=None):
-        """Load packages meta-information to internal data structures"""
+    def load(self, inf, base_url=None, fields=None):
+        """Load packages meta-information to internal data structures.
+           If fields is given, only these fields are kept in packages. Key field
+           and architecture are always kept"""
         if base_url is None:
             base_url = self.base_url
-        while 1:
-            para = self.__load_one(inf, base_url)
-            if not para: 
-                break
-            
-            if 'architecture' in para and \
-                    para['architecture'] not in ["all", "any"] and \
-                    self.allowed_arches and self.allowed_arches != ["all"] and \
-                    not [arch for arch in para['architecture'].split() if
-                         arch in self.allowed_arches]:
+        if fields is not None:
+            fields = frozenset(fields) | frozenset([self.key, 'architecture'])
+        arches = self.allowed_arches
+        if arches == ["all"]:
+            arches = None
+        for text in split_paragraphs(inf):
+            para = self.__load_one(text, base_url, fields)
+            arch = para.get('architecture')
+            if arches and arch is not None and arch not in ("all", "any") and \
+                    not [name for name in arch.split() if name in arches]:
                 continue
-            if para[self.key] not in self:
-                self[para[self.key]] = []
-            self[para[self.key]].append(para)
+            name = para[self.key]
+            pkgs = self.get(name)
+            if pkgs is None:
+                self[name] = pkgs = []
+            pkgs.append(para)
+
+    def extend(self, other):
+        """Appends packages from other AptRepoMetadataBase, keeping their order"""
+        for key in other.keys():
+            if key not in self:
+                self[key] = []
+            self[key].extend(other[key])
 
     def _store(self, ofl):
         """Write our control data to a file object"""
@@ -306,74 +1449,446 @@ class AptRepoMetadataBase(DpkgOrderedDatalist):
                 ofl.write("\n")
 
 
+# Snapshot file starts with magic, format version, number of strings and number of
+# record words. Then lengths of strings, strings themselves and record words follow.
+# Numbers are little endian uint32
+_SNAPSHOT_MAGIC = "MDEBSNAP"
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_HEADER = "<8sIII"
+# Id of missing string
+_SNAPSHOT_NONE = 0xFFFFFFFF
+_UINT32 = [code for code in "IL" if array.array(code).itemsize == 4][0]
+
+
+class _SnapshotWriter(object):
+    """Encodes packages to string table and uint32 record words"""
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.shapes = []
+        self.shape_ids = {}
+        self.lists = []
+        # Lists are referenced as -1 - list number, until it's known where they start
+        self.words = []
+        self.head = 0
+
+    def end_head(self):
+        """Marks end of words, which are written before shapes and lists"""
+        self.head = len(self.words)
+
+    def string(self, value):
+        """Returns id of string value"""
+        if value is None:
+            return _SNAPSHOT_NONE
+        value = str(value)
+        sid = self.string_ids.get(value)
+        if sid is None:
+            sid = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return sid
+
+    def add_strings(self, values):
+        """Adds counted list of strings to record words, None is stored as missing list"""
+        if values is None:
+            self.words.append(_SNAPSHOT_NONE)
+            return
+        self.words.append(len(values))
+        self.words.extend([self.string(value) for value in values])
+
+    def add_package(self, para):
+        """Adds shape and value references of paragraph. Paragraph, which only
+           keeps its text, is added as text without decoding it"""
+        if isinstance(para, LazyAptRepoParagraph) and para._undecoded_text() is not None:
+            self.words.append(self.string(para.base_url))
+            self.words.append(_SNAPSHOT_NONE)
+            self.words.append(self.string(para._undecoded_text()))
+            return
+        casing = para.trueFieldCasing
+        keys = []
+        values = []
+        for (key, value) in para.items():
+            keys.append(self.string(casing.get(key, key)))
+            if isinstance(value, list):
+                # Lists are never shared, so each one can become a new list on load
+                values.append(-1 - len(self.lists))
+                self.lists.append([self.string(item) for item in value])
+            else:
+                values.append(self.string(value))
+        keys = tuple(keys)
+        shape = self.shape_ids.get(keys)
+        if shape is None:
+            shape = self.shape_ids[keys] = len(self.shapes)
+            self.shapes.append(keys)
+        self.words.append(self.string(para.base_url))
+        self.words.append(shape)
+        self.words.extend(values)
+
+    def write(self, fhdl):
+        """Writes string table and words, with shapes and lists after end_head() mark"""
+        words = array.array(_UINT32, self.words[:self.head])
+        words.append(len(self.shapes))
+        for shape in self.shapes:
+            words.append(len(shape))
+            words.extend(shape)
+        words.append(len(self.lists))
+        for items in self.lists:
+            words.append(len(items))
+            words.extend(items)
+        # Lists follow strings in object table
+        nstrings = len(self.strings)
+        words.extend([(word < 0 and [nstrings - 1 - word] or [word])[0]
+                      for word in self.words[self.head:]])
+        lengths = array.array(_UINT32, [len(value) for value in self.strings])
+        if sys.byteorder == "big":
+            lengths.byteswap()
+            words.byteswap()
+        fhdl.write(struct.pack(_SNAPSHOT_HEADER, _SNAPSHOT_MAGIC, _SNAPSHOT_VERSION,
+                               len(self.strings), len(words)))
+        fhdl.write(lengths.tostring())
+        fhdl.write("".join(self.strings))
+        fhdl.write(words.tostring())
+
+
+class _SnapshotReader(object):
+    """Decodes snapshot written by _SnapshotWriter"""
+
+    def __init__(self, data):
+        (magic, version, nstrings, nwords) = struct.unpack_from(_SNAPSHOT_HEADER, data)
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise ValueError("Not a snapshot of version %d" % _SNAPSHOT_VERSION)
+        pos = struct.calcsize(_SNAPSHOT_HEADER)
+        lengths = array.array(_UINT32)
+        lengths.fromstring(data[pos:pos + 4 * nstrings])
+        pos += 4 * nstrings
+        if sys.byteorder == "big":
+            lengths.byteswap()
+        self.strings = strings = []
+        for length in lengths:
+            strings.append(data[pos:pos + length])
+            pos += length
+        self.words = array.array(_UINT32)
+        self.words.fromstring(data[pos:pos + 4 * nwords])
+        if sys.byteorder == "big":
+            self.words.byteswap()
+        if len(self.words) != nwords:
+            raise ValueError("Snapshot is truncated")
+        self.pos = 0
+
+    def word(self):
+        """Returns next record word"""
+        self.pos += 1
+        return self.words[self.pos - 1]
+
+    def string(self):
+        """Returns string referenced by next record word"""
+        sid = self.word()
+        if sid == _SNAPSHOT_NONE:
+            return None
+        return self.strings[sid]
+
+    def __take(self, count):
+        """Returns next count record words. Raises IndexError if there are not so many"""
+        if self.pos + count > len(self.words):
+            raise IndexError("Snapshot record out of range")
+        self.pos += count
+        return self.words[self.pos - count:self.pos]
+
+    def get_strings(self):
+        """Returns counted list of strings or None"""
+        count = self.word()
+        if count == _SNAPSHOT_NONE:
+            return None
+        return [self.strings[sid] for sid in self.__take(count)]
+
+    def get_numbers(self):
+        """Returns counted list of numbers"""
+        return self.__take(self.word())
+
+    def read_tables(self):
+        """Reads shapes and lists, which precede packages"""
+        self.shapes = []
+        for idx in xrange(self.word()):
+            self.shapes.append(tuple([intern(key) for key in self.get_strings()]))
+        # Values reference strings and lists following them
+        self.objects = self.strings + [self.get_strings() for idx in xrange(self.word())]
+
+    def get_package(self, paragraph_class, case_sensitive):
+        """Returns next package as paragraph_class object"""
+        base_url = self.string()
+        shape = self.word()
+        para = paragraph_class(base_url=base_url)
+        para.setcase_sensitive(case_sensitive)
+        if shape == _SNAPSHOT_NONE:
+            # Package stored as its text
+            text = self.string()
+            if text is None:
+                raise ValueError("Package without text")
+            para.load_text(text)
+            return para
+        keys = self.shapes[shape]
+        refs = self.__take(len(keys))
+        para.load_fields(keys, map(self.objects.__getitem__, refs))
+        return para
+
+
 class AptRepoClient(LoggableObject):
     """ Client class to access Apt repositories. """
 
-    def __init__(self, repos=None, arch=None):
-        """Base class to access APT debian packages meta-data"""
+    def __init__(self, repos=None, arch=None, workers=1, cache_dir=None,
+                 paragraph_class=AptRepoParagraph):
+        """Base class to access APT debian packages meta-data.
+           workers -- number of repositories fetched and parsed concurrently
+           cache_dir -- if set, fetched indexes are kept there and only revalidated later
+           paragraph_class -- class of package objects, e.g. LazyAptRepoParagraph"""
         if arch is not None:
             self._arch = arch
         else:
             self._arch = ["all"]
+        self._workers = max(1, workers)
+        self._paragraph_class = paragraph_class
+        self._fields = None
+        self._index_hashes = {}
+        # Release directories known to have neither InRelease nor Release file
+        self._missing_releases = set()
+        self._cache = None
+        if cache_dir:
+            self._cache = _MetadataCache(cache_dir)
         self.sources = {}
         self.binaries = {}
+        self.__sources_index = _VersionIndex()
+        self.__binaries_index = _VersionIndex()
         self.source_to_binaries_map = {}
         self.pkgid_map = {}
+        self.__source_map = _PackageMap(lambda pkg: pkg.get_source())
+        self.__pkgid_map = _PackageMap(lambda pkg: pkg.get_pkgid())
         self._repos = []
         if repos:
             self.__make_repos(repos)
 
-    def load_repos(self, repoline=None, ignore_errors=True, clear=True):
-        """Loads repositories into internal data structures. Replaces previous content if clear = True (default)"""
+    def load_repos(self, repoline=None, ignore_errors=True, clear=True, fields=None):
+        """Loads repositories into internal data structures. Replaces previous content if clear = True (default).
+           Otherwise repositories loaded before are loaded again only if their indexes changed.
+           If fields is given, packages only keep fields from it (and package name and architecture).
+           Note that get_pkgid() and get_source() need md5sum, files, source and version fields"""
         if clear:
             self.sources = {}
             self.binaries = {}
-            self.source_to_binaries_map = {}
-            self.pkgid_map = {}
+            self.__sources_index.clear()
+            self.__binaries_index.clear()
+            self._index_hashes = {}
         if repoline:
             self.__make_repos(repoline, clear)    
 
+        self._fields = fields
         self.__load_repos(self._repos, ignore_errors)
+        self.__sources_index.repo_keys.invalidate()
+        self.__binaries_index.repo_keys.invalidate()
 
     # Alias for load_repos(). Just to make commandline apt-get users happy
     update = load_repos
 
+    def refresh(self, ignore_errors=True):
+        """Reloads only repositories, which indexes changed since they were loaded.
+           Changes are detected by checksums from Release files, stamps of local files or
+           HTTP validators (if cache_dir is set, otherwise such indexes are always reloaded).
+           New content of each (base_url, distribution, section) key replaces the old one
+           at once, when all its indexes are loaded. Other keys are left untouched.
+           Returns list of keys which were replaced"""
+        return [cache_key for (pkgcache, cache_key) in
+                self.__load_repos(self._repos, ignore_errors, True)]
+
     def make_source_to_binaries_map(self):
         """Makes dictionary 'source_to_binaries' out of available packages"""
         if not self.binaries:
             # If no binary packages, try to load them
             self.load_repos()
-        if not self.source_to_binaries_map:
-            # Map not present and needs to be generated
-            for repo in self.binaries:
-                for pkgname in self.binaries[repo].keys():
-                    for pkg in self.binaries[repo][pkgname]:
-                        src = pkg.get_source()
-                        if src not in self.source_to_binaries_map:
-                            self.source_to_binaries_map[src] = []
-                        self.source_to_binaries_map[src].append(pkg)
+        if not self.__source_map.active and not self.source_to_binaries_map:
+            # Map not present and needs to be generated. It's kept up to date from now on
+            self.__update_map(self.__source_map, [self.binaries])
+            self.source_to_binaries_map = self.__source_map.merged
 
     def make_pkgid_map(self):
         """Makes dictionary 'pkgid_map' out of available source/binary packages"""
         if not self.binaries and not self.sources:
             # If no packages, try to load them
             self.load_repos()
-        if not self.pkgid_map:
-            # Map not present and needs to be generated
-            for repo in self.sources:
-                for pkgname in self.sources[repo].keys():
-                    for pkg in self.sources[repo][pkgname]:
-                        pkgid = pkg.get_pkgid()
-                        if pkgid not in self.pkgid_map:
-                            self.pkgid_map[pkgid] = []
-                        self.pkgid_map[pkgid].append(pkg)
-            for repo in self.binaries:
-                for pkgname in self.binaries[repo].keys():
-                    for pkg in self.binaries[repo][pkgname]:
-                        pkgid = pkg.get_pkgid()
-                        if pkgid not in self.pkgid_map:
-                            self.pkgid_map[pkgid] = []
-                        self.pkgid_map[pkgid].append(pkg)
+        if not self.__pkgid_map.active and not self.pkgid_map:
+            # Map not present and needs to be generated. It's kept up to date from now on
+            self.__update_map(self.__pkgid_map, [self.sources, self.binaries])
+            self.pkgid_map = self.__pkgid_map.merged
+
+    def __refresh_maps(self, loaded):
+        """Updates maps, which were made already, after repositories in loaded
+           [(pkgcache, cache_key), ...] were loaded. Other maps are dropped and
+           made on demand, like maps which can't be updated because of broken packages"""
+        try:
+            if self.__source_map.active:
+                self.__update_map(self.__source_map, [self.binaries], loaded)
+        except (AptRepoException, KeyError):
+            self.__source_map.clear()
+        if not self.__source_map.active:
+            self.source_to_binaries_map = {}
+        try:
+            if self.__pkgid_map.active:
+                self.__update_map(self.__pkgid_map, [self.sources, self.binaries], loaded)
+        except (AptRepoException, KeyError):
+            self.__pkgid_map.clear()
+        if not self.__pkgid_map.active:
+            self.pkgid_map = {}
+
+    def __update_map(self, pkgmap, pkgcaches, loaded=()):
+        """Brings segments of pkgmap up to date with repositories of pkgcaches.
+           Segments of repositories in loaded [(pkgcache, cache_key), ...] are rebuilt,
+           other ones only if their metadata was replaced"""
+        repos = []
+        for pkgcache in pkgcaches:
+            kind = (pkgcache is self.binaries and ["binaries"] or ["sources"])[0]
+            for cache_key in self._repo_order(pkgcache):
+                repos.append(((kind, cache_key), pkgcache, cache_key))
+        current = set([repo[0] for repo in repos])
+        for repo in pkgmap.order[:]:
+            if repo not in current:
+                pkgmap.drop(repo)
+        loaded = set([(id(pkgcache), cache_key) for (pkgcache, cache_key) in loaded])
+        for (repo, pkgcache, cache_key) in repos:
+            segment = pkgmap.segments.get(repo)
+            if segment is None or segment[0] is not pkgcache[cache_key] or \
+                    (id(pkgcache), cache_key) in loaded:
+                pkgmap.set(repo, pkgcache[cache_key], self._repo_packages(pkgcache, cache_key))
+        pkgmap.active = True
+
+    def save_snapshot(self, path):
+        """Stores loaded packages, source_to_binaries_map and pkgid_map to file at path.
+           See load_snapshot()"""
+        writer = _SnapshotWriter()
+        writer.add_strings(self._repos)
+        writer.add_strings(self._arch)
+        writer.add_strings(self._fields is not None and sorted(self._fields) or None)
+        writer.words.append(len(self._index_hashes))
+        for (url, token) in self._index_hashes.items():
+            writer.words.append(writer.string(url))
+            writer.words.append(writer.string(token))
+        writer.end_head()
+
+        numbers = {}
+        for pkgcache in (self.sources, self.binaries):
+            writer.words.append(len(pkgcache))
+            for (cache_key, metadata) in pkgcache.items():
+                writer.words.extend([writer.string(item) for item in cache_key])
+                writer.words.append(writer.string(metadata.base_url))
+                writer.words.append(metadata.case_sensitive and 1 or 0)
+                writer.words.append(sum([len(pkgs) for pkgs in metadata.values()]))
+                for name in metadata.keys():
+                    for pkg in metadata[name]:
+                        numbers[id(pkg)] = len(numbers)
+                        writer.add_package(pkg)
+        for (pkgmap, key_length) in ((self.source_to_binaries_map, 2), (self.pkgid_map, 1)):
+            writer.words.append(len(pkgmap))
+            for (key, pkgs) in pkgmap.items():
+                if key_length == 1:
+                    key = (key,)
+                writer.words.extend([writer.string(item) for item in key])
+                pkgs = [numbers[id(pkg)] for pkg in pkgs if id(pkg) in numbers]
+                writer.words.append(len(pkgs))
+                writer.words.extend(pkgs)
+
+        fhdl = SafeWriteFile(path + ".new", path, "wb")
+        try:
+            writer.write(fhdl)
+        except:
+            fhdl.abort()
+            raise
+        fhdl.close()
+
+    def load_snapshot(self, path):
+        """Replaces loaded data with snapshot made by save_snapshot(). Returns False and keeps
+           current data if there is no usable snapshot at path: it's missing, of other format,
+           made for other repositories or architectures, or some index changed since then.
+           Snapshots of plain HTTP repositories without Release file are never up to date"""
+        try:
+            fhdl = open(path, "rb")
+            try:
+                data = fhdl.read()
+            finally:
+                fhdl.close()
+            reader = _SnapshotReader(data)
+            del data
+        except (IOError, ValueError, struct.error), err:
+            self._logger.debug("Unable to read snapshot %s: %s" % (path, err))
+            return False
+        try:
+            (repos, arch, fields) = (reader.get_strings(), reader.get_strings(),
+                                     reader.get_strings())
+            tokens = {}
+            for idx in xrange(reader.word()):
+                url = reader.string()
+                tokens[url] = reader.string()
+        except IndexError:
+            self._logger.debug("Snapshot %s is damaged" % path)
+            return False
+        if repos != self._repos or arch != self._arch:
+            self._logger.debug("Snapshot %s is for other repositories" % path)
+            return False
+        plan = self.__plan_indexes(self._repos)
+        for (base_url, url, dest_dict, cache_key, target) in plan:
+            token = _index_token(url, target)
+            if token is None or tokens.get(url) != token:
+                self._logger.debug("Snapshot %s is out of date: %s" % (path, url))
+                return False
+
+        try:
+            (pkgcaches, pkgmaps) = self.__read_snapshot_packages(reader)
+        except (IndexError, KeyError, TypeError, ValueError):
+            # References out of tables or packages without name field
+            self._logger.debug("Snapshot %s is damaged" % path)
+            return False
+        (self.sources, self.binaries) = pkgcaches
+        (self.source_to_binaries_map, self.pkgid_map) = pkgmaps
+        # Maps from snapshot are used until the next load_repos()
+        self.__source_map.clear()
+        self.__pkgid_map.clear()
+        self._index_hashes = tokens
+        self._fields = fields
+        for (pkgcache, index) in ((self.sources, self.__sources_index),
+                                  (self.binaries, self.__binaries_index)):
+            index.clear()
+            index.defer(pkgcache, [entry[3] for entry in plan if entry[3] in pkgcache],
+                        self._logger)
+        return True
+
+    def __read_snapshot_packages(self, reader):
+        """Returns ([sources, binaries], [source_to_binaries_map, pkgid_map]) read from snapshot"""
+        reader.read_tables()
+        pkgcaches = []
+        packages = []
+        for kind in ("sources", "binaries"):
+            pkgcache = {}
+            for idx in xrange(reader.word()):
+                cache_key = (reader.string(), reader.string(), reader.string())
+                metadata = AptRepoMetadataBase(reader.string(), reader.word(),
+                                               allowed_arches=self._arch,
+                                               paragraph_class=self._paragraph_class)
+                for pkgidx in xrange(reader.word()):
+                    para = reader.get_package(self._paragraph_class, metadata.case_sensitive)
+                    packages.append(para)
+                    name = para[metadata.key]
+                    if name not in metadata:
+                        metadata[name] = []
+                    metadata[name].append(para)
+                pkgcache[cache_key] = metadata
+            pkgcaches.append(pkgcache)
+        pkgmaps = []
+        for key_length in (2, 1):
+            pkgmap = {}
+            for idx in xrange(reader.word()):
+                if key_length == 1:
+                    key = reader.string()
+                else:
+                    key = (reader.string(), reader.string())
+                pkgmap[key] = [packages[number] for number in reader.get_numbers()]
+            pkgmaps.append(pkgmap)
+        return (pkgcaches, pkgmaps)
 
     def get_available_source_repos(self):
         """Lists known source repositories. Format is [ (base_url, distribution, section), ... ]"""
@@ -385,11 +1900,11 @@ class AptRepoClient(LoggableObject):
 
     def get_best_binary_version(self, package, base_url=None):
         """Return exact repository and best available version for binary package"""
-        return self.__get_best_version(package, base_url, self.binaries)
+        return self.__get_best_version(package, base_url, self.binaries, self.__binaries_index)
 
     def get_best_source_version(self, package, base_url=None):
         """Return exact repository and best available version for source package"""
-        return self.__get_best_version(package, base_url, self.sources)
+        return self.__get_best_version(package, base_url, self.sources, self.__sources_index)
 
     def get_binary_name_version(self, package, version=None, base_url=None):
         """ 
@@ -400,10 +1915,10 @@ class AptRepoClient(LoggableObject):
             return self.__get_pkgs_by_name_version(package,
                                                    self.get_best_binary_version(package,
                                                                                 base_url)[1],
-                                                   base_url, self.binaries)
+                                                   base_url, self.binaries, self.__binaries_index)
         else:
             return self.__get_pkgs_by_name_version(package, version, base_url,
-                                                   self.binaries)
+                                                   self.binaries, self.__binaries_index)
 
     def get_source_name_version(self, package, version=None, base_url=None):
         """ 
@@ -414,99 +1929,115 @@ class AptRepoClient(LoggableObject):
             return self.__get_pkgs_by_name_version(package,
                                                    self.get_best_source_version(package,
                                                                                 base_url)[1],
-                                                   base_url, self.sources)
+                                                   base_url, self.sources, self.__sources_index)
         else:
-            return self.__get_pkgs_by_name_version(package, version, base_url, self.sources)
+            return self.__get_pkgs_by_name_version(package, version, base_url, self.sources,
+                                                   self.__sources_index)
+
+    def get_best_binary_versions(self, packages, base_url=None):
+        """Like get_best_binary_version() for many packages in one pass.
+           Returns { package: (base_url, version), ... }"""
+        return self.__get_best_versions(packages, base_url, self.binaries, self.__binaries_index)
+
+    def get_best_source_versions(self, packages, base_url=None):
+        """Like get_best_source_version() for many packages in one pass.
+           Returns { package: (base_url, version), ... }"""
+        return self.__get_best_versions(packages, base_url, self.sources, self.__sources_index)
+
+    def get_binary_name_versions(self, packages, base_url=None):
+        """Like get_binary_name_version() for many packages in one pass.
+           Items of packages are names (for the best version) or (name, version) tuples.
+           Returns { item: [package, ...], ... }"""
+        return self.__get_pkgs_by_name_versions(packages, base_url, self.binaries,
+                                                self.__binaries_index)
+
+    def get_source_name_versions(self, packages, base_url=None):
+        """Like get_source_name_version() for many packages in one pass.
+           Items of packages are names (for the best version) or (name, version) tuples.
+           Returns { item: [package, ...], ... }"""
+        return self.__get_pkgs_by_name_versions(packages, base_url, self.sources,
+                                                self.__sources_index)
 
     def get_available_binary_versions(self, package, base_url=None):
-        return _get_available_versions(package, base_url, self.binaries)
+        """Returns [(repository, version), ...] for package, sorted by version"""
+        index = self.__binaries_index
+        return index.versions(package, index.repo_keys.resolve(base_url, self.binaries))
 
     def get_available_source_versions(self, package, base_url=None):
-        return _get_available_versions(package, base_url, self.sources)
+        """Returns [(repository, version), ...] for package, sorted by version"""
+        index = self.__sources_index
+        return index.versions(package, index.repo_keys.resolve(base_url, self.sources))
 
     def get_available_sources(self, base_url=None):
-        return _get_available_pkgs(base_url, self.sources)
+        cache_keys = self.__sources_index.repo_keys.resolve(base_url, self.sources)
+        return _get_available_pkgs(cache_keys, self.sources)
 
     def get_available_binaries(self, base_url=None):
-        return _get_available_pkgs(base_url, self.binaries)
+        cache_keys = self.__binaries_index.repo_keys.resolve(base_url, self.binaries)
+        return _get_available_pkgs(cache_keys, self.binaries)
 
-    def __get_best_version(self, package, base_url, pkgcache):
+    def __get_best_version(self, package, base_url, pkgcache, index):
         """
             Should return touple (base_url,package_version) with the best version found in cache.
             If base_url is not specified, all repositories will be checked
         """
-        cache_keys = _filter_base_urls(base_url, pkgcache)
-
-        # Go trough all base_url keys
-        best = None
-        best_base_url = None
-        for cache_key in cache_keys:
-            cache = pkgcache.get(cache_key, {})
-            if package in cache:
-                match = self.__pkg_best_match(cache[package])
-                if match:
-                    if not best:
-                        best = match
-                        # We're safe. this should not be assigned
-                        best_base_url = cache_key
-                    else:
-                        if DpkgVersion(match) > DpkgVersion(best):
-                            best = match
-                            best_base_url = cache_key
+        (best_base_url, best) = index.best(package, index.repo_keys.resolve(base_url, pkgcache))
         if best is None:
             return (None, None)
         else:
             return best_base_url, str(best)
 
-    def __get_pkgs_by_name_version(self, package, version, base_url, pkgcache):
+    def __get_pkgs_by_name_version(self, package, version, base_url, pkgcache, index):
         """
            Should return array of packages, matched by name/version, from one or more base_urls
         """
-        cache_keys = _filter_base_urls(base_url, pkgcache)
-        
-        if version is not None and not isinstance(version, DpkgVersion):
+        if version is None:
+            return []
+        if not isinstance(version, DpkgVersion):
             try:
-                version = DpkgVersion(version)
+                version = cached_version(version)
             except VersionError:
                 # Bad input data. Return empty set
                 self._logger.info("BadVersion: %s" % version)
                 return []
-
-        # Go trough all base_url keys
-        pkgs = []
-        for cache_key in cache_keys:
-            cache = pkgcache.get(cache_key, {})
-            if package in cache:
-                for pkg in cache[package]:
-                    try:
-                        if version is not None and DpkgVersion(pkg['version']) == version:
-                            pkgs.append(pkg)
-                    except VersionError:
-                        # Package with bad version in repository. Let's skip it
-                        self._logger.info("BadVersion: %s %s" % (package, pkg['version']))
-                        continue
-        return pkgs
-
-    def __pkg_best_match(self, cache):
-        """ Looks for best version available """
-        if len(cache) == 0:
-            # WTF!?
-            return None
-        try:
-            best = DpkgVersion(cache[0]['version'])
-        except VersionError:
-            self._logger.info("BadVersion: %s %s" % (cache[0]['package'], cache[0]['version']))
-            return None
-        if len(cache) > 1:
-            for pkg in cache:
+        return index.matching(package, version, index.repo_keys.resolve(base_url, pkgcache))
+
+    def __get_best_versions(self, packages, base_url, pkgcache, index):
+        """Returns { package: (base_url, version), ... } for all packages"""
+        cache_keys = index.repo_keys.resolve(base_url, pkgcache)
+        result = {}
+        for package in packages:
+            (best_base_url, best) = index.best(package, cache_keys)
+            if best is None:
+                result[package] = (None, None)
+            else:
+                result[package] = (best_base_url, str(best))
+        return result
+
+    def __get_pkgs_by_name_versions(self, packages, base_url, pkgcache, index):
+        """Returns { name or (name, version): [package, ...], ... } for all packages"""
+        cache_keys = index.repo_keys.resolve(base_url, pkgcache)
+        result = {}
+        for item in packages:
+            if isinstance(item, types.TupleType):
+                (package, version) = item
+            else:
+                (package, version) = (item, None)
+            if version is None:
+                version = index.best(package, cache_keys)[1]
+                if version is None:
+                    result[item] = []
+                    continue
+            elif not isinstance(version, DpkgVersion):
                 try:
-                    pkg_ver = DpkgVersion(pkg['version'])
-                    if pkg_ver > best:
-                        best = pkg_ver
+                    version = cached_version(version)
                 except VersionError:
-                    self._logger.info("BadVersion: %s %s" % (pkg['package'], pkg['version']))
+                    # Bad input data. Return empty set
+                    self._logger.info("BadVersion: %s" % version)
+                    result[item] = []
                     continue
-        return best 
+            result[item] = index.matching(package, version, cache_keys)
+        return result
 
     def __make_repos(self, repos=None, clear=True):
         """ Update available repositories array """
@@ -532,9 +2063,14 @@ class AptRepoClient(LoggableObject):
         elif isinstance(repos, types.StringType):
             self._repos += [repo for repo in filter_repolines(repos.splitlines()) if repo not in self._repos]
 
-    def __load_repos(self, repos, ignore_errors=True):
-        """Should load data from remote repository. Format the same as sources.list"""
-        to_load = []
+    def __plan_indexes(self, repos):
+        """Returns [(base_url, url, dest_dict, cache_key, target), ...] for indexes of repos.
+           target is (url, compression, checksum, pdiff) of index picked from Release file,
+           where pdiff is (url, checksum, index checksum) of diff index or None.
+           target is None if there is no Release file or index is not listed in it,
+           then index is probed for the same way as without Release file"""
+        plan = []
+        releases = {}
         for repo in repos:
             (base_url, url_srcs, url_bins) = self.__make_urls(repo)
             if url_srcs:
@@ -548,28 +2084,282 @@ class AptRepoClient(LoggableObject):
                 raise AptRepoException("WTF?!")
 
             for (url, distro, section) in repourls:
-                if (base_url, distro, section) not in dest_dict:
-                    dest_dict[(base_url, distro, section)] = AptRepoMetadataBase(base_url, allowed_arches=self._arch)
-                dest = dest_dict[(base_url, distro, section)]
-                to_load.append((base_url, url, dest, ignore_errors))
-
+                target = None
+                if section:
+                    release_dir = posixpath.join(base_url, "dists", distro)
+                else:
+                    release_dir = posixpath.dirname(url)
+                if release_dir not in releases:
+                    releases[release_dir] = self.__fetch_release(release_dir)
+                if releases[release_dir] is not None:
+                    target = _pick_index(releases[release_dir], url[len(release_dir)+1:])
+                    if target is not None:
+                        pdiff = _pick_pdiff(releases[release_dir], url[len(release_dir)+1:])
+                        if pdiff is not None:
+                            pdiff = (posixpath.join(release_dir, pdiff[0]), pdiff[1], pdiff[2])
+                        target = (posixpath.join(release_dir, target[0]), target[1], target[2],
+                                  pdiff)
+                plan.append((base_url, url, dest_dict, (base_url, distro, section), target))
+        return plan
+
+    def __load_repos(self, repos, ignore_errors=True, refresh=False):
+        """Should load data from remote repository. Format the same as sources.list.
+           Repositories loaded before are loaded again only if their indexes changed, each
+           into new metadata, which replaces the old one. If refresh is set, repositories
+           which are not loaded yet are loaded the same way, otherwise they are added"""
+        to_load = []
+        tokens = {}
+        dest_keys = {}
+        plan = self.__plan_indexes(repos)
+        known = set([(id(dest_dict), cache_key) for (base_url, url, dest_dict, cache_key, target)
+                     in plan if cache_key in dest_dict])
+        if refresh:
+            replacements = self.__changed_repos(plan, ignore_errors)
+        else:
+            # Reloaded indexes must not duplicate packages loaded from them before
+            replacements = self.__changed_repos([entry for entry in plan
+                                                 if (id(entry[2]), entry[3]) in known],
+                                                ignore_errors)
+        for (base_url, url, dest_dict, cache_key, target) in plan:
+            if (id(dest_dict), cache_key) in replacements:
+                dest = replacements[(id(dest_dict), cache_key)]
+            elif refresh or (id(dest_dict), cache_key) in known:
+                continue
+            else:
+                if cache_key not in dest_dict:
+                    dest_dict[cache_key] = AptRepoMetadataBase(base_url,
+                                                               allowed_arches=self._arch,
+                                                               paragraph_class=self._paragraph_class)
+                dest = dest_dict[cache_key]
+            dest_keys[id(dest)] = (dest_dict, cache_key)
+            tokens[url] = _index_token(url, target)
+            to_load.append((base_url, url, dest, ignore_errors, target))
         stt = time.time()
-        for args in to_load:
-            self.__parse_one_repo(*args)
+        if self._workers > 1 and len(to_load) > 1:
+            results = self.__load_parallel(to_load)
+        else:
+            results = []
+            for (base_url, url, dest, ignore_errors, target) in to_load:
+                if target is not None:
+                    # Checksum is verified only at the end of index, so it's
+                    # loaded separately and merged after successful verification
+                    dest = None
+                results.append((True, self.__parse_one_repo(base_url, url, ignore_errors,
+                                                            dest, target)))
+        # Merge in to_load order, so result doesn't depend on completion order
+        loaded = []
+        hashes = {}
+        for ((base_url, url, dest, ignore_errors, target), (success, result)) in zip(to_load, results):
+            if not success:
+                raise result
+            if result is not None and result is not dest:
+                dest.extend(result)
+            if result is not None and tokens[url] is not None:
+                hashes[url] = tokens[url]
+            if result is not None and dest_keys[id(dest)] not in loaded:
+                loaded.append(dest_keys[id(dest)])
+        # Everything is loaded, swap in new content
+        replaced = []
+        for (base_url, url, dest_dict, cache_key, target) in plan:
+            dest = replacements.pop((id(dest_dict), cache_key), None)
+            if dest is not None:
+                dest_dict[cache_key] = dest
+                if dest_dict is self.binaries:
+                    self.__binaries_index.drop(cache_key)
+                else:
+                    self.__sources_index.drop(cache_key)
+                replaced.append((dest_dict, cache_key))
+        self._index_hashes.update(hashes)
+        if refresh:
+            loaded = replaced
+        else:
+            loaded = [repo for repo in loaded if repo not in replaced] + replaced
+        for (dest_dict, cache_key) in loaded:
+            self._store_repo(dest_dict, cache_key, (dest_dict, cache_key) in replaced)
+        for (pkgcache, index) in ((self.sources, self.__sources_index),
+                                  (self.binaries, self.__binaries_index)):
+            index.defer(pkgcache, [cache_key for (dest_dict, cache_key) in loaded
+                                   if dest_dict is pkgcache], self._logger)
+        self.__refresh_maps(loaded)
         self._logger.debug("Parsing time: %f", time.time()-stt)
+        return loaded
+
+    def __changed_repos(self, plan, ignore_errors):
+        """Returns { (id(pkgcache), cache_key): new AptRepoMetadataBase, ... } for
+           repositories of plan, which are not loaded or some of their indexes changed"""
+        changed = {}
+        for (base_url, url, dest_dict, cache_key, target) in plan:
+            if (id(dest_dict), cache_key) in changed:
+                continue
+            if cache_key in dest_dict:
+                token = _index_token(url, target)
+                if token is not None and self._index_hashes.get(url) == token:
+                    continue
+                if token is None and not self.__index_changed(url, ignore_errors):
+                    continue
+            self._logger.debug("Changed: %s" % url)
+            changed[(id(dest_dict), cache_key)] = AptRepoMetadataBase(
+                base_url, allowed_arches=self._arch, paragraph_class=self._paragraph_class)
+        return changed
+
+    def __index_changed(self, url, ignore_errors):
+        """Tells if index without Release file changed since it was cached.
+           Without cache it's not known, so it's considered changed"""
+        if self._cache is None:
+            return True
+        fls = self.__open_index(url, ignore_errors)
+        if fls is None:
+            return True
+        try:
+            if getattr(fls, 'not_modified', False):
+                return False
+            # Read it till the end, so it's stored in cache and loaded from there
+            while fls.read(_StreamReader.CHUNK_SIZE):
+                pass
+            return True
+        finally:
+            fls.close()
+
+    def _store_repo(self, pkgcache, cache_key, replace=False):
+        """Called when packages of repository cache_key were loaded into pkgcache
+           (self.sources or self.binaries). replace is set if they replaced previous
+           content of the repository, instead of being added to it.
+           Storage backends override it"""
+        pass
+
+    def _repo_order(self, pkgcache):
+        """Returns cache keys of pkgcache (self.sources or self.binaries) in load order,
+           which decides among equal versions of package"""
+        if pkgcache is self.binaries:
+            return self.__binaries_index.order(pkgcache)
+        return self.__sources_index.order(pkgcache)
+
+    def _repo_packages(self, pkgcache, cache_key):
+        """Returns list of packages of repository cache_key in pkgcache.
+           Storage backends, which don't keep packages in pkgcache, override it"""
+        metadata = pkgcache[cache_key]
+        packages = []
+        for pkgname in metadata.keys():
+            packages.extend(metadata[pkgname])
+        return packages
+
+    def __load_parallel(self, to_load):
+        """Fetches and parses repositories from to_load in self._workers threads.
+           Returns list of (success, metadata or exception) in to_load order"""
+        results = [None] * len(to_load)
+        jobs = Queue.Queue()
+        for idx in range(len(to_load)):
+            jobs.put(idx)
+        failed = threading.Event()
+
+        def worker():
+            """Takes jobs from the queue until it's empty or some job failed"""
+            while not failed.isSet():
+                try:
+                    idx = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                (base_url, url, dest, ignore_errors, target) = to_load[idx]
+                try:
+                    results[idx] = (True, self.__parse_one_repo(base_url, url, ignore_errors,
+                                                                None, target))
+                except Exception, exc:
+                    results[idx] = (False, exc)
+                    failed.set()
+
+        threads = [threading.Thread(target=worker)
+                   for idx in range(min(self._workers, len(to_load)))]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failed.isSet():
+            # Jobs are taken in order, so only jobs after the failed one might be left
+            for idx in range(len(results)):
+                if results[idx] is None:
+                    results[idx] = (False, AptRepoException("Not loaded: %s" % to_load[idx][1]))
+        return results
+
+    def __fetch_release(self, release_dir):
+        """Fetches InRelease or Release file from release_dir.
+           Returns it parsed by _parse_release() or None if there is no Release file.
+           Directories where neither file exists are not asked again by this client"""
+        if release_dir in self._missing_releases:
+            return None
+        missing = True
+        for name in ("InRelease", "Release"):
+            url = posixpath.join(release_dir, name)
+            try:
+                self._logger.debug("Fetching URL: %s" % url)
+                fls = _universal_urlopen(url, self._cache)
+            except Exception, gene:
+                self._logger.debug("Unable to fetch: %s (%s)" % (url, gene))
+                missing = missing and _is_not_found(gene)
+                continue
+            try:
+                # Read it whole, so it gets stored in cache
+                release = _parse_release(cStringIO.StringIO(fls.read()))
+            finally:
+                fls.close()
+            if self._cache is not None:
+                # By-hash urls change with every index, old ones are never asked again
+                self._cache.prune(release_dir, _release_urls(release_dir, release))
+            return release
+        if missing:
+            self._missing_releases.add(release_dir)
+        return None
+
+    def __parse_one_repo(self, base_url, url, ignore_errors, dest=None, target=None):
+        """Loads one repository meta-data from URL and returns it parsed to AptRepoMetadataBase.
+           If dest is specified, data is loaded into it.
+           target is tuple (url, compression, checksum, pdiff) of index picked from Release file"""
+        stt = time.time()
+        if target is not None and target[3] is not None and self._cache is not None:
+            # Diffs are applied to uncompressed copy of index kept in cache.
+            # Unlike other indexes, which are parsed while they are fetched, this
+            # holds whole uncompressed index in memory (twice while patches are
+            # applied, as string and as its lines), so pdiff saves bandwidth at
+            # the cost of the streaming parser's memory use
+            fls = self.__open_pdiff(url, target[3])
+            if fls is None:
+                fls = self.__open_target(target)
+                data = fls.read()
+                fls.close()
+                self._cache.store_index_copy(url, data)
+                fls = cStringIO.StringIO(data)
+                del data
+        elif target is not None:
+            fls = self.__open_target(target)
+        else:
+            fls = self.__open_index(url, ignore_errors)
+            if fls is None:
+                return None
+
+        fetched = time.time()
+        if dest is None:
+            dest = AptRepoMetadataBase(base_url, allowed_arches=self._arch,
+                                       paragraph_class=self._paragraph_class)
+        dest.load(fls, base_url, self._fields)
+        # Close socket after use
+        fls.close()
+        del fls
+        self._logger.debug("Loaded %s: fetch %f, parse %f", url,
+                           fetched - stt, time.time() - fetched)
+        return dest
 
-    def __parse_one_repo(self, base_url, url, dest, ignore_errors):
-        """Loads one repository meta-data from URL and parses it to dest"""
-        # Let's check .gz variant first
+    def __open_index(self, url, ignore_errors):
+        """Opens index without Release file, probing for .gz variant first.
+           Returns None if index is not found and ignore_errors is set"""
         try:
             self._logger.debug("Fetching URL: %s.gz" % url)
-            fls = _universal_urlopen(url+".gz")
+            fls = _universal_urlopen(url+".gz", self._cache)
         except urllib2.HTTPError, hte:
             if hte.code == 404:
                 # If no Packages/Sources.gz found, let's try just Packages/Sources
                 try:
                     self._logger.debug("Compressed metadata not found. Fetching URL: %s" % url)
-                    fls = _universal_urlopen(url)
+                    fls = _universal_urlopen(url, self._cache)
                 except urllib2.HTTPError, hte:
                     if hte.code == 404:
                         if ignore_errors:
@@ -583,11 +2373,74 @@ class AptRepoClient(LoggableObject):
         except Exception, gene:
             # Generic exception
             raise AptRepoException("Unable to fetch: %s (%s)" % (url, gene), gene)
+        return fls
 
-        dest.load(fls, base_url)
-        # Close socket after use
-        fls.close()
-        del fls
+    def __open_target(self, target):
+        """Opens index picked from Release file and verifies its checksum"""
+        (url, compression, checksum) = target[:3]
+        try:
+            self._logger.debug("Fetching URL: %s" % url)
+            return _universal_urlopen(url, self._cache, compression, checksum)
+        except AptRepoException:
+            raise
+        except urllib2.HTTPError, hte:
+            raise AptRepoException("Unable to fetch: %s (HTTP Error code %d)" % (url, hte.code), hte)
+        except Exception, gene:
+            # Generic exception
+            raise AptRepoException("Unable to fetch: %s (%s)" % (url, gene), gene)
+
+    def __open_pdiff(self, url, pdiff):
+        """Brings cached copy of index at url up to date with diffs listed in diff index.
+           Returns file object with index or None if diffs can't be used"""
+        (index_url, index_checksum, checksum) = pdiff
+        data = self._cache.index_copy(url)
+        if data is None:
+            return None
+        current = (hashlib.sha256(data).hexdigest(), len(data))
+        if checksum is not None and current == checksum:
+            self._logger.debug("Cached copy is up to date: %s" % url)
+            return cStringIO.StringIO(data)
+        try:
+            fls = self.__open_target((index_url, "", index_checksum))
+            try:
+                (wanted, history, patches, downloads, merged) = \
+                    _parse_diff_index(cStringIO.StringIO(fls.read()))
+            finally:
+                fls.close()
+            names = [name for (sha, size, name) in history if (sha, size) == current]
+            if not names:
+                self._logger.debug("Cached copy is too old for diffs: %s" % url)
+                return None
+            start = [entry[2] for entry in history].index(names[0])
+            if merged:
+                # Each patch leads to current index
+                names = names[:1]
+            else:
+                names = [entry[2] for entry in history[start:]]
+            lines = data.splitlines(True)
+            del data
+            for name in names:
+                patch_url = posixpath.join(posixpath.dirname(index_url), name + ".gz")
+                fls = self.__open_target((patch_url, ".gz", downloads[name + ".gz"]))
+                try:
+                    patch = fls.read()
+                finally:
+                    fls.close()
+                if (hashlib.sha256(patch).hexdigest(), len(patch)) != patches[name]:
+                    raise AptRepoException("Checksum mismatch: %s" % patch_url)
+                _apply_ed_patch(lines, patch)
+            data = "".join(lines)
+            del lines
+        except (AptRepoException, KeyError, IndexError, ValueError), err:
+            self._logger.debug("Unable to use diffs for %s: %s" % (url, err))
+            return None
+        result = (hashlib.sha256(data).hexdigest(), len(data))
+        if result != wanted or checksum is not None and result != checksum:
+            self._logger.debug("Patched index doesn't match checksum: %s" % url)
+            return None
+        self._logger.debug("Applied %d diffs: %s" % (len(names), url))
+        self._cache.store_index_copy(url, data)
+        return cStringIO.StringIO(data)
 
     def __make_urls(self, repoline):
         """The same as above, but only for one line"""
@@ -0,0 +1,412 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# AptRepoMmapIndex.py
+#
+# This module implements read-only package index in memory-mapped file,
+# which can be shared by many processes.
+#
+# Copyright (C) 2006,2007 Alexandr Kanevskiy
+#
+# Contact: Alexandr Kanevskiy <packages@bifh.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 2 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+# $Id$
+
+__revision__ = "r"+"$Revision$"[11:-2]
+__all__ = ['AptRepoMmapIndex', 'write_mmap_index']
+
+from minideblib.AptRepoClient import AptRepoParagraph, _RepoKeyIndex, _stanza_text
+from minideblib.DpkgVersion import DpkgVersion, VersionError, cached_version
+from minideblib.LoggableObject import LoggableObject
+from minideblib.SafeWriteFile import SafeWriteFile
+import types
+import struct
+import mmap
+
+# Index file layout, numbers are little endian:
+#   header: magic, version, number of source and binary records,
+#           offsets of records, strings and stanzas
+#   repositories: count, then url, distribution, section, base_url as counted
+#           strings and flags of each one
+#   records: source records, then binary records. Records of each kind are sorted
+#           by package name, then by version rank and load order
+#   strings: package names and versions
+#   stanzas: raw paragraph texts
+_MMAP_MAGIC = "MDEBMMAP"
+_MMAP_VERSION = 1
+_MMAP_HEADER = "<8sIIIQQQ"
+# name offset, name length, version offset, version length, repository,
+# version rank (0 for bad versions), stanza offset, stanza length
+_MMAP_RECORD = "<IIIIIIQI"
+_MMAP_RECORD_SIZE = struct.calcsize(_MMAP_RECORD)
+_MMAP_REPO_BINARY = 1
+_MMAP_REPO_CASE_SENSITIVE = 2
+
+
+def _counted(value):
+    """Returns value as counted string"""
+    return struct.pack("<I", len(value)) + value
+
+
+def write_mmap_index(client, path):
+    """Writes packages loaded by AptRepoClient client to index file at path,
+       which can be opened with AptRepoMmapIndex. File is replaced atomically,
+       so processes which have old index mapped keep using it"""
+    repos = []
+    strings = {}
+    string_parts = []
+    stanza_parts = []
+    # Sizes of strings and stanzas
+    sizes = [0, 0]
+    kinds = []
+
+    def add_string(value):
+        offset = strings.get(value)
+        if offset is None:
+            offset = strings[value] = sizes[0]
+            string_parts.append(value)
+            sizes[0] += len(value)
+        return (offset, len(value))
+
+    def add_stanza(text):
+        offset = sizes[1]
+        stanza_parts.append(text)
+        stanza_parts.append("\n\n")
+        sizes[1] += len(text) + 2
+        return (offset, len(text))
+
+    for (pkgcache, flags) in ((client.sources, 0), (client.binaries, _MMAP_REPO_BINARY)):
+        groups = {}
+        seq = 0
+        for cache_key in client._repo_order(pkgcache):
+            metadata = pkgcache[cache_key]
+            repo = len(repos)
+            repos.append((cache_key, metadata.base_url or "",
+                          flags | (metadata.case_sensitive and _MMAP_REPO_CASE_SENSITIVE or 0)))
+            for name in metadata.keys():
+                for pkg in metadata[name]:
+                    version = pkg.get('version') or ""
+                    try:
+                        key = cached_version(version).cmp_key
+                    except VersionError:
+                        key = ()
+                    stanza = add_stanza(_stanza_text(pkg))
+                    seq += 1
+                    groups.setdefault(name, []).append((key, seq, repo, version, stanza))
+        records = []
+        for name in sorted(groups.keys()):
+            name_ref = add_string(name)
+            entries = groups[name]
+            entries.sort()
+            rank = 0
+            last = None
+            for (key, seq, repo, version, stanza) in entries:
+                if key and key != last:
+                    rank += 1
+                    last = key
+                records.append(struct.pack(_MMAP_RECORD, name_ref[0], name_ref[1],
+                                           *(add_string(version) + (repo, key and rank or 0) +
+                                             stanza)))
+        kinds.append(records)
+
+    repo_data = [struct.pack("<I", len(repos))]
+    for (cache_key, base_url, flags) in repos:
+        repo_data.extend([_counted(str(item)) for item in cache_key])
+        repo_data.append(_counted(str(base_url)))
+        repo_data.append(struct.pack("<I", flags))
+    repo_data = "".join(repo_data)
+    records_offset = struct.calcsize(_MMAP_HEADER) + len(repo_data)
+    strings_offset = records_offset + _MMAP_RECORD_SIZE * (len(kinds[0]) + len(kinds[1]))
+    stanzas_offset = strings_offset + sizes[0]
+
+    fhdl = SafeWriteFile(path + ".new", path, "wb")
+    try:
+        fhdl.write(struct.pack(_MMAP_HEADER, _MMAP_MAGIC, _MMAP_VERSION,
+                               len(kinds[0]), len(kinds[1]),
+                               records_offset, strings_offset, stanzas_offset))
+        fhdl.write(repo_data)
+        for records in kinds:
+            fhdl.write("".join(records))
+        fhdl.write("".join(string_parts))
+        for part in stanza_parts:
+            fhdl.write(part)
+    except:
+        fhdl.abort()
+        raise
+    fhdl.close()
+
+
+class _MmapPackages(object):
+    """Records of one kind (sources or binaries) in mapped index file"""
+
+    def __init__(self, data, start, count, strings, stanzas, repos, paragraph_class):
+        self.data = data
+        self.start = start
+        self.count = count
+        self.strings = strings
+        self.stanzas = stanzas
+        self.repos = repos
+        self.paragraph_class = paragraph_class
+
+    def record(self, idx):
+        """Returns (name offset, name length, version offset, version length,
+           repository, rank, stanza offset, stanza length) of record idx"""
+        return struct.unpack_from(_MMAP_RECORD, self.data, self.start + idx * _MMAP_RECORD_SIZE)
+
+    def string(self, offset, length):
+        """Returns string from strings table"""
+        return self.data[self.strings + offset:self.strings + offset + length]
+
+    def name(self, idx):
+        """Returns package name of record idx"""
+        (offset, length) = struct.unpack_from("<II", self.data,
+                                              self.start + idx * _MMAP_RECORD_SIZE)
+        return self.string(offset, length)
+
+    def find(self, package):
+        """Returns (first, end) record numbers of package"""
+        (low, high) = (0, self.count)
+        while low < high:
+            mid = (low + high) // 2
+            if self.name(mid) < package:
+                low = mid + 1
+            else:
+                high = mid
+        end = low
+        while end < self.count and self.name(end) == package:
+            end += 1
+        return (low, end)
+
+    def package(self, record):
+        """Returns paragraph decoded from stanza of record"""
+        (cache_key, base_url, flags) = self.repos[record[4]]
+        para = self.paragraph_class(base_url=base_url)
+        para.setcase_sensitive(flags & _MMAP_REPO_CASE_SENSITIVE)
+        para.load_text(self.data[self.stanzas + record[6]:self.stanzas + record[6] + record[7]])
+        return para
+
+    def best(self, package, cache_keys=None):
+        """Returns (cache key, version) of the best version, like _VersionIndex.best()"""
+        (first, end) = self.find(package)
+        found = None
+        for idx in xrange(end - 1, first - 1, -1):
+            record = self.record(idx)
+            if not record[5] or found is not None and record[5] != found[5]:
+                break
+            if cache_keys is None or self.repos[record[4]][0] in cache_keys:
+                found = record
+        if found is None:
+            return (None, None)
+        return (self.repos[found[4]][0], cached_version(self.string(found[2], found[3])))
+
+    def matching(self, package, version, cache_keys=None):
+        """Returns packages with given version (a DpkgVersion)"""
+        (first, end) = self.find(package)
+        key = version.cmp_key
+        result = []
+        rank = None
+        for idx in xrange(first, end):
+            record = self.record(idx)
+            if rank is None:
+                if not record[5] or \
+                        cached_version(self.string(record[2], record[3])).cmp_key != key:
+                    continue
+                rank = record[5]
+            elif record[5] != rank:
+                break
+            if cache_keys is None or self.repos[record[4]][0] in cache_keys:
+                result.append(self.package(record))
+        return result
+
+    def versions(self, package, cache_keys=None):
+        """Returns [(cache key, version string), ...] sorted by version"""
+        (first, end) = self.find(package)
+        result = []
+        seen = set()
+        for idx in xrange(first, end):
+            record = self.record(idx)
+            cache_key = self.repos[record[4]][0]
+            if cache_keys is None or cache_key in cache_keys:
+                item = (cache_key, self.string(record[2], record[3]))
+                if item not in seen:
+                    seen.add(item)
+                    result.append(item)
+        return result
+
+    def names(self, cache_keys=None):
+        """Returns list of package names available under cache_keys (None for all)"""
+        names = set()
+        for idx in xrange(self.count):
+            record = self.record(idx)
+            if cache_keys is None or self.repos[record[4]][0] in cache_keys:
+                names.add(self.string(record[0], record[1]))
+        return list(names)
+
+
+class AptRepoMmapIndex(LoggableObject):
+    """Read-only access to packages in index file written by write_mmap_index().
+       File is memory-mapped, so processes using the same index share its pages.
+       Query methods work like the ones of AptRepoClient, but packages are
+       decoded from file only when they are returned"""
+
+    def __init__(self, path, paragraph_class=AptRepoParagraph):
+        fhdl = open(path, "rb")
+        try:
+            self.__data = mmap.mmap(fhdl.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fhdl.close()
+        try:
+            (magic, version, nsources, nbinaries, records, strings, stanzas) = \
+                struct.unpack_from(_MMAP_HEADER, self.__data)
+        except struct.error:
+            magic = version = None
+        if magic != _MMAP_MAGIC or version != _MMAP_VERSION:
+            self.__data.close()
+            raise ValueError("%s is not an index of version %d" % (path, _MMAP_VERSION))
+
+        repos = []
+        pos = struct.calcsize(_MMAP_HEADER)
+        for idx in xrange(struct.unpack_from("<I", self.__data, pos)[0]):
+            pos += 4
+            items = []
+            for item in xrange(4):
+                length = struct.unpack_from("<I", self.__data, pos)[0]
+                items.append(self.__data[pos + 4:pos + 4 + length])
+                pos += 4 + length
+            flags = struct.unpack_from("<I", self.__data, pos)[0]
+            repos.append((tuple(items[:3]), items[3] or None, flags))
+        # Stand-ins for AptRepoClient pkgcaches, to resolve base_url filters
+        self.__source_keys = dict([(repo[0], None) for repo in repos
+                                   if not repo[2] & _MMAP_REPO_BINARY])
+        self.__binary_keys = dict([(repo[0], None) for repo in repos
+                                   if repo[2] & _MMAP_REPO_BINARY])
+        self.__source_repo_keys = _RepoKeyIndex()
+        self.__binary_repo_keys = _RepoKeyIndex()
+        self.__sources = _MmapPackages(self.__data, records, nsources, strings, stanzas,
+                                       repos, paragraph_class)
+        self.__binaries = _MmapPackages(self.__data, records + nsources * _MMAP_RECORD_SIZE,
+                                        nbinaries, strings, stanzas, repos, paragraph_class)
+
+    def close(self):
+        """Unmaps index file"""
+        self.__data.close()
+
+    def get_available_source_repos(self):
+        """Lists known source repositories. Format is [ (base_url, distribution, section), ... ]"""
+        return self.__source_keys.keys()
+
+    def get_available_binary_repos(self):
+        """Lists known binary repositories. Format is [ (base_url, distribution, section), ... ]"""
+        return self.__binary_keys.keys()
+
+    def get_best_binary_version(self, package, base_url=None):
+        """Return exact repository and best available version for binary package"""
+        return self.get_best_binary_versions([package], base_url)[package]
+
+    def get_best_source_version(self, package, base_url=None):
+        """Return exact repository and best available version for source package"""
+        return self.get_best_source_versions([package], base_url)[package]
+
+    def get_binary_name_version(self, package, version=None, base_url=None):
+        """Returns list of packages for requested name/version.
+           If version is not specified, the best version will be choosen"""
+        item = (package, version)
+        return self.get_binary_name_versions([item], base_url)[item]
+
+    def get_source_name_version(self, package, version=None, base_url=None):
+        """Returns list of packages for requested name/version.
+           If version is not specified, the best version will be choosen"""
+        item = (package, version)
+        return self.get_source_name_versions([item], base_url)[item]
+
+    def get_best_binary_versions(self, packages, base_url=None):
+        """Returns { package: (base_url, version), ... }"""
+        return self.__get_best_versions(packages, self.__binary_repos(base_url), self.__binaries)
+
+    def get_best_source_versions(self, packages, base_url=None):
+        """Returns { package: (base_url, version), ... }"""
+        return self.__get_best_versions(packages, self.__source_repos(base_url), self.__sources)
+
+    def get_binary_name_versions(self, packages, base_url=None):
+        """Items of packages are names (for the best version) or (name, version) tuples.
+           Returns { item: [package, ...], ... }"""
+        return self.__get_pkgs_by_name_versions(packages, self.__binary_repos(base_url),
+                                                self.__binaries)
+
+    def get_source_name_versions(self, packages, base_url=None):
+        """Items of packages are names (for the best version) or (name, version) tuples.
+           Returns { item: [package, ...], ... }"""
+        return self.__get_pkgs_by_name_versions(packages, self.__source_repos(base_url),
+                                                self.__sources)
+
+    def get_available_binary_versions(self, package, base_url=None):
+        """Returns [(repository, version), ...] for package, sorted by version"""
+        return self.__binaries.versions(package, self.__binary_repos(base_url))
+
+    def get_available_source_versions(self, package, base_url=None):
+        """Returns [(repository, version), ...] for package, sorted by version"""
+        return self.__sources.versions(package, self.__source_repos(base_url))
+
+    def get_available_sources(self, base_url=None):
+        return self.__sources.names(self.__source_repos(base_url))
+
+    def get_available_binaries(self, base_url=None):
+        return self.__binaries.names(self.__binary_repos(base_url))
+
+    def __source_repos(self, base_url):
+        """Returns set of source repositories requested by base_url or None for all of them"""
+        return self.__source_repo_keys.resolve(base_url, self.__source_keys)
+
+    def __binary_repos(self, base_url):
+        """Returns set of binary repositories requested by base_url or None for all of them"""
+        return self.__binary_repo_keys.resolve(base_url, self.__binary_keys)
+
+    def __get_best_versions(self, packages, cache_keys, table):
+        """Returns { package: (base_url, version), ... } for all packages"""
+        result = {}
+        for package in packages:
+            (best_base_url, best) = table.best(package, cache_keys)
+            if best is None:
+                result[package] = (None, None)
+            else:
+                result[package] = (best_base_url, str(best))
+        return result
+
+    def __get_pkgs_by_name_versions(self, packages, cache_keys, table):
+        """Returns { name or (name, version): [package, ...], ... } for all packages"""
+        result = {}
+        for item in packages:
+            if isinstance(item, types.TupleType):
+                (package, version) = item
+            else:
+                (package, version) = (item, None)
+            if version is None:
+                version = table.best(package, cache_keys)[1]
+                if version is None:
+                    result[item] = []
+                    continue
+            elif not isinstance(version, DpkgVersion):
+                try:
+                    version = cached_version(version)
+                except VersionError:
+                    # Bad input data. Return empty set
+                    self._logger.info("BadVersion: %s" % version)
+                    result[item] = []
+                    continue
+            result[item] = table.matching(package, version, cache_keys)
+        return result
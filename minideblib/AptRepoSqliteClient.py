@@ -0,0 +1,333 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# AptRepoSqliteClient.py
+#
+# This module implements APT repository client, which keeps packages in SQLite database.
+#
+# Copyright (C) 2006,2007 Alexandr Kanevskiy
+#
+# Contact: Alexandr Kanevskiy <packages@bifh.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 2 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+# $Id$
+
+__revision__ = "r"+"$Revision$"[11:-2]
+__all__ = ['AptRepoSqliteClient', 'debversion_collation']
+
+from minideblib.AptRepoClient import AptRepoClient, AptRepoException, AptRepoParagraph, \
+    _base_url_patterns, _stanza_text
+from minideblib.DpkgVersion import DpkgVersion, VersionError, cached_version
+import types
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# Values of repos.kind
+_SOURCES = 0
+_BINARIES = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    id INTEGER PRIMARY KEY,
+    kind INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    distribution TEXT NOT NULL,
+    section TEXT NOT NULL,
+    base_url TEXT,
+    case_sensitive INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS repos_key ON repos (kind, url, distribution, section);
+CREATE TABLE IF NOT EXISTS packages (
+    id INTEGER PRIMARY KEY,
+    repo INTEGER NOT NULL REFERENCES repos (id),
+    package TEXT NOT NULL,
+    version TEXT COLLATE debversion,
+    valid INTEGER NOT NULL,
+    architecture TEXT,
+    source TEXT,
+    source_version TEXT COLLATE debversion,
+    pkgid TEXT,
+    stanza TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packages_package ON packages (package, version);
+CREATE INDEX IF NOT EXISTS packages_source ON packages (source, source_version);
+CREATE INDEX IF NOT EXISTS packages_architecture ON packages (architecture);
+CREATE INDEX IF NOT EXISTS packages_repo ON packages (repo);
+CREATE INDEX IF NOT EXISTS packages_pkgid ON packages (pkgid);
+"""
+
+
+def _version_key(version):
+    """Returns comparison key of version string, bad versions sort first"""
+    try:
+        return cached_version(version).cmp_key
+    except VersionError:
+        return ()
+
+
+def debversion_collation(left, right):
+    """SQLite collation, which compares strings as Debian versions"""
+    return cmp(_version_key(left), _version_key(right))
+
+
+class AptRepoSqliteClient(AptRepoClient):
+    """AptRepoClient which keeps loaded packages in SQLite database instead of memory.
+       Table repos has a row for every repository: kind (0 for sources, 1 for binaries),
+       url, distribution, section. Table packages has package, version, architecture,
+       source, source_version, pkgid and stanza (paragraph text) columns, with indexes
+       on them. Version columns use "debversion" collation.
+       Queries are answered by the database, packages are decoded only when they are
+       returned or put to source_to_binaries_map and pkgid_map. self.sources and self.binaries only keep (empty) entries of repositories"""
+
+    def __init__(self, repos=None, arch=None, workers=1, cache_dir=None,
+                 paragraph_class=AptRepoParagraph, database=":memory:"):
+        """database -- path of database file, in memory database by default.
+           Other parameters are the same as for AptRepoClient"""
+        if sqlite3 is None:
+            raise AptRepoException("AptRepoSqliteClient needs sqlite3 module")
+        AptRepoClient.__init__(self, repos, arch, workers, cache_dir, paragraph_class)
+        self.__db = sqlite3.connect(database)
+        self.__db.text_factory = str
+        self.__db.create_collation("debversion", debversion_collation)
+        self.__db.executescript(_SCHEMA)
+        self.__db.commit()
+
+    def query(self, sql, params=()):
+        """Runs SQL statement with params against database. Returns list of result rows"""
+        return self.__db.execute(sql, params).fetchall()
+
+    def close(self):
+        """Closes database"""
+        self.__db.close()
+
+    def load_repos(self, repoline=None, ignore_errors=True, clear=True, fields=None):
+        """Like AptRepoClient.load_repos(), but packages are stored in database"""
+        if clear:
+            self.__db.execute("DELETE FROM packages")
+            self.__db.execute("DELETE FROM repos")
+            self.__db.commit()
+        AptRepoClient.load_repos(self, repoline, ignore_errors, clear, fields)
+
+    update = load_repos
+
+    def save_snapshot(self, path):
+        """Not supported, database file keeps packages already"""
+        raise AptRepoException("AptRepoSqliteClient keeps packages in database, "
+                               "snapshots are not supported")
+
+    def load_snapshot(self, path):
+        """Not supported, always returns False"""
+        self._logger.debug("AptRepoSqliteClient doesn't load snapshots: %s" % path)
+        return False
+
+    def _store_repo(self, pkgcache, cache_key, replace=False):
+        """Moves packages of repository from pkgcache to database"""
+        metadata = pkgcache[cache_key]
+        kind = (pkgcache is self.binaries and [_BINARIES] or [_SOURCES])[0]
+        row = self.__db.execute("SELECT id FROM repos WHERE kind = ? AND url = ? AND "
+                                "distribution = ? AND section = ?",
+                                (kind,) + tuple(cache_key)).fetchone()
+        if row is None:
+            repo = self.__db.execute("INSERT INTO repos (kind, url, distribution, section, "
+                                     "base_url, case_sensitive) VALUES (?, ?, ?, ?, ?, ?)",
+                                     (kind,) + tuple(cache_key) +
+                                     (metadata.base_url, metadata.case_sensitive and 1 or 0)
+                                     ).lastrowid
+        else:
+            repo = row[0]
+            if replace:
+                # Deleted in the same transaction, so readers see old or new packages
+                self.__db.execute("DELETE FROM packages WHERE repo = ?", (repo,))
+
+        def rows():
+            for name in metadata.keys():
+                for pkg in metadata[name]:
+                    version = pkg.get('version')
+                    valid = version is not None and _version_key(version) and 1 or 0
+                    try:
+                        (source, source_version) = pkg.get_source()
+                    except (AptRepoException, KeyError):
+                        (source, source_version) = (None, None)
+                    try:
+                        pkgid = pkg.get_pkgid()
+                    except AptRepoException:
+                        pkgid = None
+                    stanza = _stanza_text(pkg)
+                    yield (repo, name, version, valid,
+                           pkg.get('architecture'), source, source_version, pkgid, stanza)
+        self.__db.executemany("INSERT INTO packages (repo, package, version, valid, "
+                              "architecture, source, source_version, pkgid, stanza) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows())
+        self.__db.commit()
+        metadata.clear()
+
+    def _repo_packages(self, pkgcache, cache_key):
+        """Returns list of packages of repository from database"""
+        kind = (pkgcache is self.binaries and [_BINARIES] or [_SOURCES])[0]
+        return self.__packages("kind = ? AND url = ? AND distribution = ? AND section = ? "
+                               "ORDER BY packages.id", (kind,) + tuple(cache_key))
+
+    def get_best_binary_version(self, package, base_url=None):
+        """Return exact repository and best available version for binary package"""
+        return self.get_best_binary_versions([package], base_url)[package]
+
+    def get_best_source_version(self, package, base_url=None):
+        """Return exact repository and best available version for source package"""
+        return self.get_best_source_versions([package], base_url)[package]
+
+    def get_binary_name_version(self, package, version=None, base_url=None):
+        """Returns list of packages for requested name/version.
+           If version is not specified, the best version will be choosen"""
+        item = (package, version)
+        return self.get_binary_name_versions([item], base_url)[item]
+
+    def get_source_name_version(self, package, version=None, base_url=None):
+        """Returns list of packages for requested name/version.
+           If version is not specified, the best version will be choosen"""
+        item = (package, version)
+        return self.get_source_name_versions([item], base_url)[item]
+
+    def get_best_binary_versions(self, packages, base_url=None):
+        """Returns { package: (base_url, version), ... }"""
+        return self.__get_best_versions(packages, self.__repo_filter(_BINARIES, base_url))
+
+    def get_best_source_versions(self, packages, base_url=None):
+        """Returns { package: (base_url, version), ... }"""
+        return self.__get_best_versions(packages, self.__repo_filter(_SOURCES, base_url))
+
+    def get_binary_name_versions(self, packages, base_url=None):
+        """Items of packages are names (for the best version) or (name, version) tuples.
+           Returns { item: [package, ...], ... }"""
+        return self.__get_pkgs_by_name_versions(packages, self.__repo_filter(_BINARIES, base_url))
+
+    def get_source_name_versions(self, packages, base_url=None):
+        """Items of packages are names (for the best version) or (name, version) tuples.
+           Returns { item: [package, ...], ... }"""
+        return self.__get_pkgs_by_name_versions(packages, self.__repo_filter(_SOURCES, base_url))
+
+    def get_available_binary_versions(self, package, base_url=None):
+        """Returns [(repository, version), ...] for package, sorted by version"""
+        return self.__get_versions(package, self.__repo_filter(_BINARIES, base_url))
+
+    def get_available_source_versions(self, package, base_url=None):
+        """Returns [(repository, version), ...] for package, sorted by version"""
+        return self.__get_versions(package, self.__repo_filter(_SOURCES, base_url))
+
+    def get_available_sources(self, base_url=None):
+        (where, params) = self.__repo_filter(_SOURCES, base_url)
+        return [row[0] for row in self.query("SELECT DISTINCT package FROM packages JOIN repos "
+                                             "ON repo = repos.id WHERE " + where, params)]
+
+    def get_available_binaries(self, base_url=None):
+        (where, params) = self.__repo_filter(_BINARIES, base_url)
+        return [row[0] for row in self.query("SELECT DISTINCT package FROM packages JOIN repos "
+                                             "ON repo = repos.id WHERE " + where, params)]
+
+    def __repo_filter(self, kind, base_url):
+        """Returns (SQL condition, params) on repos table for repositories of kind,
+           requested by base_url"""
+        where = ["kind = ?"]
+        params = [kind]
+        if base_url:
+            patterns = []
+            for pattern in _base_url_patterns(base_url):
+                conditions = ["1"]
+                for (column, value) in zip(("url", "distribution", "section"), pattern):
+                    if value is not None:
+                        conditions.append("%s = ?" % column)
+                        params.append(value)
+                patterns.append("(%s)" % " AND ".join(conditions))
+            where.append("(%s)" % " OR ".join(patterns))
+        return (" AND ".join(where), tuple(params))
+
+    def __packages(self, where, params):
+        """Returns packages decoded from rows of packages matching where condition"""
+        result = []
+        for (base_url, case_sensitive, stanza) in self.query(
+                "SELECT base_url, case_sensitive, stanza FROM packages JOIN repos "
+                "ON repo = repos.id WHERE " + where, params):
+            para = self._paragraph_class(base_url=base_url)
+            para.setcase_sensitive(case_sensitive)
+            para.load_text(stanza)
+            result.append(para)
+        return result
+
+    def __best(self, package, repo_filter):
+        """Returns (cache key, version) of the best version, first loaded one
+           wins among equal versions"""
+        (where, params) = repo_filter
+        row = self.__db.execute("SELECT url, distribution, section, version FROM packages "
+                                "JOIN repos ON repo = repos.id WHERE package = ? AND valid AND " +
+                                where + " ORDER BY version DESC, repos.id, packages.id LIMIT 1",
+                                (package,) + params).fetchone()
+        if row is None:
+            return (None, None)
+        return (tuple(row[:3]), cached_version(row[3]))
+
+    def __get_best_versions(self, packages, repo_filter):
+        """Returns { package: (base_url, version), ... } for all packages"""
+        result = {}
+        for package in packages:
+            (best_base_url, best) = self.__best(package, repo_filter)
+            if best is None:
+                result[package] = (None, None)
+            else:
+                result[package] = (best_base_url, str(best))
+        return result
+
+    def __get_pkgs_by_name_versions(self, packages, repo_filter):
+        """Returns { name or (name, version): [package, ...], ... } for all packages"""
+        (where, params) = repo_filter
+        result = {}
+        for item in packages:
+            if isinstance(item, types.TupleType):
+                (package, version) = item
+            else:
+                (package, version) = (item, None)
+            if version is None:
+                version = self.__best(package, repo_filter)[1]
+                if version is None:
+                    result[item] = []
+                    continue
+            elif not isinstance(version, DpkgVersion):
+                try:
+                    version = cached_version(version)
+                except VersionError:
+                    # Bad input data. Return empty set
+                    self._logger.info("BadVersion: %s" % version)
+                    result[item] = []
+                    continue
+            result[item] = self.__packages("package = ? AND version = ? AND valid AND " + where +
+                                           " ORDER BY repos.id, packages.id",
+                                           (package, str(version)) + params)
+        return result
+
+    def __get_versions(self, package, repo_filter):
+        """Returns [(cache key, version string), ...] sorted by version"""
+        (where, params) = repo_filter
+        result = []
+        seen = set()
+        for row in self.query("SELECT url, distribution, section, version FROM packages "
+                              "JOIN repos ON repo = repos.id WHERE package = ? AND " + where +
+                              " ORDER BY valid, version, repos.id, packages.id", (package,) + params):
+            item = (tuple(row[:3]), row[3])
+            if item not in seen:
+                seen.add(item)
+                result.append(item)
+        return result
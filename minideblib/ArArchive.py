@@ -0,0 +1,185 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# ArArchive.py
+#
+# This module implements reader of ar archives, like .deb packages
+#
+# Copyright (C) 2005,2006 Alexandr Kanevskiy
+#
+# Contact: Alexandr Kanevskiy <packages@bifh.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 2 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+# $Id$
+
+__revision__ = "r"+"$Revision$"[11:-2]
+__all__ = ['ArArchive', 'ArArchiveException']
+
+AR_MAGIC = "!<arch>\n"
+# name, mtime, uid, gid, mode, size, magic
+_AR_HEADER_FIELDS = (16, 12, 6, 6, 8, 10, 2)
+_AR_HEADER_SIZE = sum(_AR_HEADER_FIELDS)
+_AR_FMAG = "`\n"
+
+
+class ArArchiveException(Exception):
+    """Exception raised for broken or unsupported ar archives"""
+    def __init__(self, msg):
+        # msg is passed to Exception, so exception could be pickled
+        Exception.__init__(self, msg)
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+    def __repr__(self):
+        return self.msg
+
+
+class ArMember(object):
+    """Header of ar archive member"""
+    __slots__ = ('name', 'mtime', 'uid', 'gid', 'mode', 'size', 'offset')
+
+    def __init__(self, name, mtime, uid, gid, mode, size, offset):
+        self.name = name
+        self.mtime = mtime
+        self.uid = uid
+        self.gid = gid
+        self.mode = mode
+        self.size = size
+        # Offset of member data in archive
+        self.offset = offset
+
+    def __repr__(self):
+        return "<ArMember %s %d bytes at %d>" % (self.name, self.size, self.offset)
+
+
+class ArMemberFile(object):
+    """Read-only file object for data of one ar archive member"""
+
+    def __init__(self, fhdl, member):
+        self.__fhdl = fhdl
+        self.__start = member.offset
+        self.__size = member.size
+        self.__pos = 0
+        self.name = member.name
+
+    def read(self, size=-1):
+        """Reads up to size bytes of member data, or all the rest if size is negative"""
+        left = self.__size - self.__pos
+        if size < 0 or size > left:
+            size = left
+        if size <= 0:
+            return ""
+        self.__fhdl.seek(self.__start + self.__pos)
+        data = self.__fhdl.read(size)
+        self.__pos += len(data)
+        return data
+
+    def tell(self):
+        return self.__pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.__pos
+        elif whence == 2:
+            pos += self.__size
+        self.__pos = max(0, min(pos, self.__size))
+
+    def close(self):
+        pass
+
+
+class ArArchive(object):
+    """Reads members of ar archive without extracting them.
+       Only common format is supported (GNU and BSD long names are not used by .deb files)"""
+
+    def __init__(self, path=None, fileobj=None):
+        """path -- path to archive, or fileobj -- seekable file object with archive"""
+        self.__own = fileobj is None
+        if fileobj is None:
+            fileobj = open(path, "rb")
+        self.__fhdl = fileobj
+        try:
+            if fileobj.read(len(AR_MAGIC)) != AR_MAGIC:
+                raise ArArchiveException("Not an ar archive: %s" % (path or fileobj))
+            self.__members = self.__read_members()
+        except:
+            self.close()
+            raise
+
+    def __read_members(self):
+        """Reads all member headers"""
+        members = []
+        offset = len(AR_MAGIC)
+        self.__fhdl.seek(0, 2)
+        end = self.__fhdl.tell()
+        while True:
+            self.__fhdl.seek(offset)
+            header = self.__fhdl.read(_AR_HEADER_SIZE)
+            if not header.strip():
+                return members
+            if len(header) != _AR_HEADER_SIZE or header[-2:] != _AR_FMAG:
+                raise ArArchiveException("Broken ar member header at %d" % offset)
+            fields = []
+            pos = 0
+            for width in _AR_HEADER_FIELDS[:-1]:
+                fields.append(header[pos:pos + width].strip())
+                pos += width
+            (name, mtime, uid, gid, mode, size) = fields
+            try:
+                member = ArMember(name.rstrip("/"), int(mtime or 0), int(uid or 0),
+                                  int(gid or 0), int(mode or "0", 8), int(size),
+                                  offset + _AR_HEADER_SIZE)
+            except ValueError:
+                raise ArArchiveException("Broken ar member header at %d" % offset)
+            if member.offset + member.size > end:
+                raise ArArchiveException("Truncated ar member %s" % member.name)
+            members.append(member)
+            # Data is padded to even size
+            offset = member.offset + member.size + member.size % 2
+
+    def close(self):
+        """Closes archive file, if it was opened by archive"""
+        if self.__own and self.__fhdl is not None:
+            self.__fhdl.close()
+        self.__fhdl = None
+
+    def getmembers(self):
+        """Returns list of ArMember objects in archive order"""
+        return self.__members[:]
+
+    def getnames(self):
+        """Returns list of member names in archive order"""
+        return [member.name for member in self.__members]
+
+    def getmember(self, name):
+        """Returns ArMember with given name. Raises KeyError if there is no such member"""
+        for member in self.__members:
+            if member.name == name:
+                return member
+        raise KeyError(name)
+
+    def extractfile(self, member):
+        """Returns file object for data of member (name or ArMember)"""
+        if not isinstance(member, ArMember):
+            member = self.getmember(member)
+        return ArMemberFile(self.__fhdl, member)
+
+    def read(self, member):
+        """Returns whole data of member (name or ArMember)"""
+        return self.extractfile(member).read()
@@ -40,6 +40,44 @@ __all__ = ['DpkgParagraph', 'DpkgControl', 'DpkgSourceControl']
 from DpkgDatalist import *
 from SignedFile import SignedFile
 import sys
+import re
+
+# Field name with value and all its continuation lines
+_field_re = re.compile(r"^([^ \n][^:\n]*):(.*(?:\n .*)*)", re.M)
+
+
+def decode_value(value):
+    '''
+    Convert raw field value, with continuation lines, as matched in
+    paragraph text to the form :meth:`DpkgParagraph.load` stores it.
+    '''
+    if '\n' in value:
+        value = value.split('\n ')
+        value[0] = value[0].strip()
+        return value
+    return value.strip()
+
+
+def split_paragraphs(f, chunk_size=1048576):
+    '''
+    Read file object in large chunks and yield text of each paragraph,
+    without separating blank lines.
+    :param f: A file like object with the method f.read(size)
+    '''
+    tail = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        paras = (tail + chunk).split('\n\n')
+        tail = paras.pop()
+        for para in paras:
+            para = para.strip('\n')
+            if para:
+                yield para
+    tail = tail.strip('\n')
+    if tail:
+        yield tail
 
 
 class DpkgParagraph(DpkgOrderedDatalist):
@@ -103,6 +141,45 @@ class DpkgParagraph(DpkgOrderedDatalist):
 
             self[key] = value
 
+    def load_text(self, text, fields=None):
+        '''
+        Fill paragraph from its text, as yielded by :func:`split_paragraphs`.
+        Gives the same result as :meth:`load`, but works on the whole
+        paragraph at once.
+        :param text: Paragraph text
+        :param fields: If given, only fields from this set are loaded
+        '''
+        items = []
+        for (key, value) in _field_re.findall(text):
+            # decode_value() inlined, it's the hottest loop of index parsing
+            if '\n' in value:
+                value = value.split('\n ')
+                value[0] = value[0].strip()
+            else:
+                value = value.strip()
+            if not self.case_sensitive:
+                newkey = key.lower()
+                if fields is not None and newkey not in fields:
+                    continue
+                self.trueFieldCasing[newkey] = key
+                key = newkey
+            elif fields is not None and key not in fields:
+                continue
+            items.append((key, value))
+        self._load_items(items)
+
+    def load_fields(self, keys, values):
+        '''
+        Fill paragraph from already decoded fields.
+        :param keys: Field names in their original case
+        :param values: Field values, in the same order
+        '''
+        if not self.case_sensitive:
+            lowered = [key.lower() for key in keys]
+            self.trueFieldCasing.update(zip(lowered, keys))
+            keys = lowered
+        self._load_items(zip(keys, values))
+
     @staticmethod
     def _store_field(f, value, lead=''):
         '''
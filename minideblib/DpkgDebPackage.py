@@ -27,18 +27,42 @@
 # $Id$
 
 __revision__ = "r"+"$Revision$"[11:-2]
-__all__ = ['DpkgDebPackage', 'DpkgDebPackageException']
+__all__ = ['DpkgDebPackage', 'DpkgDebPackageException', 'scan_debs']
 
 import os
 import re
 import glob
-import shutil
 import gzip 
+import zlib
+import tarfile
 import tempfile
-import commands
-import errno
-
+import subprocess
+import threading
+from fnmatch import fnmatch
+from cStringIO import StringIO
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from minideblib.ArArchive import ArArchive, ArArchiveException
 from minideblib.DpkgControl import DpkgParagraph
+from minideblib.DpkgFileList import DpkgFileList
 from minideblib.DpkgVersion import DpkgVersion
 from minideblib.LoggableObject import LoggableObject
 
@@ -46,7 +70,8 @@ from minideblib.LoggableObject import LoggableObject
 class DpkgDebPackageException(Exception):
     """General exception which could be raised by DpkgDebPackage"""
     def __init__(self, msg):
-        Exception.__init__(self)
+        # msg is passed to Exception, so exception could be pickled
+        Exception.__init__(self, msg)
         self.msg = msg
 
     def __str__(self):
@@ -67,7 +92,8 @@ class DpkgDebPackage(LoggableObject):
         self.changes = None
         self.news = None
         self.files = None
-        self.__raw_files = None
+        # DpkgFileList with details of files
+        self.filelist = None
         self.path = None
         if pkgfile:
             self.path = os.path.abspath(pkgfile)
@@ -89,20 +115,27 @@ class DpkgDebPackage(LoggableObject):
             raise DpkgDebPackageException("Unable to locate file: %s" % self.path)
         if path_changed or not self.control:
             self.load_control()
-        if getchanges:
-            self.load_changes(getchanges)
-        if getfiles:
-            self.load_contents()
+        if getchanges or getfiles:
+            # Both file list and changelogs are taken from single pass over data.tar
+            (filelist, found) = self.__scan_data(getfiles, getchanges)
+            if getchanges:
+                (self.news, self.changes) = self.__extract_changes(getchanges, found=found)
+            if getfiles:
+                self.__set_files(filelist)
 
     def load_contents(self):
         """ Reads contents of .deb file into memory """
         if self.path and os.path.isfile(self.path):
-            self.__raw_files = self.__list_contents()
-            if self.__raw_files:
-                self.files = [fname[5] for fname in self.__raw_files]
+            self.__set_files(self.__scan_data(True, None)[0])
         else: 
             raise DpkgDebPackageException("Unable to locate file: %s" % self.path)
 
+    def __set_files(self, filelist):
+        """Stores file list of package"""
+        self.filelist = filelist
+        if self.filelist:
+            self.files = self.filelist.names
+
     def load_changes(self, getchanges='both'):
         """ Reads changelog and/or news information into memory """
         if self.path and os.path.isfile(self.path):
@@ -115,83 +148,101 @@ class DpkgDebPackage(LoggableObject):
     def load_control(self):
         """ Reads control information into memory """
         if self.path and os.path.isfile(self.path):
-            tempdir = self.__extract_control()
-            fhdl = open(os.path.join(tempdir, "control"), "r")
+            members = self.__read_control()
+            if "control" not in members:
+                raise DpkgDebPackageException("No control file in %s" % self.path)
             self.control = DpkgParagraph()
-            self.control.load(fhdl)
-            fhdl.close()
-            if not self.__parse_md5sums(tempdir):
+            try:
+                self.control.load(StringIO(members["control"]))
+            except (ValueError, IndexError), err:
+                raise DpkgDebPackageException("Unable to parse control file in %s: %s" % (self.path, err))
+            if not self.__parse_md5sums(members.get("md5sums")):
                 self._logger.warning("Can't parse md5sums")
             else:
                 self.__md5files = [xsum[1] for xsum in self.md5sums]
-            shutil.rmtree(tempdir, True)
         else:
             raise DpkgDebPackageException("Unable to locate file: %s" % self.path)
 
-    def __extract_changes(self, which, since_version=None):
+    def __extract_changes(self, which, since_version=None, found=None):
         '''Extract changelog entries, news or both from the package.
         If since_version is specified, only return entries later than the specified version.
+        found is list of (name, data) changelog files already read from the package.
         returns a sequence of Changes objects.'''
 
-        def changelog_variations(fname):
-            """Return list of all possible changelog/news locations"""
-            formats = ['usr/doc/*/%s.gz',
-                       'usr/share/doc/*/%s.gz',
-                       'usr/doc/*/%s',
-                       'usr/share/doc/*/%s',
-                       './usr/doc/*/%s.gz',
-                       './usr/share/doc/*/%s.gz',
-                       './usr/doc/*/%s',
-                       './usr/share/doc/*/%s']
-            return [fmt % fname for fmt in formats]
-        
-        news_filenames = changelog_variations('NEWS.Debian')
-        changelog_filenames = changelog_variations('changelog.Debian')
-        changelog_filenames_native = changelog_variations('changelog')
-
-        filenames = []
-        if which == 'both' or which == 'news':
-            filenames.extend(news_filenames)
-        if which == 'both' or which == 'changelogs':
-            filenames.extend(changelog_filenames)
-            filenames.extend(changelog_filenames_native)
-
-        tempdir = self.extract_contents(filenames)
+        if found is None:
+            found = self.__scan_data(False, which)[1]
+
+        def first_changelog(patterns):
+            """Returns first parseable changelog matching one of patterns"""
+            for pattern in patterns:
+                for (name, data) in found:
+                    if _match_path(name, pattern):
+                        changes = self.__read_changelog(name, data, since_version)
+                        if changes:
+                            return changes
+            return None
 
         news = None
-        for filename in news_filenames:
-            news = self.__read_changelog(os.path.join(tempdir, filename),
-                                         since_version)
-            if news:
-                break
+        if which == 'both' or which == 'news':
+            news = first_changelog(_NEWS_FILENAMES)
 
         changelog = None
-        for batch in (changelog_filenames, changelog_filenames_native):
-            for filename in batch:
-                changelog = self.__read_changelog(os.path.join(tempdir, filename),
-                                                  since_version)
-                if changelog:
-                    break
-            if changelog:
-                break
-
-        shutil.rmtree(tempdir, True)
+        if which == 'both' or which == 'changelogs':
+            changelog = first_changelog(_CHANGELOG_FILENAMES) or \
+                        first_changelog(_CHANGELOG_FILENAMES_NATIVE)
 
         return (news, changelog)
 
-    def __extract_control(self):
-        """Extracts content of control.tar.gz from .deb package"""
+    def __iter_tar(self, name):
+        """Iterates over (member, tarfile) pairs of control.tar or data.tar 
+           section of .deb package. Archive is read as a stream, so member 
+           data could be read only while iterating over this member"""
         try:
-            tempdir = tempfile.mkdtemp(prefix='dpkgdebpackage')
-        except AttributeError:
-            tempdir = tempfile.mktemp()
-            os.mkdir(tempdir)
-
-        extract_command = 'ar p %s control.tar.gz | tar zxf - -C %s 2>/dev/null' % (self.path, tempdir)
-
-        os.system(extract_command)
-
-        return tempdir
+            archive = ArArchive(self.path)
+        except (IOError, ArArchiveException), err:
+            raise DpkgDebPackageException("Unable to read %s: %s" % (self.path, err))
+        try:
+            section = None
+            for member in archive.getmembers():
+                if member.name == name or member.name.startswith(name + "."):
+                    section = member
+                    break
+            if section is None:
+                raise DpkgDebPackageException("No %s section in %s" % (name, self.path))
+            compression = section.name[len(name) + 1:]
+            (fileobj, mode) = _open_section(archive.extractfile(section), compression)
+            if fileobj is None:
+                raise DpkgDebPackageException("Unsupported compression of %s in %s" % (section.name, self.path))
+            try:
+                tar = tarfile.open(fileobj=fileobj, mode=mode)
+                member = tar.next()
+                while member is not None:
+                    yield (member, tar)
+                    # Don't let tarfile keep all members of stream
+                    tar.members = []
+                    member = tar.next()
+                tar.close()
+            except _DECODE_ERRORS, err:
+                raise DpkgDebPackageException("Unable to read %s from %s: %s" % (section.name, self.path, err))
+            finally:
+                fileobj.close()
+        finally:
+            archive.close()
+
+    def __read_member(self, tar, member):
+        """Returns data of current member of tar stream"""
+        try:
+            return tar.extractfile(member).read()
+        except _DECODE_ERRORS, err:
+            raise DpkgDebPackageException("Unable to read %s from %s: %s" % (member.name, self.path, err))
+
+    def __read_control(self):
+        """Returns dict with contents of files from control section of .deb package"""
+        members = {}
+        for (member, tar) in self.__iter_tar("control.tar"):
+            if member.isfile():
+                members[_member_name(member)] = self.__read_member(tar, member)
+        return members
 
     def extract_contents(self, filenames):
         """Extracts partial contents of Debian package to temporary directory"""
@@ -201,70 +252,75 @@ class DpkgDebPackage(LoggableObject):
             tempdir = tempfile.mktemp()
             os.mkdir(tempdir)
 
-        extract_command = 'ar p %s data.tar.gz |tar zxf - -C %s %s 2>/dev/null' % (
-            self.path,
-            tempdir,
-            ' '.join(["'%s'" % filen for filen in filenames])
-            )
-
-        # tar exits unsuccessfully if _any_ of the files we wanted
-        # were not available, so we can't do much with its status
-        os.system(extract_command)
+        patterns = [_member_name(filen) for filen in filenames]
+        for (member, tar) in self.__iter_tar("data.tar"):
+            name = _member_name(member)
+            if name.startswith("/") or ".." in name.split("/"):
+                continue
+            # Like tar, extract whole directory if it was requested
+            path = name
+            while path:
+                if [pattern for pattern in patterns if fnmatch(path, pattern)]:
+                    try:
+                        tar.extract(member, tempdir)
+                    except _DECODE_ERRORS, err:
+                        raise DpkgDebPackageException("Unable to extract %s from %s: %s" % (member.name, self.path, err))
+                    break
+                path = os.path.dirname(path)
 
         return tempdir
     
-    def __parse_md5sums(self, tempdir):
-        """Parses md5sums file from extracted control section of debian package"""
-        path = os.path.join(tempdir, "md5sums")
-        if not os.access(path, os.R_OK):
-            print "Can't open file %s" % path
+    def __parse_md5sums(self, data):
+        """Parses md5sums file from control section of debian package"""
+        if data is None:
+            self._logger.warning("Can't find md5sums in %s" % self.path)
             return False
         self.md5sums = []
-        fhdl = open(path, "r")
-        for line in fhdl.readlines():
-            if line[33] != " ":
-                print "33 is not a space.\n %s" % line
+        for line in data.splitlines(True):
+            if len(line) < 35 or line[33] != " ":
                 # Something bad happend, unknown file format.
-                fhdl.close()
+                self._logger.warning("Malformed md5sums line in %s: %r" % (self.path, line))
                 return False
             argl = [line[:32].strip(), line[34:].strip()]
             self.md5sums.append(argl)
-        fhdl.close()
         return True
 
-    def __list_contents(self):
-        """Returns filelist of data.tar.gz"""
-        (status, output) = commands.getstatusoutput("ar p %s data.tar.gz | tar ztvf -" % self.path)
-        if status != 0:
-            return []
-        files = [line.split() for line in output.splitlines()]
-        return files
+    def __scan_data(self, getfiles=True, getchanges='both'):
+        """Reads data.tar of package once. Returns DpkgFileList (or None if 
+           getfiles is false) and list of (name, data) of changelog files 
+           selected by getchanges, in archive order"""
+        files = None
+        if getfiles:
+            files = DpkgFileList()
+        filenames = _changes_filenames(getchanges)
+        found = []
+        for (member, tar) in self.__iter_tar("data.tar"):
+            if getfiles:
+                files.append_member(member)
+            if filenames and member.isfile():
+                name = _member_name(member)
+                for pattern in filenames:
+                    if _match_path(name, pattern):
+                        found.append((name, self.__read_member(tar, member)))
+                        break
+        return (files, found)
 
-    def __read_changelog(self, filename, since_version):
+    def __read_changelog(self, filename, data, since_version):
         """Read changelog up to specified version"""
         changelog_header = re.compile('^\S+ \((?P<version>.*)\) .*;.*urgency=(?P<urgency>\w+).*')
-        filenames = glob.glob(filename)
 
-        fhdl = None
-        for filename in filenames:
-            try:
-                if filename.endswith('.gz'):
-                    fhdl = gzip.GzipFile(filename)
-                else:
-                    fhdl = open(filename)
-                break
-            except IOError, ioerr:
-                if ioerr.errno == errno.ENOENT:
-                    pass
-                else:
-                    raise
-
-        if not fhdl:
-            return None
+        fhdl = StringIO(data)
+        if filename.endswith('.gz'):
+            fhdl = gzip.GzipFile(fileobj=fhdl)
 
         changes = ''
         is_debian_changelog = 0
-        for line in fhdl.readlines():
+        try:
+            lines = fhdl.readlines()
+        except (IOError, EOFError, ValueError, zlib.error), err:
+            self._logger.warning("Can't read %s: %s" % (filename, err))
+            return None
+        for line in lines:
             match = changelog_header.match(line)
             if match:
                 is_debian_changelog = 1
@@ -278,3 +334,278 @@ class DpkgDebPackage(LoggableObject):
             return None
 
         return changes
+
+
+# Section compressions which tarfile decompresses itself
+_TAR_COMPRESSIONS = ["", "gz"]
+if bz2 is not None:
+    _TAR_COMPRESSIONS.append("bz2")
+
+# Errors which could be raised while decoding section
+_DECODE_ERRORS = [IOError, EOFError, zlib.error, tarfile.TarError]
+if lzma is not None:
+    _DECODE_ERRORS.append(lzma.LZMAError)
+if zstandard is not None:
+    _DECODE_ERRORS.append(zstandard.ZstdError)
+_DECODE_ERRORS = tuple(_DECODE_ERRORS)
+
+# Decompressor factories for other section compressions
+_DECOMPRESSORS = {}
+if lzma is not None:
+    _DECOMPRESSORS["xz"] = lzma.LZMADecompressor
+    _DECOMPRESSORS["lzma"] = lambda: lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+if zstandard is not None:
+    _DECOMPRESSORS["zst"] = lambda: zstandard.ZstdDecompressor().decompressobj()
+
+# Commands used if there is no module for compression
+_DECOMPRESS_COMMANDS = {
+    "bz2": ["bzip2", "-dc"],
+    "xz": ["xz", "-dc"],
+    "lzma": ["xz", "--format=lzma", "-dc"],
+    "zst": ["zstd", "-dc"],
+}
+
+def _open_section(fileobj, compression):
+    """Returns (file object, tarfile mode) for reading of compressed .deb section.
+       Returns (None, None) if compression is not supported"""
+    if compression in _TAR_COMPRESSIONS:
+        return (fileobj, "r|" + compression)
+    if compression in _DECOMPRESSORS:
+        return (_DecompressedFile(fileobj, _DECOMPRESSORS[compression]), "r|")
+    if compression in _DECOMPRESS_COMMANDS:
+        try:
+            return (_PipedFile(fileobj, _DECOMPRESS_COMMANDS[compression]), "r|")
+        except OSError:
+            pass
+    return (None, None)
+
+
+class _DecompressedFile:
+    """Read-only file object, which decompresses data of another file on the fly.
+       Output of decompressor is limited per call, so highly compressed data
+       doesn't blow up into huge buffers"""
+
+    CHUNK_SIZE = 65536
+    # Compressed data is fed in pieces of this size, if decompressor can't limit its output
+    INPUT_SIZE = 16384
+    # Maximum output per call for decompressors supporting max_length (zlib)
+    OUTPUT_SIZE = 262144
+
+    def __init__(self, fileobj, factory):
+        self.__fileobj = fileobj
+        self.__factory = factory
+        self.__obj = factory()
+        # Compressed data not fed to decompressor yet
+        self.__input = ""
+        # Decompressed data and position of its unread part
+        self.__pending = ""
+        self.__offset = 0
+        self.__eof = False
+
+    def __fill(self):
+        """Replaces consumed pending data with next piece of decompressed data"""
+        if not self.__input:
+            self.__input = self.__fileobj.read(self.CHUNK_SIZE)
+            if not self.__input:
+                self.__pending = ""
+                if hasattr(self.__obj, 'flush'):
+                    self.__pending = self.__obj.flush()
+                self.__offset = 0
+                self.__eof = True
+                return
+        if getattr(self.__obj, 'eof', False):
+            # Next concatenated stream starts exactly at chunk boundary
+            self.__obj = self.__factory()
+        if hasattr(self.__obj, 'unconsumed_tail'):
+            self.__pending = self.__obj.decompress(self.__input, self.OUTPUT_SIZE)
+            # At end of stream zlib reports rest of input in unused_data
+            # (and, in some versions, in unconsumed_tail as well)
+            rest = ""
+            if not self.__obj.unused_data:
+                rest = self.__obj.unconsumed_tail
+        else:
+            self.__pending = self.__obj.decompress(self.__input[:self.INPUT_SIZE])
+            rest = self.__input[self.INPUT_SIZE:]
+        self.__offset = 0
+        self.__input = getattr(self.__obj, 'unused_data', '') + rest
+        if getattr(self.__obj, 'unused_data', ''):
+            # Next concatenated stream starts
+            self.__obj = self.__factory()
+
+    def read(self, size=-1):
+        """Reads up to size bytes of decompressed data"""
+        result = []
+        while size != 0:
+            if self.__offset >= len(self.__pending):
+                if self.__eof:
+                    break
+                self.__fill()
+                continue
+            if size < 0:
+                end = len(self.__pending)
+            else:
+                end = min(len(self.__pending), self.__offset + size)
+                size -= end - self.__offset
+            if self.__offset == 0 and end == len(self.__pending):
+                result.append(self.__pending)
+            else:
+                result.append(self.__pending[self.__offset:end])
+            self.__offset = end
+        return "".join(result)
+
+    def close(self):
+        self.__pending = ""
+        self.__input = ""
+        self.__fileobj.close()
+
+
+class _PipedFile:
+    """Read-only file object, which decompresses data of another file with 
+       external command. Data is fed to command from separate thread"""
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, fileobj, command):
+        self.__fileobj = fileobj
+        self.__command = command[0]
+        self.__proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       close_fds=True)
+        self.__feeder = threading.Thread(target=self.__feed)
+        self.__feeder.setDaemon(True)
+        self.__feeder.start()
+
+    def __feed(self):
+        """Copies compressed data to command"""
+        try:
+            try:
+                while True:
+                    chunk = self.__fileobj.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.__proc.stdin.write(chunk)
+            except IOError:
+                # Command exited before reading everything
+                pass
+        finally:
+            try:
+                self.__proc.stdin.close()
+            except IOError:
+                pass
+
+    def read(self, size=-1):
+        """Reads up to size bytes of decompressed data"""
+        data = self.__proc.stdout.read(size)
+        if not data and size != 0:
+            self.__feeder.join()
+            if self.__proc.wait() != 0:
+                raise IOError("%s exited with status %d" % (self.__command, self.__proc.returncode))
+        return data
+
+    def close(self):
+        if self.__proc.poll() is None:
+            self.__proc.stdout.close()
+            try:
+                self.__proc.terminate()
+            except OSError:
+                pass
+        self.__feeder.join()
+        self.__proc.wait()
+        self.__fileobj.close()
+
+
+def _changelog_variations(fname):
+    """Return list of all possible changelog/news locations"""
+    formats = ['usr/doc/*/%s.gz',
+               'usr/share/doc/*/%s.gz',
+               'usr/doc/*/%s',
+               'usr/share/doc/*/%s']
+    return [fmt % fname for fmt in formats]
+
+_NEWS_FILENAMES = _changelog_variations('NEWS.Debian')
+_CHANGELOG_FILENAMES = _changelog_variations('changelog.Debian')
+_CHANGELOG_FILENAMES_NATIVE = _changelog_variations('changelog')
+
+def _changes_filenames(which):
+    """Returns patterns of changelog/news files to read for which"""
+    filenames = []
+    if which == 'both' or which == 'news':
+        filenames.extend(_NEWS_FILENAMES)
+    if which == 'both' or which == 'changelogs':
+        filenames.extend(_CHANGELOG_FILENAMES)
+        filenames.extend(_CHANGELOG_FILENAMES_NATIVE)
+    return filenames
+
+def _member_name(member):
+    """Returns name of tar member (or pattern) without leading './' """
+    if isinstance(member, tarfile.TarInfo):
+        member = member.name
+    while member.startswith("./"):
+        member = member[2:]
+    return member.rstrip("/")
+
+def _match_path(name, pattern):
+    """Matches name against shell pattern, wildcards don't match '/' """
+    return name.count("/") == pattern.count("/") and fnmatch(name, pattern)
+
+
+def _find_debs(paths):
+    """Returns list of .deb files in directory (searched recursively), 
+       matching glob pattern, or given list of files"""
+    if isinstance(paths, basestring):
+        if os.path.isdir(paths):
+            found = []
+            for (dirpath, dirnames, filenames) in os.walk(paths):
+                dirnames.sort()
+                found.extend([os.path.join(dirpath, fname) for fname in sorted(filenames)
+                              if fname.endswith(".deb") or fname.endswith(".udeb")])
+            return found
+        return sorted(glob.glob(paths))
+    return list(paths)
+
+
+def _scan_deb(args):
+    """Loads one package for scan_debs. Returns (path, package, error)"""
+    (path, getfiles, getchanges) = args
+    try:
+        package = DpkgDebPackage(path)
+        if getfiles or getchanges:
+            package.load(getfiles=getfiles, getchanges=getchanges)
+    except DpkgDebPackageException, err:
+        return (path, None, err)
+    except Exception, err:
+        return (path, None, DpkgDebPackageException("Unable to load %s: %s" % (path, err)))
+    # Logger is created lazily and can't be passed to other process
+    package.__dict__.pop('_logger', None)
+    return (path, package, None)
+
+
+def scan_debs(paths, processes=None, ordered=True, getfiles=False, getchanges=None, chunksize=1):
+    """Loads control and md5sums (and optionally contents and changes) of many
+       .deb files in pool of processes. Results are yielded as soon as they are ready.
+       paths -- directory (searched recursively), glob pattern or list of files
+       processes -- number of processes, None for number of CPUs, 1 to work in-process
+       ordered -- yield results in order of paths, otherwise in order of completion
+       getfiles, getchanges -- the same as for DpkgDebPackage.load
+       chunksize -- number of packages sent to process at once
+       Yields (path, DpkgDebPackage, None) for loaded packages and 
+       (path, None, DpkgDebPackageException) for packages which failed to load."""
+    tasks = [(path, getfiles, getchanges) for path in _find_debs(paths)]
+    if processes is None and multiprocessing is not None:
+        processes = multiprocessing.cpu_count()
+    if processes is None or processes <= 1 or multiprocessing is None or len(tasks) < 2:
+        for task in tasks:
+            yield _scan_deb(task)
+        return
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        if ordered:
+            results = pool.imap(_scan_deb, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(_scan_deb, tasks, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        # Does nothing more than join if all results were consumed
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,213 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# DpkgFileList.py
+#
+# This module implements compact list of files of Debian binary package
+#
+# Copyright (C) 2005,2006 Alexandr Kanevskiy
+#
+# Contact: Alexandr Kanevskiy <packages@bifh.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 2 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+# $Id$
+
+__revision__ = "r"+"$Revision$"[11:-2]
+__all__ = ['DpkgFileList', 'DpkgFileEntry']
+
+import time
+import array
+import tarfile
+from itertools import izip
+
+_TAR_TYPES = {
+    tarfile.DIRTYPE: "d",
+    tarfile.SYMTYPE: "l",
+    tarfile.LNKTYPE: "h",
+    tarfile.CHRTYPE: "c",
+    tarfile.BLKTYPE: "b",
+    tarfile.FIFOTYPE: "p",
+}
+
+
+def _path(name):
+    """Returns name of file without leading './' and trailing '/' """
+    while name.startswith("./"):
+        name = name[2:]
+    return name.rstrip("/")
+
+
+class DpkgFileEntry(object):
+    """Single file of package, as stored in data.tar"""
+    __slots__ = ('name', 'size', 'mode', 'mtime', 'type', 'linkname',
+                 'uname', 'gname', 'devmajor', 'devminor')
+
+    def __init__(self, name, size, mode, mtime, ftype, linkname="",
+                 uname="", gname="", devmajor=0, devminor=0):
+        self.name = name
+        self.size = size
+        self.mode = mode
+        self.mtime = mtime
+        # One of tarfile type flags
+        self.type = ftype
+        self.linkname = linkname
+        self.uname = uname
+        self.gname = gname
+        self.devmajor = devmajor
+        self.devminor = devminor
+
+    def __repr__(self):
+        return "<DpkgFileEntry %s>" % self.name
+
+    def path(self):
+        """Returns name of file without leading './' and trailing '/' """
+        return _path(self.name)
+
+    def isfile(self):
+        return self.type in tarfile.REGULAR_TYPES
+
+    def isdir(self):
+        return self.type == tarfile.DIRTYPE
+
+    def issym(self):
+        return self.type == tarfile.SYMTYPE
+
+    def islnk(self):
+        return self.type == tarfile.LNKTYPE
+
+    def isdev(self):
+        return self.type in (tarfile.CHRTYPE, tarfile.BLKTYPE, tarfile.FIFOTYPE)
+
+    def filemode(self):
+        """Returns 'ls -l' like mode string"""
+        mode = _TAR_TYPES.get(self.type, "-")
+        for (rbit, wbit, xbit, special, schar) in ((0400, 0200, 0100, 04000, "s"),
+                                                   (040, 020, 010, 02000, "s"),
+                                                   (04, 02, 01, 01000, "t")):
+            mode += (self.mode & rbit and "r" or "-")
+            mode += (self.mode & wbit and "w" or "-")
+            if self.mode & special:
+                mode += (self.mode & xbit and schar or schar.upper())
+            else:
+                mode += (self.mode & xbit and "x" or "-")
+        return mode
+
+    def ls(self):
+        """Returns description of file as list, in the same form as 'tar tvf' does"""
+        if self.type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            size = "%d,%d" % (self.devmajor, self.devminor)
+        else:
+            size = str(self.size)
+        mtime = time.localtime(self.mtime)
+        entry = [self.filemode(), "%s/%s" % (self.uname, self.gname), size,
+                 time.strftime("%Y-%m-%d", mtime), time.strftime("%H:%M", mtime), self.name]
+        if self.issym():
+            entry.extend(["->", self.linkname])
+        elif self.islnk():
+            entry.extend(["link", "to", self.linkname])
+        return entry
+
+
+class DpkgFileList(object):
+    """Compact list of files of package. Attributes are kept in parallel
+       arrays, DpkgFileEntry objects are created only on access"""
+
+    def __init__(self):
+        # Names as stored in archive, directories end with '/'
+        self.names = []
+        self.sizes = array.array('l')
+        self.modes = array.array('H')
+        self.mtimes = array.array('l')
+        self.types = array.array('c')
+        # Owner names are interned, so each is stored once
+        self.unames = []
+        self.gnames = []
+        # Sparse attributes: index -> link target, index -> (major, minor)
+        self.links = {}
+        self.devices = {}
+
+    def append_member(self, member):
+        """Appends file described by tarfile.TarInfo"""
+        name = member.name
+        if member.isdir() and not name.endswith("/"):
+            name += "/"
+        index = len(self.names)
+        self.names.append(name)
+        self.sizes.append(member.size)
+        self.modes.append(member.mode & 07777)
+        self.mtimes.append(int(member.mtime))
+        self.types.append(member.type)
+        self.unames.append(intern(member.uname or str(member.uid)))
+        self.gnames.append(intern(member.gname or str(member.gid)))
+        if member.issym() or member.islnk():
+            self.links[index] = member.linkname
+        if member.ischr() or member.isblk():
+            self.devices[index] = (member.devmajor, member.devminor)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        """Returns DpkgFileEntry for file with given index"""
+        if index < 0:
+            index += len(self.names)
+        (devmajor, devminor) = self.devices.get(index, (0, 0))
+        return DpkgFileEntry(self.names[index], self.sizes[index], self.modes[index],
+                             self.mtimes[index], self.types[index], self.links.get(index, ""),
+                             self.unames[index], self.gnames[index], devmajor, devminor)
+
+    def __iter__(self):
+        for index in xrange(len(self.names)):
+            yield self[index]
+
+    def raw(self):
+        """Returns list of files in the same form as 'tar tvf' does"""
+        return [entry.ls() for entry in self]
+
+    def paths(self):
+        """Returns names of files without leading './' and trailing '/' """
+        return [_path(name) for name in self.names]
+
+    def total_size(self):
+        """Returns total size of regular files"""
+        total = 0
+        for (size, ftype) in izip(self.sizes, self.types):
+            if ftype in tarfile.REGULAR_TYPES:
+                total += size
+        return total
+
+    def size_by_directory(self, depth=None):
+        """Returns dict directory -> total size of regular files below it.
+           Directories are named without './', '' is the root. If depth is
+           specified, only directories up to that depth are counted"""
+        totals = {}
+        # Ancestors of each seen directory, most of files share few directories
+        ancestors = {}
+        for (name, size, ftype) in izip(self.names, self.sizes, self.types):
+            if ftype not in tarfile.REGULAR_TYPES:
+                continue
+            dirname = _path(name).rpartition("/")[0]
+            dirs = ancestors.get(dirname)
+            if dirs is None:
+                parts = (dirname and dirname.split("/") or [])
+                if depth is not None:
+                    parts = parts[:depth]
+                dirs = ["/".join(parts[:count]) for count in range(len(parts) + 1)]
+                ancestors[dirname] = dirs
+            for directory in dirs:
+                totals[directory] = totals.get(directory, 0) + size
+        return totals
@@ -12,6 +12,7 @@ __author__ = "Scott James Remnant <scott@netsplit.com>"
 
 
 import re
+import threading
 
 
 # Regular expressions make validating things easy
@@ -22,6 +23,19 @@ valid_revision = re.compile(r'^[A-Za-z0-9+.~]+$')
 # Character comparison table for upstream and revision components
 cmp_table = "~ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-.:"
 
+# Maps characters of cmp_table to bytes, which sort in the same order as
+# characters do in deb_cmp_str(). "~" sorts before the end of the string,
+# which is marked by "\x02". Digits are left alone
+_cmp_trans = [chr(i) for i in range(256)]
+for _idx, _char in enumerate(cmp_table):
+    _cmp_trans[ord(_char)] = chr(0x40 + _idx)
+_cmp_trans[ord("~")] = "\x01"
+_cmp_trans = "".join(_cmp_trans)
+del _idx, _char
+
+# Splits translated version component into (non digits, digits) parts
+_cmp_part_re = re.compile(r'([^0-9]*)([0-9]*)')
+
 
 class VersionError(Exception):
     pass
@@ -57,8 +71,26 @@ class DpkgVersion(object):
      - epoch: Epoch
      - upstream: Upstream version
      - revision: Debian/local revision
+     - cmp_key: Tuple, which sorts in Debian order. Computed on first use,
+       sorted(versions, key=DpkgVersion.get_cmp_key) is much faster than
+       plain sorted(versions)
     """
 
+    # (epoch, upstream, revision, comparison key) last computed
+    _cmp_cache = None
+
+    def get_cmp_key(self):
+        """Return the key, which sorts versions in Debian order."""
+        cache = self._cmp_cache
+        if cache is None or cache[0] is not self.epoch or \
+                cache[1] is not self.upstream or cache[2] is not self.revision:
+            cache = self._cmp_cache = (self.epoch, self.upstream, self.revision,
+                                       (self.epoch or 0, deb_cmp_key(self.upstream),
+                                        deb_cmp_key(self.revision or "")))
+        return cache[3]
+
+    cmp_key = property(get_cmp_key)
+
     def __init__(self, ver):
         """Parse a string or number into the three components."""
         self.epoch = None
@@ -126,29 +158,13 @@ class DpkgVersion(object):
 
     def __cmp__(self, other):
         """Compare two Version classes."""
-        other = DpkgVersion(other)
-
-        # Compare epochs only if they are not equal.
-        if self.epoch != other.epoch:
-            # Special cases for braindead packages
-            sepoch = self.epoch
-            oepoch = other.epoch
-            if not sepoch:
-                sepoch = 0
-            if not oepoch:
-                oepoch = 0
-            result = cmp(sepoch, oepoch)
-            if result != 0:
-                return result
-
-        result = deb_cmp(self.upstream, other.upstream)
-        if result != 0:
-            return result
-        result = deb_cmp(self.revision or "", other.revision or "")
-        if result != 0:
-            return result
+        if not isinstance(other, DpkgVersion):
+            other = DpkgVersion(other)
+        return cmp(self.cmp_key, other.cmp_key)
 
-        return 0
+    def __hash__(self):
+        """Equal versions hash equally, like "1.0" and "1.00"."""
+        return hash(self.cmp_key)
 
     def is_native(self):
         native = False
@@ -157,6 +173,126 @@ class DpkgVersion(object):
         return native
 
 
+class _FrozenDpkgVersion(DpkgVersion):
+    """DpkgVersion shared through the version cache, which can't be changed."""
+
+    def __init__(self, ver):
+        DpkgVersion.__init__(self, ver)
+        self.get_cmp_key()
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get("_frozen"):
+            raise AttributeError("Cached version can't be changed")
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError("Cached version can't be changed")
+
+
+class _VersionCache(object):
+    """Thread safe LRU cache of parsed versions. Keeps VersionError for bad
+    versions as well."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # Links are [previous, next, key, value], root.next is the least recently used
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def get(self, ver):
+        """Return parsed version from the cache, parse it when missing."""
+        self.lock.acquire()
+        try:
+            link = self.links.get(ver)
+            if link is not None:
+                # Move to the most recently used end
+                (prev, nxt) = link[:2]
+                prev[1] = nxt
+                nxt[0] = prev
+                last = self.root[0]
+                last[1] = self.root[0] = link
+                link[0] = last
+                link[1] = self.root
+                self.hits += 1
+                value = link[3]
+            else:
+                self.misses += 1
+        finally:
+            self.lock.release()
+        if link is None:
+            try:
+                value = _FrozenDpkgVersion(ver)
+            except VersionError, err:
+                value = err
+            self.lock.acquire()
+            try:
+                if self.maxsize > 0 and ver not in self.links:
+                    last = self.root[0]
+                    link = last[1] = self.root[0] = self.links[ver] = [last, self.root, ver, value]
+                    self.__trim()
+            finally:
+                self.lock.release()
+        if isinstance(value, VersionError):
+            raise value
+        return value
+
+    def resize(self, maxsize):
+        self.lock.acquire()
+        try:
+            self.maxsize = maxsize
+            self.__trim()
+        finally:
+            self.lock.release()
+
+    def __trim(self):
+        """Drop least recently used entries over maxsize."""
+        while len(self.links) > max(self.maxsize, 0):
+            oldest = self.root[1]
+            self.root[1] = oldest[1]
+            oldest[1][0] = self.root
+            del self.links[oldest[2]]
+
+
+_version_cache = _VersionCache(65536)
+
+
+def cached_version(ver):
+    """Return DpkgVersion for ver, sharing parsed versions through a
+    process wide LRU cache. Returned objects can't be changed. Raises
+    VersionError for bad versions, just like DpkgVersion()."""
+    if isinstance(ver, DpkgVersion):
+        return ver
+    return _version_cache.get(ver)
+
+
+def set_version_cache_size(maxsize):
+    """Set number of versions kept by cached_version(), 0 disables caching."""
+    _version_cache.resize(maxsize)
+
+
+def version_cache_info():
+    """Return (hits, misses, maxsize, currsize) of cached_version() cache."""
+    return (_version_cache.hits, _version_cache.misses,
+            _version_cache.maxsize, len(_version_cache.links))
+
+
+def clear_version_cache():
+    """Forget all cached versions and reset counters."""
+    _version_cache.lock.acquire()
+    try:
+        _version_cache.clear()
+        _version_cache.hits = _version_cache.misses = 0
+    finally:
+        _version_cache.lock.release()
+
+
 def strcut(tmpstr, idx, accept):
     """Cut characters from str that are entirely in accept."""
     ret = ""
@@ -189,21 +325,27 @@ def deb_cmp_str(x, y):
     return 0
 
 
+def deb_cmp_key(tmpstr):
+    """Return the tuple, which compares like tmpstr does in deb_cmp().
+
+    Every (string, number) part contributes its translated string with an
+    end marker and its number. One more end marker closes the key: a longer
+    version goes on with a non empty string, which decides against the
+    padding of the shorter one."""
+    key = []
+    if isinstance(tmpstr, unicode):
+        tmpstr = str(tmpstr)
+    for (chars, digits) in _cmp_part_re.findall(tmpstr.translate(_cmp_trans)):
+        if chars or digits:
+            key.append(chars + "\x02")
+            key.append(digits and int(digits) or 0)
+    if not key:
+        # Empty string compares like a single empty part
+        key = ["\x02", 0]
+    key.append("\x02")
+    return tuple(key)
+
+
 def deb_cmp(x, y):
     """Implement the string comparison outlined by Debian policy."""
-    x_idx = y_idx = 0
-    while x_idx < len(x) or y_idx < len(y):
-        # Compare strings
-        (x_str, x_idx) = strcut(x, x_idx, cmp_table)
-        (y_str, y_idx) = strcut(y, y_idx, cmp_table)
-        result = deb_cmp_str(x_str, y_str)
-        if result != 0:
-            return result
-
-        # Compare numbers
-        (x_str, x_idx) = strcut(x, x_idx, "0123456789")
-        (y_str, y_idx) = strcut(y, y_idx, "0123456789")
-        result = cmp(int(x_str or "0"), int(y_str or "0"))
-        if result != 0:
-            return result
-    return 0
+    return cmp(deb_cmp_key(x), deb_cmp_key(y))
@@ -24,18 +24,39 @@
 from UserDict import UserDict
 
 
+class _Hole(object):
+    """Marks place of deleted key in order list"""
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<deleted>"
+
+    def __reduce__(self):
+        # Keep it a singleton across pickling and copying
+        return "_hole"
+
+_hole = _Hole()
+
+
 class OrderedDict(UserDict):
+    # Keys in insertion order. Deleted keys leave a hole behind, which keeps
+    # deletion O(1). Holes are squeezed out once they take up half of the list
     __order = []
+    # Key to position in __order. Only built by the first deletion
+    __index = None
+    __holes = 0
 
     def __init__(self, dictionary=None):
         UserDict.__init__(self)
         self.__order = []
+        self.__index = None
+        self.__holes = 0
         if dictionary is not None and dictionary.__class__ is not None:
             self.update(dictionary)
 
     def __cmp__(self, dictionary):
         if isinstance(dictionary, OrderedDict):
-            ret = cmp(self.__order, dictionary.__order)
+            ret = cmp(self.keys(), dictionary.keys())
             if not ret:
                 ret = UserDict.__cmp__(self, dictionary)
             return ret
@@ -43,17 +64,47 @@ class OrderedDict(UserDict):
             return UserDict.__cmp__(self, dictionary)
 
     def __setitem__(self, key, value):
-        if key not in self:
+        if key not in self.data:
+            if self.__index is not None:
+                self.__index[key] = len(self.__order)
             self.__order.append(key)
-        UserDict.__setitem__(self, key, value)
+        self.data[key] = value
 
     def __delitem__(self, key):
-        if key in self:
-            del self.__order[self.__order.index(key)]
-        UserDict.__delitem__(self, key)
+        del self.data[key]
+        if self.__index is None:
+            index = self.__index = {}
+            for pos, k in enumerate(self.__order):
+                if k is not _hole:
+                    index[k] = pos
+        self.__order[self.__index.pop(key)] = _hole
+        self.__holes += 1
+        if self.__holes * 2 > len(self.__order):
+            self.__order = self.keys()
+            self.__index = None
+            self.__holes = 0
+
+    def __iter__(self):
+        if self.__holes:
+            return (k for k in self.__order if k is not _hole)
+        return iter(self.__order)
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        data = self.data
+        for k in self:
+            yield data[k]
+
+    def iteritems(self):
+        data = self.data
+        for k in self:
+            yield (k, data[k])
 
     def clear(self):
         self.__order = []
+        self.__index = None
+        self.__holes = 0
         UserDict.clear(self)
 
     def copy(self):
@@ -63,16 +114,52 @@ class OrderedDict(UserDict):
         return copy.copy(self)
 
     def keys(self):
-        return self.__order
+        if self.__holes:
+            return [k for k in self.__order if k is not _hole]
+        return self.__order[:]
 
     def items(self):
-        return map(lambda x, self=self: (x, self.__getitem__(x)), self.__order)
+        keys = self.keys()
+        return zip(keys, map(self.data.__getitem__, keys))
 
     def values(self):
-        return map(lambda x, self=self: self.__getitem__(x), self.__order)
+        return map(self.data.__getitem__, self.keys())
+
+    def popitem(self):
+        if not self.data:
+            raise KeyError('popitem(): dictionary is empty')
+        key = self.keys()[-1]
+        value = self.data[key]
+        self.__delitem__(key)
+        return (key, value)
+
+    def pop(self, key, *args):
+        if key not in self.data:
+            return self.data.pop(key, *args)
+        value = self.data[key]
+        self.__delitem__(key)
+        return value
+
+    def update(self, dictionary=None, **kwargs):
+        if dictionary is not None:
+            for k, v in dictionary.items():
+                self.__setitem__(k, v)
+        for k, v in kwargs.items():
+            self.__setitem__(k, v)
 
-    def update(self, dictionary):
-        for k, v in dictionary.items():
+    def _load_items(self, items):
+        """Set (key, value) pairs from list at once. Much faster than
+        setting them one by one, when we're empty"""
+        if not self.data:
+            self.data.update(items)
+            if len(self.data) == len(items):
+                self.__order = [k for k, v in items]
+                self.__index = None
+                self.__holes = 0
+                return
+            # Duplicate keys. Start over slowly
+            self.data.clear()
+        for k, v in items:
             self.__setitem__(k, v)
 
 # vim:ts=4:sw=4:et:
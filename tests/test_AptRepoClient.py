@@ -0,0 +1,537 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import os
+import sys
+import random
+import gzip
+import difflib
+import shutil
+import hashlib
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from minideblib.AptRepoClient import AptRepoClient, AptRepoException, _MetadataCache, \
+    _StreamReader, _apply_ed_patch, AptRepoParagraph, LazyAptRepoParagraph, \
+    CompactAptRepoParagraph
+
+URL = "http://example.org/debian/dists/stable/main/binary-i386/Packages"
+BODY = "Package: foo\nVersion: 1.0\n\nPackage: bar\nVersion: 2.0\n"
+
+
+class StreamReaderCacheTest(unittest.TestCase):
+    """Data read through cache is stored only after it was verified"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='minideblib-test')
+        self.cache = _MetadataCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, True)
+
+    def __reader(self, checksum):
+        return _StreamReader(StringIO(BODY), URL, checksum=checksum, cache=self.cache,
+                             cache_fhdl=self.cache.writer(URL), headers={'ETag': '"1"'})
+
+    def __cached_files(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_verified_body_is_stored(self):
+        reader = self.__reader((hashlib.sha256(BODY).hexdigest(), len(BODY)))
+        self.assertEqual(reader.read(), BODY)
+        reader.close()
+        self.assertEqual(sorted([os.path.splitext(name)[1] for name in self.__cached_files()]),
+                         [".data", ".meta"])
+        self.assertEqual(self.cache.validators(URL), {'If-None-Match': '"1"'})
+
+    def test_bad_checksum_is_not_stored(self):
+        reader = self.__reader((hashlib.sha256("other").hexdigest(), len(BODY)))
+        self.assertRaises(AptRepoException, reader.read)
+        reader.close()
+        self.assertEqual(self.__cached_files(), [])
+        self.assertEqual(self.cache.validators(URL), {})
+
+    def __store(self, url, body, etag):
+        fhdl = self.cache.writer(url)
+        fhdl.write(body)
+        self.cache.commit(url, fhdl, {'ETag': etag})
+
+    def __cached_body(self, url):
+        fhdl = self.cache.open(url)
+        try:
+            return fhdl.read()
+        finally:
+            fhdl.close()
+
+    def test_body_and_validators_are_replaced_together(self):
+        self.__store(URL, BODY, '"1"')
+        self.__store(URL, "new body", '"2"')
+        self.assertEqual(len(self.__cached_files()), 2)
+        self.assertEqual(self.__cached_body(URL), "new body")
+        self.assertEqual(self.cache.validators(URL), {'If-None-Match': '"2"'})
+        # New body written, but not committed: old body is used with its validators
+        fhdl = self.cache.writer(URL)
+        fhdl.write("newer body")
+        fhdl.close()
+        self.assertEqual(self.__cached_body(URL), "new body")
+        self.assertEqual(self.cache.validators(URL), {'If-None-Match': '"2"'})
+        self.cache.prune("http://example.org/debian", [URL])
+        self.assertEqual(len(self.__cached_files()), 2)
+        self.assertEqual(self.__cached_body(URL), "new body")
+
+    def test_prune(self):
+        by_hash = "http://example.org/debian/dists/stable/main/binary-i386/by-hash/SHA256/"
+        other = "http://example.org/debian/dists/stable-updates/main/binary-i386/Packages"
+        for url in (URL, by_hash + "1", by_hash + "2", other):
+            self.__store(url, BODY, '"1"')
+        self.cache.store_index_copy(URL, BODY)
+        self.cache.store_index_copy(by_hash + "1", BODY)
+        self.cache.prune("http://example.org/debian/dists/stable", [URL, by_hash + "2"])
+        self.assertEqual(len(self.__cached_files()), 7)
+        for url in (URL, by_hash + "2", other):
+            self.assertEqual(self.__cached_body(url), BODY)
+        self.assertEqual(self.cache.validators(by_hash + "1"), {})
+        self.assertRaises(IOError, self.cache.open, by_hash + "1")
+        self.assertEqual(self.cache.index_copy(URL), BODY)
+        self.assertEqual(self.cache.index_copy(by_hash + "1"), None)
+
+    def test_bad_size_is_not_stored(self):
+        reader = self.__reader((hashlib.sha256(BODY).hexdigest(), len(BODY) + 1))
+        self.assertRaises(AptRepoException, list, reader)
+        reader.close()
+        self.assertEqual(self.__cached_files(), [])
+
+
+class ReleaseFileTest(unittest.TestCase):
+    """Indexes are loaded whatever checksums Release file of local repository lists"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='minideblib-test')
+        self.dist = os.path.join(self.root, "dists", "stable")
+        os.makedirs(os.path.join(self.dist, "main", "binary-i386"))
+        self.packages = os.path.join("main", "binary-i386", "Packages")
+        body = BODY.replace("\n\n", "\nArchitecture: i386\n\n") + "Architecture: i386\n"
+        fhdl = open(os.path.join(self.dist, self.packages), "w")
+        fhdl.write(body)
+        fhdl.close()
+        fhdl = gzip.open(os.path.join(self.dist, self.packages + ".gz"), "wb")
+        fhdl.write(body)
+        fhdl.close()
+        self.module = sys.modules[AptRepoClient.__module__]
+        self.urlopen = self.module._universal_urlopen
+
+    def tearDown(self):
+        self.module._universal_urlopen = self.urlopen
+        shutil.rmtree(self.root, True)
+
+    def __write_release(self, fields):
+        lines = ["Origin: test", "Suite: stable"]
+        for (field, algorithm) in fields:
+            lines.append("%s:" % field)
+            for suffix in (".gz", ""):
+                data = open(os.path.join(self.dist, self.packages + suffix), "rb").read()
+                lines.append(" %s %d %s" % (hashlib.new(algorithm, data).hexdigest(), len(data),
+                                            self.packages + suffix))
+        fhdl = open(os.path.join(self.dist, "Release"), "w")
+        fhdl.write("\n".join(lines) + "\n")
+        fhdl.close()
+
+    def __load(self, client=None):
+        if client is None:
+            client = AptRepoClient(arch=["i386"])
+        client.load_repos("deb file://%s stable main" % self.root, ignore_errors=False)
+        return client
+
+    def test_md5sum_only_release(self):
+        self.__write_release([("MD5Sum", "md5")])
+        client = self.__load()
+        self.assertEqual(client.get_best_binary_version("foo")[1], "1.0")
+        self.assertEqual(client.get_best_binary_version("bar")[1], "2.0")
+
+    def test_sha1_release(self):
+        self.__write_release([("MD5Sum", "md5"), ("SHA1", "sha1")])
+        self.assertEqual(self.__load().get_best_binary_version("bar")[1], "2.0")
+
+    def test_md5sum_mismatch(self):
+        self.__write_release([("MD5Sum", "md5")])
+        fhdl = gzip.open(os.path.join(self.dist, self.packages + ".gz"), "wb")
+        fhdl.write(BODY.replace("2.0", "3.0"))
+        fhdl.close()
+        self.assertRaises(AptRepoException, self.__load)
+
+    def test_index_not_listed(self):
+        fhdl = open(os.path.join(self.dist, "Release"), "w")
+        fhdl.write("Origin: test\nSuite: stable\nSHA256:\n %s 0 contrib/binary-i386/Packages\n"
+                   % hashlib.sha256("").hexdigest())
+        fhdl.close()
+        self.assertEqual(self.__load().get_best_binary_version("foo")[1], "1.0")
+
+    def test_missing_release_is_not_asked_again(self):
+        urls = []
+
+        def urlopen(url, *args):
+            urls.append(url)
+            return self.urlopen(url, *args)
+        self.module._universal_urlopen = urlopen
+        client = self.__load()
+        self.__load(client)
+        self.assertEqual(len([url for url in urls if url.endswith("Release")]), 2)
+        self.assertEqual(client.get_best_binary_version("foo")[1], "1.0")
+
+
+def write_index(path, body):
+    """Writes index and its .gz variant, creating directories"""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fhdl = open(path, "w")
+    fhdl.write(body)
+    fhdl.close()
+    fhdl = gzip.open(path + ".gz", "wb")
+    fhdl.write(body)
+    fhdl.close()
+
+
+class CompactParagraphTest(unittest.TestCase):
+    """CompactAptRepoParagraph reads and writes paragraphs like AptRepoParagraph"""
+
+    TEXT = ("Package: foo\nVersion: 1.0\nArchitecture: i386\n"
+            "Description: short\n long line\n .\n more\n")
+
+    def test_load_and_store(self):
+        plain = AptRepoParagraph()
+        plain.load(StringIO(self.TEXT))
+        compact = CompactAptRepoParagraph(StringIO(self.TEXT), base_url="http://example.org")
+        self.assertEqual(compact.items(), plain.items())
+        self.assertEqual(compact.base_url, "http://example.org")
+        (plain_out, compact_out) = (StringIO(), StringIO())
+        plain.store(plain_out)
+        compact.store(compact_out)
+        self.assertEqual(compact_out.getvalue(), plain_out.getvalue())
+        root = tempfile.mkdtemp(prefix='minideblib-test')
+        try:
+            path = os.path.join(root, "control")
+            compact.store(path)
+            self.assertEqual(open(path).read(), plain_out.getvalue())
+            self.assertEqual(os.listdir(root), ["control"])
+            fhdl = open(path, "w")
+            fhdl.write(self.TEXT)
+            fhdl.close()
+            self.assertEqual(CompactAptRepoParagraph(path).items(), plain.items())
+        finally:
+            shutil.rmtree(root, True)
+
+    def test_shapes_are_bounded(self):
+        module = sys.modules[CompactAptRepoParagraph.__module__]
+        paras = []
+        for num in range(module._COMPACT_SHAPES_MAX * 2):
+            para = CompactAptRepoParagraph()
+            para.load_text("Package: foo\nX-Field-%d: %d\n" % (num, num))
+            paras.append(para)
+            self.assertTrue(len(module._compact_shapes) <= module._COMPACT_SHAPES_MAX)
+        for (num, para) in enumerate(paras):
+            self.assertEqual(para.items(), [("package", "foo"), ("x-field-%d" % num, str(num))])
+        para = CompactAptRepoParagraph()
+        para.load_text("Package: bar\nX-Field-0: 0\n")
+        self.assertTrue(para._shape is module._compact_shape(("Package", "X-Field-0"), False))
+
+
+class SnapshotTest(unittest.TestCase):
+    """Snapshot gives back the same packages and maps, damaged ones are refused"""
+
+    BINARIES = ("Package: foo\nVersion: 1.0-1\nArchitecture: i386\nSource: foo-src (1.0)\n"
+                "MD5sum: %032x\nX-Mixed-Case: yes\nDescription: foo\n long\n .\n text\n\n"
+                "Package: bar\nVersion: 2.0\nArchitecture: all\nMD5sum: %032x\n"
+                "Description: bar\n" % (1, 2))
+    SOURCES = ("Package: foo-src\nBinary: foo\nVersion: 1.0\nDirectory: pool/f/foo-src\n"
+               "Files:\n %032x 10 foo-src_1.0.dsc\n %032x 20 foo-src_1.0.tar.gz\n" % (3, 4))
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='minideblib-test')
+        dist = os.path.join(self.root, "dists", "stable", "main")
+        write_index(os.path.join(dist, "binary-i386", "Packages"), self.BINARIES)
+        write_index(os.path.join(dist, "source", "Sources"), self.SOURCES)
+        self.repos = ["deb file://%s stable main" % self.root,
+                      "deb-src file://%s stable main" % self.root]
+        self.path = os.path.join(self.root, "snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.root, True)
+
+    def __client(self, paragraph_class=None, repos=None):
+        kwargs = {}
+        if paragraph_class is not None:
+            kwargs['paragraph_class'] = paragraph_class
+        return AptRepoClient(repos or self.repos, ["i386"], **kwargs)
+
+    def __saved(self, paragraph_class=None):
+        client = self.__client(paragraph_class)
+        client.load_repos()
+        client.make_source_to_binaries_map()
+        client.make_pkgid_map()
+        client.save_snapshot(self.path)
+        return client
+
+    def __contents(self, client):
+        packages = []
+        for pkgcache in (client.binaries, client.sources):
+            for cache_key in sorted(pkgcache):
+                for name in pkgcache[cache_key].keys():
+                    for pkg in pkgcache[cache_key][name]:
+                        packages.append((cache_key, pkg.items(), pkg.base_url,
+                                         sorted([(key, pkg.trueFieldCasing.get(key, key))
+                                                 for key in pkg.keys()])))
+        maps = []
+        for pkgmap in (client.source_to_binaries_map, client.pkgid_map):
+            maps.append(sorted([(key, [pkg['package'] for pkg in pkgs])
+                                for (key, pkgs) in pkgmap.items()]))
+        return (packages, maps)
+
+    def __undecoded(self, client):
+        return [(pkg['package'], pkg._undecoded_text() is not None)
+                for pkgcache in (client.binaries, client.sources)
+                for metadata in pkgcache.values() for name in metadata.keys()
+                for pkg in metadata[name]]
+
+    def test_lazy_packages_are_not_decoded(self):
+        client = self.__client(LazyAptRepoParagraph)
+        client.load_repos()
+        client.make_source_to_binaries_map()
+        client.make_pkgid_map()
+        client.get_binary_name_version("bar")[0].keys()
+        client.save_snapshot(self.path)
+        self.assertEqual(sorted(self.__undecoded(client)),
+                         [("bar", False), ("foo", True), ("foo-src", True)])
+        loaded = self.__client(LazyAptRepoParagraph)
+        self.assertTrue(loaded.load_snapshot(self.path))
+        self.assertEqual(sorted(self.__undecoded(loaded)),
+                         [("bar", True), ("foo", True), ("foo-src", True)])
+        self.assertEqual(self.__contents(loaded), self.__contents(client))
+
+    def test_round_trip(self):
+        for paragraph_class in (None, LazyAptRepoParagraph):
+            saved = self.__saved(paragraph_class)
+            client = self.__client(paragraph_class)
+            self.assertTrue(client.load_snapshot(self.path))
+            self.assertEqual(self.__contents(client), self.__contents(saved))
+            self.assertEqual(client.get_best_binary_version("foo"),
+                             saved.get_best_binary_version("foo"))
+            self.assertEqual(client.get_source_name_version("foo-src")[0]['files'],
+                             saved.get_source_name_version("foo-src")[0]['files'])
+
+    def test_refused_snapshots(self):
+        self.__saved()
+        client = self.__client(repos=self.repos[:1])
+        self.assertFalse(client.load_snapshot(self.path))
+        self.assertFalse(client.load_snapshot(self.path + ".missing"))
+        write_index(os.path.join(self.root, "dists", "stable", "main", "binary-i386",
+                                 "Packages"), self.BINARIES + "\nPackage: baz\nVersion: 1\n")
+        self.assertFalse(self.__client().load_snapshot(self.path))
+
+    def test_damaged_snapshots(self):
+        saved = self.__saved()
+        expected = self.__contents(saved)
+        data = open(self.path, "rb").read()
+        damaged = [data[:size] for size in range(len(data))]
+        rand = random.Random(1)
+        for num in range(300):
+            pos = rand.randrange(len(data))
+            damaged.append(data[:pos] + chr(rand.randrange(256)) + data[pos + 1:])
+        client = self.__client()
+        client.load_repos()
+        for content in damaged:
+            fhdl = open(self.path, "wb")
+            fhdl.write(content)
+            fhdl.close()
+            if not client.load_snapshot(self.path):
+                # Data loaded before is kept
+                self.assertEqual(self.__contents(client)[0], expected[0])
+            client.load_repos()
+
+
+def ed_script(old, new):
+    """Returns ed script, like "diff --ed" makes, turning list of lines old into new"""
+    commands = []
+    for (tag, old_start, old_end, new_start, new_end) in \
+            difflib.SequenceMatcher(None, old, new).get_opcodes():
+        lines = "".join(new[new_start:new_end]) + ".\n"
+        span = "%d" % (old_start + 1)
+        if old_end - old_start > 1:
+            span += ",%d" % old_end
+        if tag == 'insert':
+            commands.append("%da\n%s" % (old_start, lines))
+        elif tag == 'replace':
+            commands.append("%sc\n%s" % (span, lines))
+        elif tag == 'delete':
+            commands.append("%sd\n" % span)
+    # Later parts of file are edited first, so line numbers of earlier ones stay valid
+    commands.reverse()
+    return "".join(commands)
+
+
+class EdPatchTest(unittest.TestCase):
+    """_apply_ed_patch() applies ed scripts the way ed does"""
+
+    def __apply(self, text, patch):
+        lines = text.splitlines(True)
+        _apply_ed_patch(lines, patch)
+        return "".join(lines)
+
+    def test_commands(self):
+        text = "one\ntwo\nthree\nfour\n"
+        self.assertEqual(self.__apply(text, "2a\nnew\nnewer\n.\n"),
+                         "one\ntwo\nnew\nnewer\nthree\nfour\n")
+        self.assertEqual(self.__apply(text, "0a\nfirst\n.\n"), "first\n" + text)
+        self.assertEqual(self.__apply(text, "2,3c\nchanged\n.\n"), "one\nchanged\nfour\n")
+        self.assertEqual(self.__apply(text, "4c\n.\n"), "one\ntwo\nthree\n")
+        self.assertEqual(self.__apply(text, "4d\n1,2d\n"), "three\n")
+        self.assertEqual(self.__apply(text, ""), text)
+
+    def test_unsupported_commands(self):
+        for patch in ("1,2m3\n", "s/one/two/\n", "w\n", "1x\n"):
+            self.assertRaises(ValueError, self.__apply, "one\ntwo\nthree\n", patch)
+
+    def test_random_against_difflib(self):
+        rand = random.Random(1)
+        for num in range(300):
+            old = ["line %d\n" % rand.randrange(8) for idx in range(rand.randrange(12))]
+            new = ["line %d\n" % rand.randrange(8) for idx in range(rand.randrange(12))]
+            lines = old[:]
+            _apply_ed_patch(lines, ed_script(old, new))
+            self.assertEqual(lines, new)
+
+
+class PdiffTest(unittest.TestCase):
+    """Cached index is brought up to date with diffs, full index is fetched when they fail"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='minideblib-test')
+        self.cache_dir = os.path.join(self.root, "cache")
+        self.dist = os.path.join(self.root, "dists", "stable")
+        self.packages = os.path.join("main", "binary-i386", "Packages")
+        os.makedirs(os.path.join(self.dist, self.packages + ".diff"))
+        self.texts = []
+        self.history = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root, True)
+
+    def __text(self, state):
+        stanzas = []
+        for num in range(20):
+            stanzas.append("Package: pkg%d\nVersion: 1.%d\nArchitecture: i386\n"
+                           % (num, num < state * 3 and state or 0))
+        stanzas.append("Package: state%d\nVersion: 1.0\nArchitecture: i386\n" % state)
+        return "\n".join(stanzas)
+
+    def __publish(self, state):
+        """Writes index of repository at state, with diffs from every state before"""
+        text = self.__text(state)
+        if self.texts:
+            name = "T-%d" % state
+            patch = ed_script(self.texts[-1].splitlines(True), text.splitlines(True))
+            write_index(os.path.join(self.dist, self.packages + ".diff", name), patch)
+            self.history.append((self.texts[-1], name, patch))
+        self.texts.append(text)
+        write_index(os.path.join(self.dist, self.packages), text)
+        sha = lambda data: (hashlib.sha256(data).hexdigest(), len(data))
+        lines = ["SHA256-Current: %s %d" % sha(text)]
+        for (field, data) in (("SHA256-History", lambda old, name, patch: old),
+                              ("SHA256-Patches", lambda old, name, patch: patch)):
+            lines.append(field + ":")
+            lines += [" %s %d %s" % (sha(data(*entry)) + (entry[1],)) for entry in self.history]
+        lines.append("SHA256-Download:")
+        for (old, name, patch) in self.history:
+            path = os.path.join(self.dist, self.packages + ".diff", name + ".gz")
+            lines.append(" %s %d %s.gz" % (sha(open(path, "rb").read()) + (name,)))
+        fhdl = open(os.path.join(self.dist, self.packages + ".diff", "Index"), "w")
+        fhdl.write("\n".join(lines) + "\n")
+        fhdl.close()
+        lines = ["Origin: test", "Suite: stable", "SHA256:"]
+        for path in (self.packages, self.packages + ".gz", self.packages + ".diff/Index"):
+            lines.append(" %s %d %s" % (sha(open(os.path.join(self.dist, path), "rb").read()) +
+                                        (path,)))
+        fhdl = open(os.path.join(self.dist, "Release"), "w")
+        fhdl.write("\n".join(lines) + "\n")
+        fhdl.close()
+
+    def __load(self):
+        client = AptRepoClient(["deb file://%s stable main" % self.root], arch=["i386"],
+                               cache_dir=self.cache_dir)
+        client.load_repos(ignore_errors=False)
+        return client
+
+    def __hide_full_index(self):
+        for suffix in ("", ".gz"):
+            os.rename(os.path.join(self.dist, self.packages + suffix),
+                      os.path.join(self.root, "Packages" + suffix))
+
+    def __assert_state(self, client, state):
+        self.assertEqual(client.get_available_binary_versions("pkg0"),
+                         [(("file://%s" % self.root, "stable", "main"), "1.%d" % state)])
+        self.assertEqual(sorted(client.get_available_binaries()),
+                         sorted(["pkg%d" % num for num in range(20)] + ["state%d" % state]))
+
+    def test_diffs_are_applied(self):
+        self.__publish(0)
+        self.__assert_state(self.__load(), 0)
+        self.__publish(1)
+        self.__publish(2)
+        self.__hide_full_index()
+        # Only cached copy and two diffs are left to load from
+        self.__assert_state(self.__load(), 2)
+        self.__publish(3)
+        self.__hide_full_index()
+        self.__assert_state(self.__load(), 3)
+
+    def test_no_cached_copy(self):
+        self.__publish(0)
+        self.__publish(1)
+        self.__assert_state(self.__load(), 1)
+
+    def test_damaged_cached_copy(self):
+        self.__publish(0)
+        self.__load()
+        self.__publish(1)
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".index"):
+                fhdl = open(os.path.join(self.cache_dir, name), "a")
+                fhdl.write("Package: junk\n")
+                fhdl.close()
+        self.__assert_state(self.__load(), 1)
+        # Full index replaced damaged copy, so diffs are used again
+        self.__publish(2)
+        self.__hide_full_index()
+        self.__assert_state(self.__load(), 2)
+
+    def test_broken_diffs(self):
+        self.__publish(0)
+        self.__load()
+        self.__publish(1)
+        self.__publish(2)
+        path = os.path.join(self.dist, self.packages + ".diff", "T-2.gz")
+        fhdl = gzip.open(path, "wb")
+        fhdl.write("1d\n")
+        fhdl.close()
+        self.__assert_state(self.__load(), 2)
+
+    def test_missing_diff(self):
+        self.__publish(0)
+        self.__load()
+        self.__publish(1)
+        self.__publish(2)
+        os.remove(os.path.join(self.dist, self.packages + ".diff", "T-1.gz"))
+        self.__assert_state(self.__load(), 2)
+
+    def test_cached_copy_too_old(self):
+        self.__publish(0)
+        self.__load()
+        self.__publish(1)
+        self.history = []
+        self.__publish(2)
+        self.__assert_state(self.__load(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
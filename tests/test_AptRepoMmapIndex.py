@@ -0,0 +1,171 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from minideblib.AptRepoClient import AptRepoClient, AptRepoParagraph, LazyAptRepoParagraph
+from minideblib.AptRepoMmapIndex import AptRepoMmapIndex, write_mmap_index
+
+
+def write_index(path, body):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fhdl = gzip.open(path, "wb")
+    fhdl.write(body)
+    fhdl.close()
+
+
+def binary(name, version, where, arch="i386"):
+    return ("Package: %s\nVersion: %s\nArchitecture: %s\nSource: src-%s\n"
+            "Description: %s from %s\n multi-line\n" % (name, version, arch, name, name, where))
+
+
+def source(name, version, where):
+    return ("Package: %s\nBinary: %s\nVersion: %s\nDirectory: pool/%s\nFiles:\n"
+            " 0123 10 %s_%s.dsc\n" % (name, name, version, where, name, version))
+
+
+class MmapIndexTest(unittest.TestCase):
+    """AptRepoMmapIndex answers the same as AptRepoClient it was written from"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='minideblib-test')
+        self.base_url = "file://%s" % self.root
+        for (dist, sections) in (("stable", ["main", "contrib"]), ("testing", ["main"])):
+            for section in sections:
+                where = "%s/%s" % (dist, section)
+                stanzas = []
+                for num in range(20):
+                    # Same versions in every repository, to check tie-breaking
+                    stanzas.append(binary("pkg%d" % num, "1.%d-1" % (num % 3), where))
+                    if num % 4 == 0:
+                        stanzas.append(binary("pkg%d" % num, "1.%d-1" % (num % 3),
+                                              where + " again", "all"))
+                stanzas.append(binary("only-%s-%s" % (dist, section), "0.1", where))
+                stanzas.append(binary("newest", "2.%d~rc%d" % (len(where) % 3, num), where))
+                stanzas.append(binary("other-arch", "1.0", where, "sparc"))
+                write_index(os.path.join(self.root, "dists", dist, section, "binary-i386",
+                                         "Packages.gz"), "\n".join(stanzas))
+        write_index(os.path.join(self.root, "dists", "stable", "main", "source", "Sources.gz"),
+                    "\n".join([source("src-pkg%d" % num, "1.%d-1" % (num % 3), "stable/main")
+                               for num in range(10)] +
+                              [source("src-pkg1", "0.9-1", "stable/main")]))
+        self.path = os.path.join(self.root, "index.mm")
+        self.index = None
+
+    def tearDown(self):
+        if self.index is not None:
+            self.index.close()
+        shutil.rmtree(self.root, True)
+
+    def __load(self, paragraph_class=LazyAptRepoParagraph):
+        client = AptRepoClient(["deb %s stable main contrib" % self.base_url,
+                                "deb %s testing main" % self.base_url,
+                                "deb-src %s stable main" % self.base_url],
+                               arch=["i386"], paragraph_class=paragraph_class)
+        client.load_repos()
+        write_mmap_index(client, self.path)
+        self.index = AptRepoMmapIndex(self.path, paragraph_class)
+        return client
+
+    def __filters(self):
+        return [None, self.base_url, [(self.base_url, "testing", None)],
+                (self.base_url, None, "contrib"), (self.base_url, "stable", "main"),
+                "http://elsewhere.example.org/debian"]
+
+    def __dump(self, pkgs):
+        return [(pkg.items(), pkg.base_url) for pkg in pkgs]
+
+    def test_repos(self):
+        client = self.__load()
+        self.assertEqual(sorted(self.index.get_available_binary_repos()),
+                         sorted(client.get_available_binary_repos()))
+        self.assertEqual(sorted(self.index.get_available_source_repos()),
+                         sorted(client.get_available_source_repos()))
+
+    def test_binaries(self):
+        client = self.__load()
+        names = client.get_available_binaries() + ["missing"]
+        for base_url in self.__filters():
+            self.assertEqual(sorted(self.index.get_available_binaries(base_url)),
+                             sorted(client.get_available_binaries(base_url)))
+            self.assertEqual(self.index.get_best_binary_versions(names, base_url),
+                             client.get_best_binary_versions(names, base_url))
+            for name in names:
+                self.assertEqual(self.index.get_best_binary_version(name, base_url),
+                                 client.get_best_binary_version(name, base_url))
+                versions = client.get_available_binary_versions(name, base_url)
+                self.assertEqual(self.index.get_available_binary_versions(name, base_url),
+                                 versions)
+                for version in [None, "9.9"] + [version for (repo, version) in versions]:
+                    self.assertEqual(
+                        self.__dump(self.index.get_binary_name_version(name, version, base_url)),
+                        self.__dump(client.get_binary_name_version(name, version, base_url)))
+            requests = [(name, None) for name in names] + [("pkg1", "1.1-1"), ("pkg2", "0")]
+            mapped = self.index.get_binary_name_versions(requests, base_url)
+            loaded = client.get_binary_name_versions(requests, base_url)
+            self.assertEqual(sorted(mapped.keys()), sorted(loaded.keys()))
+            for key in loaded:
+                self.assertEqual(self.__dump(mapped[key]), self.__dump(loaded[key]))
+
+    def test_sources(self):
+        client = self.__load()
+        names = client.get_available_sources() + ["missing"]
+        for base_url in self.__filters():
+            self.assertEqual(sorted(self.index.get_available_sources(base_url)),
+                             sorted(client.get_available_sources(base_url)))
+            self.assertEqual(self.index.get_best_source_versions(names, base_url),
+                             client.get_best_source_versions(names, base_url))
+            for name in names:
+                self.assertEqual(self.index.get_best_source_version(name, base_url),
+                                 client.get_best_source_version(name, base_url))
+                self.assertEqual(self.index.get_available_source_versions(name, base_url),
+                                 client.get_available_source_versions(name, base_url))
+                self.assertEqual(
+                    self.__dump(self.index.get_source_name_version(name, None, base_url)),
+                    self.__dump(client.get_source_name_version(name, None, base_url)))
+
+    def test_ties_follow_load_order(self):
+        client = self.__load()
+        self.assertEqual(self.index.get_best_binary_version("pkg3"),
+                         ((self.base_url, "stable", "main"), "1.0-1"))
+        self.assertEqual([pkg['description'][0]
+                          for pkg in self.index.get_binary_name_version("pkg4")],
+                         ["pkg4 from stable/main", "pkg4 from stable/main again",
+                          "pkg4 from stable/contrib", "pkg4 from stable/contrib again",
+                          "pkg4 from testing/main", "pkg4 from testing/main again"])
+        self.assertEqual(self.__dump(self.index.get_binary_name_version("pkg4")),
+                         self.__dump(client.get_binary_name_version("pkg4")))
+
+    def test_lazy_packages_are_not_decoded(self):
+        client = self.__load()
+        for pkgcache in (client.binaries, client.sources):
+            for metadata in pkgcache.values():
+                for name in metadata.keys():
+                    for pkg in metadata[name]:
+                        self.assertNotEqual(pkg._undecoded_text(), None)
+
+    def test_plain_paragraphs(self):
+        client = self.__load(AptRepoParagraph)
+        for pkg in self.index.get_binary_name_version("newest"):
+            self.assertTrue(isinstance(pkg, AptRepoParagraph))
+        self.assertEqual(self.__dump(self.index.get_binary_name_version("newest")),
+                         self.__dump(client.get_binary_name_version("newest")))
+
+    def test_not_an_index(self):
+        fhdl = open(self.path, "wb")
+        fhdl.write("Package: not an index\n")
+        fhdl.close()
+        self.assertRaises(ValueError, AptRepoMmapIndex, self.path)
+        fhdl = open(self.path, "wb")
+        fhdl.close()
+        self.assertRaises((ValueError, EnvironmentError), AptRepoMmapIndex, self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from minideblib.AptRepoClient import AptRepoClient
+from minideblib.AptRepoSqliteClient import AptRepoSqliteClient
+
+SECTIONS = ["main", "contrib", "non-free", "extra", "games", "local"]
+
+
+def stanza(name, version, section):
+    return ("Package: %s\nVersion: %s\nArchitecture: i386\nDescription: %s from %s\n"
+            % (name, version, name, section))
+
+
+class SqliteParityTest(unittest.TestCase):
+    """AptRepoSqliteClient answers the same as AptRepoClient, including ties"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='minideblib-test')
+        for section in SECTIONS:
+            stanzas = []
+            for num in range(30):
+                # Every section has the same versions of most packages
+                stanzas.append(stanza("pkg%d" % num, "1.%d-1" % (num % 4), section))
+                if num % 5 == 0:
+                    stanzas.append(stanza("pkg%d" % num, "1.%d-1" % (num % 4), section + "-dup"))
+            stanzas.append(stanza("only-%s" % section, "1.0", section))
+            stanzas.append(stanza("newest", "2.%d" % (len(section) % 3), section))
+            self.__write(section, "\n".join(stanzas))
+        self.repos = ["deb file://%s stable %s" % (self.root, " ".join(SECTIONS))]
+
+    def tearDown(self):
+        shutil.rmtree(self.root, True)
+
+    def __write(self, section, body):
+        dirname = os.path.join(self.root, "dists", "stable", section, "binary-i386")
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fhdl = gzip.open(os.path.join(dirname, "Packages.gz"), "wb")
+        fhdl.write(body)
+        fhdl.close()
+
+    def __clients(self):
+        client = AptRepoClient(self.repos, arch=["i386"])
+        client.load_repos()
+        sqlite = AptRepoSqliteClient(self.repos, arch=["i386"])
+        sqlite.load_repos()
+        return (client, sqlite)
+
+    def __names(self):
+        return ["pkg%d" % num for num in range(30)] + \
+            ["only-%s" % section for section in SECTIONS] + ["newest", "missing"]
+
+    def __assert_same(self, client, sqlite):
+        names = self.__names()
+        self.assertEqual(client.get_best_binary_versions(names),
+                         sqlite.get_best_binary_versions(names))
+        for name in names:
+            self.assertEqual(client.get_best_binary_version(name),
+                             sqlite.get_best_binary_version(name))
+            self.assertEqual([(pkg['package'], pkg['version'], pkg['description'])
+                              for pkg in client.get_binary_name_version(name)],
+                             [(pkg['package'], pkg['version'], pkg['description'])
+                              for pkg in sqlite.get_binary_name_version(name)])
+            self.assertEqual(client.get_available_binary_versions(name),
+                             sqlite.get_available_binary_versions(name))
+
+    def test_ties_follow_load_order(self):
+        (client, sqlite) = self.__clients()
+        self.__assert_same(client, sqlite)
+        for num in range(30):
+            self.assertEqual(client.get_best_binary_version("pkg%d" % num)[0],
+                             ("file://%s" % self.root, "stable", "main"))
+        self.assertEqual([pkg['description'] for pkg in client.get_binary_name_version("pkg5")],
+                         ["pkg5 from %s%s" % (section, suffix) for section in SECTIONS
+                          for suffix in ("", "-dup")])
+
+    def test_reload_without_clear(self):
+        (client, sqlite) = self.__clients()
+        self.__write("contrib", stanza("pkg1", "1.1-1", "contrib") + "\n" +
+                     stanza("pkg7", "9.0", "contrib"))
+        for loaded in (client, sqlite):
+            loaded.load_repos(clear=False)
+        self.__assert_same(client, sqlite)
+        self.assertEqual(len(client.get_binary_name_version("pkg1")), len(SECTIONS))
+        self.assertEqual(client.get_best_binary_version("pkg7"),
+                         (("file://%s" % self.root, "stable", "contrib"), "9.0"))
+        self.assertEqual(sqlite.query("SELECT COUNT(*) FROM packages WHERE package = 'pkg0'"),
+                         [(len(SECTIONS) * 2 - 2,)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import zlib
+import gzip
+import unittest
+from cStringIO import StringIO
+
+from minideblib.DpkgDebPackage import _DecompressedFile
+
+
+def gzipped(data):
+    output = StringIO()
+    fhdl = gzip.GzipFile(fileobj=output, mode="wb")
+    fhdl.write(data)
+    fhdl.close()
+    return output.getvalue()
+
+
+def gzip_factory():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class _PlainDecompressor(object):
+    """zlib decompressor without max_length support, like lzma or zstandard ones"""
+    def __init__(self):
+        self.__obj = gzip_factory()
+
+    def decompress(self, data):
+        return self.__obj.decompress(data)
+
+    def flush(self):
+        return self.__obj.flush()
+
+    unused_data = property(lambda self: self.__obj.unused_data)
+
+
+class DecompressedFileTest(unittest.TestCase):
+    """Streaming decompression of .deb sections"""
+
+    DATA = "".join(["line %d of highly compressible data\n" % num for num in range(50000)]) + "x" * 3000000
+
+    def __read_all(self, fhdl, size):
+        chunks = []
+        while True:
+            chunk = fhdl.read(size)
+            if not chunk:
+                return "".join(chunks)
+            self.assertTrue(len(chunk) <= size)
+            chunks.append(chunk)
+
+    def test_small_reads(self):
+        for factory in (gzip_factory, _PlainDecompressor):
+            fhdl = _DecompressedFile(StringIO(gzipped(self.DATA)), factory)
+            self.assertEqual(self.__read_all(fhdl, 10240), self.DATA)
+
+    def test_concatenated_streams(self):
+        for factory in (gzip_factory, _PlainDecompressor):
+            fhdl = _DecompressedFile(StringIO(gzipped(self.DATA) + gzipped("tail")), factory)
+            self.assertEqual(self.__read_all(fhdl, 7777), self.DATA + "tail")
+
+    def test_read_everything(self):
+        fhdl = _DecompressedFile(StringIO(gzipped(self.DATA)), gzip_factory)
+        self.assertEqual(fhdl.read(5), self.DATA[:5])
+        self.assertEqual(fhdl.read(), self.DATA[5:])
+        self.assertEqual(fhdl.read(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
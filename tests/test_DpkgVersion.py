@@ -0,0 +1,93 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import random
+import unittest
+
+from minideblib.DpkgVersion import DpkgVersion, deb_cmp, deb_cmp_key, deb_cmp_str, strcut, \
+    cmp_table
+
+
+def reference_cmp(x, y):
+    """deb_cmp() as it was before it used deb_cmp_key(), part by part"""
+    x_idx = y_idx = 0
+    while x_idx < len(x) or y_idx < len(y):
+        (x_str, x_idx) = strcut(x, x_idx, cmp_table)
+        (y_str, y_idx) = strcut(y, y_idx, cmp_table)
+        result = deb_cmp_str(x_str, y_str)
+        if result != 0:
+            return result
+        (x_str, x_idx) = strcut(x, x_idx, "0123456789")
+        (y_str, y_idx) = strcut(y, y_idx, "0123456789")
+        result = cmp(int(x_str or "0"), int(y_str or "0"))
+        if result != 0:
+            return result
+    return 0
+
+
+class DebCmpKeyTest(unittest.TestCase):
+    """deb_cmp_key() sorts version parts the same way as comparing them part by part"""
+
+    def test_policy_order(self):
+        # Example from Debian policy, ascending
+        ordered = ["~~", "~~a", "~", "", "a"]
+        for (idx, smaller) in enumerate(ordered):
+            for bigger in ordered[idx + 1:]:
+                self.assertTrue(deb_cmp_key(smaller) < deb_cmp_key(bigger), (smaller, bigger))
+                self.assertEqual(deb_cmp(smaller, bigger), -1)
+                self.assertEqual(deb_cmp(bigger, smaller), 1)
+
+    def test_sorts_like_reference(self):
+        parts = ["0", "0~", "0.0", "00.1", "1~rc1", "1", "1.0~", "1.0", "1.00a", "1.0a",
+                 "1.0a~", "1.0b", "1.0+", "1.0-", "1.0.", "1.0:", "1.1", "1.9", "1.10", "1a",
+                 "1a.1", "1b", "1+dfsg", "1.2.3", "2", "Z", "z", "+", "~1"]
+        random.Random(3).shuffle(parts)
+        self.assertEqual(sorted(parts, key=deb_cmp_key), sorted(parts, cmp=reference_cmp))
+
+    def test_equal_numbers(self):
+        self.assertEqual(deb_cmp("1.01", "1.1"), 0)
+        self.assertEqual(deb_cmp_key("1.01"), deb_cmp_key("1.001"))
+        self.assertEqual(deb_cmp("", "0"), 0)
+
+    def test_random_against_reference(self):
+        rand = random.Random(1)
+        alphabet = "0123456789~.+-:aZ"
+        strings = ["".join([rand.choice(alphabet) for idx in range(rand.randint(0, 8))])
+                   for num in range(400)]
+        for num in range(20000):
+            (x, y) = (rand.choice(strings), rand.choice(strings))
+            expected = reference_cmp(x, y)
+            self.assertEqual(cmp(deb_cmp_key(x), deb_cmp_key(y)), expected, (x, y))
+            self.assertEqual(deb_cmp(x, y), expected, (x, y))
+
+    def test_sorting(self):
+        rand = random.Random(2)
+        versions = ["1.0-1", "1:0.9", "1.0-1~bpo1", "1.0", "0.9-10", "0.9-9", "1.0-1+b1",
+                    "2:0", "1.0~rc1-1", "1.0-1.1"]
+        shuffled = versions[:]
+        rand.shuffle(shuffled)
+        expected = sorted(shuffled, cmp=lambda x, y: cmp(DpkgVersion(x), DpkgVersion(y)))
+        self.assertEqual([str(version) for version in
+                          sorted([DpkgVersion(version) for version in shuffled],
+                                 key=DpkgVersion.get_cmp_key)], expected)
+        self.assertEqual(expected, ["0.9-9", "0.9-10", "1.0~rc1-1", "1.0", "1.0-1~bpo1",
+                                    "1.0-1", "1.0-1+b1", "1.0-1.1", "1:0.9", "2:0"])
+
+    def test_key_follows_changed_fields(self):
+        version = DpkgVersion("1.0-1")
+        key = version.cmp_key
+        version.revision = "2"
+        self.assertNotEqual(version.cmp_key, key)
+        self.assertTrue(version > "1.0-1")
+        version.epoch = 1
+        self.assertTrue(version > "0:9.0")
+
+    def test_equal_versions_hash_equally(self):
+        self.assertEqual(DpkgVersion("1.0"), DpkgVersion("1.00"))
+        self.assertEqual(hash(DpkgVersion("1.0")), hash(DpkgVersion("1.00")))
+        self.assertEqual(DpkgVersion("0:1.0"), DpkgVersion("1.0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# bench_ordereddict.py
+#
+# Compares minideblib.OrderedDict with the list based implementation it
+# replaced (kept below as ListOrderedDict) on deletion-heavy and
+# iteration-heavy workloads. Before timing, both are run through the same
+# random operations and must end up with the same keys in the same order.
+#
+# Usage: python tools/bench_ordereddict.py [-n KEYS] [-i ITERATIONS] [-r REPEAT]
+#
+# $Id$
+
+import os
+import sys
+import time
+import random
+from optparse import OptionParser
+from UserDict import UserDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from minideblib.OrderedDict import OrderedDict
+
+
+class ListOrderedDict(UserDict):
+    """OrderedDict as it was before, order is kept in a list"""
+
+    def __init__(self, dictionary=None):
+        UserDict.__init__(self)
+        self.__order = []
+        if dictionary is not None:
+            self.update(dictionary)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.__order.append(key)
+        UserDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key in self:
+            del self.__order[self.__order.index(key)]
+        UserDict.__delitem__(self, key)
+
+    def keys(self):
+        return self.__order
+
+    def items(self):
+        return map(lambda x, self=self: (x, self.__getitem__(x)), self.__order)
+
+    def values(self):
+        return map(lambda x, self=self: self.__getitem__(x), self.__order)
+
+    def update(self, dictionary):
+        for k, v in dictionary.items():
+            self.__setitem__(k, v)
+
+
+def check_same_order(trials):
+    """Runs random inserts and deletes on both classes, compares results"""
+    rand = random.Random(1)
+    for trial in xrange(trials):
+        (old, new) = (ListOrderedDict(), OrderedDict())
+        for step in xrange(200):
+            key = rand.randint(0, 40)
+            if rand.random() < 0.6:
+                old[key] = new[key] = step
+            elif key in old:
+                del old[key]
+                del new[key]
+        if old.keys() != new.keys() or old.items() != new.items() or list(new) != new.keys():
+            raise AssertionError("Different order after trial %d" % trial)
+
+
+def delete_from_end(cls, count):
+    mapping = cls()
+    for key in xrange(count):
+        mapping[key] = key
+    for key in xrange(count - 1, -1, -2):
+        del mapping[key]
+
+
+def delete_from_start(cls, count):
+    mapping = cls()
+    for key in xrange(count):
+        mapping[key] = key
+    for key in xrange(0, count, 2):
+        del mapping[key]
+
+
+def delete_random(cls, count):
+    keys = range(count)
+    random.Random(2).shuffle(keys)
+    mapping = cls()
+    for key in xrange(count):
+        mapping[key] = key
+    for key in keys:
+        del mapping[key]
+
+
+def paragraph_like(cls):
+    """Returns mapping with 20 fields, like a package paragraph"""
+    mapping = cls()
+    for num in xrange(20):
+        mapping["field%d" % num] = "value%d" % num
+    return mapping
+
+
+def iterate_items(cls, count):
+    mapping = paragraph_like(cls)
+    for num in xrange(count):
+        for (key, value) in mapping.items():
+            pass
+
+
+def keys_and_values(cls, count):
+    mapping = paragraph_like(cls)
+    for num in xrange(count):
+        mapping.keys()
+        mapping.values()
+
+
+def iterate_iteritems(cls, count):
+    mapping = paragraph_like(cls)
+    if cls is ListOrderedDict:
+        # Its iteritems() comes from UserDict and isn't ordered, items() is the ordered one
+        items = mapping.items
+    else:
+        items = mapping.iteritems
+    for num in xrange(count):
+        for (key, value) in items():
+            pass
+
+
+def bench(func, cls, count, repeat):
+    """Returns the best time of repeat runs"""
+    best = None
+    for idx in range(repeat):
+        stt = time.time()
+        func(cls, count)
+        spent = time.time() - stt
+        if best is None or spent < best:
+            best = spent
+    return best
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--keys", type="int", default=20000,
+                      help="keys of deletion workloads [%default]")
+    parser.add_option("-i", "--iterations", type="int", default=100000,
+                      help="passes of iteration workloads [%default]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="runs of each workload, the best one counts [%default]")
+    (options, args) = parser.parse_args()
+
+    check_same_order(300)
+    print "%-40s %10s %10s" % ("workload", "list", "current")
+    for (name, func, count) in (
+            ("insert %d, delete half from end" % options.keys, delete_from_end, options.keys),
+            ("insert %d, delete half from start" % options.keys, delete_from_start, options.keys),
+            ("insert %d, delete all randomly" % options.keys, delete_random, options.keys),
+            ("items() of 20 keys x %d" % options.iterations, iterate_items, options.iterations),
+            ("keys()+values() of 20 keys x %d" % options.iterations, keys_and_values,
+             options.iterations),
+            ("iteritems() of 20 keys x %d" % options.iterations, iterate_iteritems,
+             options.iterations)):
+        print "%-40s %9.2fs %9.2fs" % (name, bench(func, ListOrderedDict, count, options.repeat),
+                                       bench(func, OrderedDict, count, options.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# bench_paragraph_memory.py
+#
+# Loads synthetic binary Packages index with each paragraph class and reports
+# memory taken per paragraph and time of a pass reading a few fields of every
+# package. Each class is measured in a separate process, by growth of its
+# resident set size (Linux only, read from /proc/self/statm).
+#
+# Usage: python tools/bench_paragraph_memory.py [-n STANZAS] [-f FIELD,...] [CLASS...]
+#
+# $Id$
+
+import os
+import sys
+import gc
+import time
+import subprocess
+from optparse import OptionParser
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from minideblib import AptRepoClient
+from bench_parse import make_index
+
+CLASSES = ["AptRepoParagraph", "LazyAptRepoParagraph", "CompactAptRepoParagraph"]
+
+
+def rss():
+    """Returns resident set size of this process in bytes"""
+    return int(open("/proc/self/statm").read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(class_name, count, fields):
+    """Loads index with paragraph class, prints bytes per paragraph and query time"""
+    data = make_index(count)
+    gc.collect()
+    before = rss()
+    metadata = AptRepoClient.AptRepoMetadataBase("http://example.org/debian",
+                                                 allowed_arches=["amd64"],
+                                                 paragraph_class=getattr(AptRepoClient,
+                                                                         class_name))
+    stt = time.time()
+    metadata.load(StringIO(data), fields=fields)
+    loaded = time.time() - stt
+    gc.collect()
+    size = rss() - before
+    stt = time.time()
+    for pkgs in metadata.values():
+        for pkg in pkgs:
+            (pkg['package'], pkg['version'], pkg['architecture'], pkg.get('source'),
+             pkg.get('filename'))
+    print "%-24s load %.2fs, %5.0f bytes/paragraph, 5-field pass %.2fs" % (
+        class_name + ":", loaded, float(size) / count, time.time() - stt)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [CLASS...]")
+    parser.add_option("-n", "--stanzas", type="int", default=60000,
+                      help="number of stanzas to generate [%default]")
+    parser.add_option("-f", "--fields", default=None,
+                      help="comma separated fields to keep (load_repos fields), all by default")
+    parser.add_option("--child", action="store_true", default=False,
+                      help="measure one class in this process")
+    (options, args) = parser.parse_args()
+
+    fields = None
+    if options.fields:
+        fields = set(options.fields.split(","))
+    if options.child:
+        measure(args[0], options.stanzas, fields)
+        return
+    for class_name in args or CLASSES:
+        command = [sys.executable, os.path.abspath(__file__), "--child",
+                   "-n", str(options.stanzas)]
+        if options.fields:
+            command += ["-f", options.fields]
+        subprocess.check_call(command + [class_name])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# bench_parse.py
+#
+# Generates synthetic binary Packages index and compares parsing it line by
+# line with DpkgParagraph.load (as AptRepoMetadataBase.load used to do)
+# against AptRepoMetadataBase.load, which splits it into paragraphs in bulk.
+#
+# Usage: python tools/bench_parse.py [-n STANZAS] [-r REPEAT] [PACKAGES]
+#
+# If PACKAGES file is given, it's parsed instead of generated index.
+#
+# $Id$
+
+import os
+import sys
+import time
+import random
+from optparse import OptionParser
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from minideblib.AptRepoClient import AptRepoMetadataBase, AptRepoParagraph, \
+    LazyAptRepoParagraph, CompactAptRepoParagraph
+
+
+def make_index(count):
+    """Returns text of Packages index with count stanzas, similar to real ones"""
+    rand = random.Random(1)
+    stanzas = []
+    for num in range(count):
+        version = "%d.%d-%d" % (num % 7, rand.randint(0, 20), rand.randint(1, 3))
+        lines = ["Package: pkg%d" % num, "Version: %s" % version, "Architecture: amd64",
+                 "Maintainer: Someone <someone@example.org>", "Installed-Size: %d" % (num * 3)]
+        if num % 3 == 0:
+            lines.append("Source: src%d (%s)" % (num // 3, version))
+        lines += ["Depends: libc6 (>= 2.3), pkg%d" % (num + 1),
+                  "Filename: pool/main/p/pkg%d_%s_amd64.deb" % (num, version),
+                  "Size: %d" % (1000 + num), "MD5sum: %032x" % num, "SHA256: %064x" % num,
+                  "Section: misc", "Priority: optional",
+                  "Description: package number %d" % num,
+                  " A long description line for package %d." % num,
+                  " .", " More text here to make it as long as real descriptions are."]
+        stanzas.append("\n".join(lines) + "\n")
+    return "\n".join(stanzas)
+
+
+def parse_lines(data):
+    """Parses index line by line, the way AptRepoMetadataBase.load did before it
+       split paragraphs in bulk. Returns paragraph count"""
+    inf = StringIO(data)
+    metadata = AptRepoMetadataBase("http://example.org/debian", allowed_arches=["amd64"])
+    count = 0
+    while True:
+        para = AptRepoParagraph(base_url=metadata.base_url)
+        para.load(inf)
+        if not para:
+            return count
+        if 'architecture' in para and \
+                para['architecture'] not in ["all", "any"] and \
+                not [arch for arch in para['architecture'].split() if
+                     arch in metadata.allowed_arches]:
+            continue
+        if para[metadata.key] not in metadata:
+            metadata[para[metadata.key]] = []
+        metadata[para[metadata.key]].append(para)
+        count += 1
+
+
+def parse_bulk(data, paragraph_class=AptRepoParagraph):
+    """Parses index with AptRepoMetadataBase.load, returns paragraph count"""
+    metadata = AptRepoMetadataBase("http://example.org/debian", allowed_arches=["amd64"],
+                                   paragraph_class=paragraph_class)
+    metadata.load(StringIO(data))
+    return sum([len(pkgs) for pkgs in metadata.values()])
+
+
+def bench(func, data, repeat):
+    """Returns (best time of repeat runs, paragraphs parsed)"""
+    best = None
+    for idx in range(repeat):
+        stt = time.time()
+        count = func(data)
+        spent = time.time() - stt
+        if best is None or spent < best:
+            best = spent
+    return (best, count)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [PACKAGES]")
+    parser.add_option("-n", "--stanzas", type="int", default=60000,
+                      help="number of stanzas to generate [%default]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="runs of each parser, the best one counts [%default]")
+    (options, args) = parser.parse_args()
+
+    if args:
+        data = open(args[0]).read()
+    else:
+        data = make_index(options.stanzas)
+    for (name, func) in (("line by line", parse_lines),
+                         ("bulk", parse_bulk),
+                         ("bulk, lazy", lambda data: parse_bulk(data, LazyAptRepoParagraph)),
+                         ("bulk, compact", lambda data: parse_bulk(data, CompactAptRepoParagraph))):
+        (spent, count) = bench(func, data, options.repeat)
+        print "%-14s %d paragraphs in %.2fs: %.0f paragraphs/s" % (name + ":", count, spent,
+                                                                   count / spent)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# bench_scan_debs.py
+#
+# Generates pool of synthetic .deb packages and compares loading them one
+# by one with DpkgDebPackage against scan_debs with different settings.
+#
+# Usage: python tools/bench_scan_debs.py [-n PACKAGES] [-p 1,2,4] [--files] [POOLDIR]
+#
+# If POOLDIR has no generated pool yet, pool is generated there (or in temporary
+# directory, which is removed afterwards).
+#
+# $Id$
+
+import os
+import sys
+import time
+import shutil
+import tarfile
+import tempfile
+from optparse import OptionParser
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from minideblib.DpkgDebPackage import DpkgDebPackage, scan_debs, _find_debs
+
+
+def tar_data(entries):
+    """Returns tar.gz with given (name, data) entries"""
+    output = StringIO()
+    tar = tarfile.open(fileobj=output, mode="w:gz")
+    for (name, data) in entries:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = 1700000000
+        info.uname = info.gname = "root"
+        tar.addfile(info, StringIO(data))
+    tar.close()
+    return output.getvalue()
+
+
+def ar_data(members):
+    """Returns ar archive with given (name, data) members"""
+    output = ["!<arch>\n"]
+    for (name, data) in members:
+        output.append("%-16s%-12d%-6d%-6d%-8s%-10d`\n" % (name, 0, 0, 0, "100644", len(data)))
+        output.append(data)
+        if len(data) % 2:
+            output.append("\n")
+    return "".join(output)
+
+
+def make_deb(path, package, nfiles):
+    """Writes synthetic package with nfiles files to path"""
+    control = ("Package: %s\nVersion: 1.0\nArchitecture: all\n"
+               "Maintainer: Nobody <nobody@example.org>\nDescription: synthetic package\n"
+               " Generated by bench_scan_debs.py\n" % package)
+    files = [("./usr/share/%s/d%d/f%d" % (package, num % 10, num), "x" * (num % 50))
+             for num in range(nfiles)]
+    md5sums = "".join(["%032x  %s\n" % (num, name[2:]) for (num, (name, _)) in enumerate(files)])
+    fhdl = open(path, "wb")
+    fhdl.write(ar_data([("debian-binary", "2.0\n"),
+                        ("control.tar.gz", tar_data([("./control", control), ("./md5sums", md5sums)])),
+                        ("data.tar.gz", tar_data(files))]))
+    fhdl.close()
+
+
+def make_pool(root, count):
+    """Generates count packages with 200-499 files each and two broken ones"""
+    for num in range(count):
+        dirname = os.path.join(root, "main", "p%d" % (num % 20))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        make_deb(os.path.join(dirname, "pkg%d_1.0_all.deb" % num), "pkg%d" % num, 200 + num % 300)
+    fhdl = open(os.path.join(root, "main", "broken_1.0_all.deb"), "wb")
+    fhdl.write("not a deb")
+    fhdl.close()
+    good = open(os.path.join(root, "main", "p0", "pkg0_1.0_all.deb"), "rb").read()
+    fhdl = open(os.path.join(root, "main", "truncated_1.0_all.deb"), "wb")
+    fhdl.write(good[:len(good) // 2])
+    fhdl.close()
+
+
+def bench_loop(root, getfiles):
+    """Loads packages one by one, returns (seconds, loaded, failed)"""
+    stt = time.time()
+    (loaded, failed) = (0, 0)
+    for path in _find_debs(root):
+        try:
+            package = DpkgDebPackage(path)
+            if getfiles:
+                package.load(getfiles=True, getchanges=None)
+            loaded += 1
+        except Exception:
+            failed += 1
+    return (time.time() - stt, loaded, failed)
+
+
+def bench_scan(root, getfiles, processes, ordered, chunksize):
+    """Loads packages with scan_debs, returns (seconds, loaded, failed)"""
+    stt = time.time()
+    (loaded, failed) = (0, 0)
+    for (path, package, error) in scan_debs(root, processes=processes, ordered=ordered,
+                                            getfiles=getfiles, chunksize=chunksize):
+        if error is None:
+            loaded += 1
+        else:
+            failed += 1
+    return (time.time() - stt, loaded, failed)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [POOLDIR]")
+    parser.add_option("-n", "--packages", type="int", default=400,
+                      help="number of packages to generate [%default]")
+    parser.add_option("-p", "--processes", default="1,2,4",
+                      help="comma separated process counts to try [%default]")
+    parser.add_option("-c", "--chunksize", type="int", default=4,
+                      help="chunksize passed to scan_debs [%default]")
+    parser.add_option("--files", action="store_true", default=False,
+                      help="also list contents of packages")
+    (options, args) = parser.parse_args()
+
+    cleanup = not args
+    if cleanup:
+        root = tempfile.mkdtemp(prefix="bench_scan_debs")
+    else:
+        root = args[0]
+    try:
+        if not os.path.isdir(os.path.join(root, "main")):
+            stt = time.time()
+            make_pool(root, options.packages)
+            print "generated %d packages in %s: %.2fs" % (options.packages, root, time.time() - stt)
+        print "loop: %.2fs loaded %d failed %d" % bench_loop(root, options.files)
+        for processes in [int(value) for value in options.processes.split(",")]:
+            for ordered in (True, False):
+                result = bench_scan(root, options.files, processes, ordered, options.chunksize)
+                print "scan_debs processes=%d ordered=%s: %.2fs loaded %d failed %d" % (
+                    (processes, ordered) + result)
+    finally:
+        if cleanup:
+            shutil.rmtree(root, True)
+
+
+if __name__ == "__main__":
+    main()